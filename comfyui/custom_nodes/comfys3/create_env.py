@@ -9,6 +9,13 @@ S3_BUCKET_NAME={os.getenv('COMFYS3_S3_BUCKET_NAME', '')}
 S3_ENDPOINT_URL={os.getenv('COMFYS3_S3_ENDPOINT_URL', '')}
 S3_INPUT_DIR={os.getenv('COMFYS3_S3_INPUT_DIR', 'tmp/input')}
 S3_OUTPUT_DIR={os.getenv('COMFYS3_S3_OUTPUT_DIR', 'tmp/output')}
+S3_MAX_POOL_CONNECTIONS={os.getenv('COMFYS3_S3_MAX_POOL_CONNECTIONS', '32')}
+S3_MAX_ATTEMPTS={os.getenv('COMFYS3_S3_MAX_ATTEMPTS', '5')}
+S3_MULTIPART_THRESHOLD={os.getenv('COMFYS3_S3_MULTIPART_THRESHOLD', str(16 * 1024 * 1024))}
+S3_MULTIPART_CHUNKSIZE={os.getenv('COMFYS3_S3_MULTIPART_CHUNKSIZE', str(16 * 1024 * 1024))}
+S3_MAX_CONCURRENCY={os.getenv('COMFYS3_S3_MAX_CONCURRENCY', '8')}
+S3_MAX_BANDWIDTH={os.getenv('COMFYS3_S3_MAX_BANDWIDTH', '')}
+S3_BATCH_WORKERS={os.getenv('COMFYS3_S3_BATCH_WORKERS', '4')}
 """
 
     with open('.env', 'w') as f:
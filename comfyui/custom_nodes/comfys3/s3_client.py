@@ -1,11 +1,101 @@
+import io
 import os
+import re
+import time
+import posixpath
+import threading
 import boto3
 from .logger import logger
-from botocore.exceptions import NoCredentialsError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError, NoCredentialsError
 
 from dotenv import load_dotenv
 load_dotenv()
 
+S3_CONFIG = Config(
+    signature_version='s3v4',
+    s3={
+        # This helps with Backblaze B2 compatibility
+        'addressing_style': 'virtual'
+    },
+    max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32)),
+    retries={
+        'max_attempts': int(os.getenv("S3_MAX_ATTEMPTS", 5)),
+        'mode': 'standard'
+    },
+    tcp_keepalive=True
+)
+
+MB = 1024 * 1024
+
+# Part size, number of parts transferred in parallel and optional bandwidth cap (bytes/s)
+# for every upload and download. Keep S3_MAX_POOL_CONNECTIONS above
+# S3_BATCH_WORKERS * S3_MAX_CONCURRENCY so batch transfers do not wait for connections.
+# Like every setting these are written to the .env by create_env.py from the COMFYS3_S3_*
+# variables.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD", 16 * MB)),
+    multipart_chunksize=int(os.getenv("S3_MULTIPART_CHUNKSIZE", 16 * MB)),
+    max_concurrency=int(os.getenv("S3_MAX_CONCURRENCY", 8)),
+    max_bandwidth=int(os.getenv("S3_MAX_BANDWIDTH")) if os.getenv("S3_MAX_BANDWIDTH") else None
+)
+
+S3_BATCH_WORKERS = int(os.getenv("S3_BATCH_WORKERS", 4))
+
+# Names of the files saved with a counter from get_save_path: <filename>_<counter>_<rest>
+SAVE_NAME_PATTERN = re.compile(r"^(.+)_(\d{5,})_(.*)$")
+# Error codes of a conditional put whose key is already taken
+KEY_TAKEN_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+SAVE_CLAIM_ATTEMPTS = 100
+
+_session = None
+_s3_instance = None
+_lock = threading.Lock()
+_transfer_observers = []
+# (direction, status) -> [count, bytes, seconds] of every transfer made by this process
+_transfer_totals = {}
+_totals_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session()
+
+        return _session
+
+
+def add_transfer_observer(observer):
+    """Call observer(direction, status, size, seconds) after every upload and download."""
+    _transfer_observers.append(observer)
+
+
+def get_transfer_totals():
+    """Return the totals of every transfer made by this process, per direction and status."""
+    with _totals_lock:
+        return [
+            {'direction': direction, 'status': status, 'count': count, 'bytes': size, 'seconds': seconds}
+            for (direction, status), (count, size, seconds) in _transfer_totals.items()
+        ]
+
+
+def _notify_transfer(direction, status, size=0, elapsed=0.0):
+    with _totals_lock:
+        totals = _transfer_totals.setdefault((direction, status), [0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += size
+        totals[2] += elapsed
+
+    for observer in _transfer_observers:
+        try:
+            observer(direction, status, size, elapsed)
+        except Exception as e:
+            logger.error(f"Transfer observer failed: {e}")
+
 
 class S3:
     def __init__(self, region, access_key, secret_key, bucket_name, endpoint_url):
@@ -14,6 +104,15 @@ class S3:
         self.secret_key = secret_key
         self.bucket_name = bucket_name
         self.endpoint_url = endpoint_url
+        self.client_creation_time = None
+        self.bucket_verification_time = None
+        self.bucket_verified = False
+        self.bucket_lock = threading.Lock()
+        self.transfer_lock = threading.Lock()
+        self.transfer_stats = {
+            'upload': {'count': 0, 'bytes': 0, 'seconds': 0.0},
+            'download': {'count': 0, 'bytes': 0, 'seconds': 0.0}
+        }
         self.s3_client = self.get_client()
         
         if self.s3_client is None:
@@ -21,6 +120,15 @@ class S3:
             
         self.input_dir = os.getenv("S3_INPUT_DIR")
         self.output_dir = os.getenv("S3_OUTPUT_DIR")
+
+        # Last counter used per (folder, filename) and folders known to exist, so that
+        # get_save_path only lists the bucket the first time a filename is used. Workers
+        # sharing the output folder claim every name with a conditional put before
+        # uploading to it, which only stops if the storage doesn't support them.
+        self.counters = {}
+        self.known_folders = set()
+        self.counter_lock = threading.Lock()
+        self.conditional_puts = True
         
         # if not self.does_folder_exist(self.input_dir):
         #     self.create_folder(self.input_dir)
@@ -51,48 +159,50 @@ class S3:
             return None
     
         try:
-            # For Backblaze B2, we need to use boto3.client instead of boto3.resource
-            # and configure it specifically for S3-compatible services
-            s3_client = boto3.client(
-                's3',
-                region_name=self.region,
-                aws_access_key_id=self.access_key,
-                aws_secret_access_key=self.secret_key,
-                endpoint_url=self.endpoint_url,
-                # These config options help with Backblaze B2 compatibility
-                config=boto3.session.Config(
-                    signature_version='s3v4',
-                    s3={
-                        'addressing_style': 'virtual'
-                    }
-                )
-            )
-            
-            # Test the connection by listing buckets
-            s3_client.head_bucket(Bucket=self.bucket_name)
-            logger.info(f"Successfully connected to S3-compatible storage at {self.endpoint_url}")
-            
-            # Return a resource object that uses our configured client
-            s3_resource = boto3.resource(
+            start = time.perf_counter()
+
+            # A single client, which unlike a resource is thread-safe, shares its connection pool
+            # between every node and thread, the bucket is only checked on first use so that
+            # creating it needs no request
+            s3_client = get_session().client(
                 's3',
                 region_name=self.region,
                 aws_access_key_id=self.access_key,
                 aws_secret_access_key=self.secret_key,
                 endpoint_url=self.endpoint_url,
-                config=boto3.session.Config(
-                    signature_version='s3v4',
-                    s3={
-                        'addressing_style': 'virtual'
-                    }
-                )
+                config=S3_CONFIG
             )
-            return s3_resource
+
+            self.client_creation_time = time.perf_counter() - start
+            logger.info(f"Created S3 client for {self.endpoint_url} in {self.client_creation_time * 1000:.1f}ms")
+            return s3_client
             
         except Exception as e:
             err = f"Failed to create S3 client: {e}"
             logger.error(err)
             return None
 
+    def check_bucket(self):
+        """Check that the bucket is reachable the first time it is used."""
+        if not self.bucket_verified:
+            with self.bucket_lock:
+                if not self.bucket_verified:
+                    start = time.perf_counter()
+                    self.s3_client.head_bucket(Bucket=self.bucket_name)
+                    self.bucket_verification_time = time.perf_counter() - start
+                    self.bucket_verified = True
+                    logger.info(f"Successfully connected to S3-compatible storage at {self.endpoint_url} in {self.bucket_verification_time * 1000:.1f}ms")
+
+    def list_keys(self, prefix, max_keys=None):
+        """Yield the keys of the bucket starting with prefix, up to max_keys of them."""
+        self.check_bucket()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pagination = {'MaxItems': max_keys} if max_keys else {}
+
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, PaginationConfig=pagination):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
+
     def get_files(self, prefix):
         if self.s3_client is None:
             logger.error("S3 client is not initialized")
@@ -100,9 +210,8 @@ class S3:
             
         if self.does_folder_exist(prefix):
             try:
-                bucket = self.s3_client.Bucket(self.bucket_name)
                 normalized_prefix = self._normalize_s3_path(prefix)
-                files = [obj.key for obj in bucket.objects.filter(Prefix=normalized_prefix)]
+                files = list(self.list_keys(normalized_prefix))
                 files = [f.replace(normalized_prefix, "") for f in files if f != normalized_prefix and not f.endswith('/')]
                 return files
             except Exception as e:
@@ -118,12 +227,10 @@ class S3:
             return False
             
         try:
-            bucket = self.s3_client.Bucket(self.bucket_name)
             # Normalize and ensure folder_name ends with / for proper prefix matching
             normalized_folder = self._normalize_s3_path(folder_name)
             prefix = normalized_folder if normalized_folder.endswith('/') else f"{normalized_folder}/"
-            response = bucket.objects.filter(Prefix=prefix, MaxKeys=1)
-            return any(True for _ in response)
+            return any(True for _ in self.list_keys(prefix, max_keys=1))
         except Exception as e:
             err = f"Failed to check if folder exists in S3: {e}"
             logger.error(err)
@@ -135,13 +242,13 @@ class S3:
             return False
             
         try:
-            bucket = self.s3_client.Bucket(self.bucket_name)
+            self.check_bucket()
             # Normalize the path and ensure it ends with /
             folder_key = self._normalize_s3_path(folder_name)
             if not folder_key.endswith('/'):
                 folder_key += '/'
             
-            bucket.put_object(Key=folder_key)
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=folder_key)
             logger.info(f"Created folder: {folder_key}")
             return True
         except Exception as e:
@@ -155,21 +262,26 @@ class S3:
             return None
             
         local_dir = os.path.dirname(local_path)
+        # exist_ok as download_many can create the same directory from several threads
         if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
+            os.makedirs(local_dir, exist_ok=True)
         try:
             normalized_s3_path = self._normalize_s3_path(s3_path)
-            bucket = self.s3_client.Bucket(self.bucket_name)
-            bucket.download_file(normalized_s3_path, local_path)
-            logger.info(f"Downloaded {normalized_s3_path} to {local_path}")
+            self.check_bucket()
+            start = time.perf_counter()
+            self.s3_client.download_file(self.bucket_name, normalized_s3_path, local_path, Config=TRANSFER_CONFIG)
+            throughput = self._record_transfer('download', os.path.getsize(local_path), time.perf_counter() - start)
+            logger.info(f"Downloaded {normalized_s3_path} to {local_path} ({throughput})")
             return local_path
         except NoCredentialsError:
             err = "Credentials not available or not valid."
             logger.error(err)
+            _notify_transfer('download', 'error')
             return None
         except Exception as e:
             err = f"Failed to download file from S3: {e}"
             logger.error(err)
+            _notify_transfer('download', 'error')
             return None
 
     def upload_file(self, local_path, s3_path):
@@ -178,20 +290,89 @@ class S3:
             return None
             
         try:
-            normalized_s3_path = self._normalize_s3_path(s3_path)
-            bucket = self.s3_client.Bucket(self.bucket_name)
-            bucket.upload_file(local_path, normalized_s3_path)
-            logger.info(f"Uploaded {local_path} to /{normalized_s3_path}")
+            normalized_s3_path = self.claim_save_key(self._normalize_s3_path(s3_path))
+            start = time.perf_counter()
+            self.s3_client.upload_file(local_path, self.bucket_name, normalized_s3_path, Config=TRANSFER_CONFIG)
+            throughput = self._record_transfer('upload', os.path.getsize(local_path), time.perf_counter() - start)
+            logger.info(f"Uploaded {local_path} to /{normalized_s3_path} ({throughput})")
             return normalized_s3_path
         except NoCredentialsError:
             err = "Credentials not available or not valid."
             logger.error(err)
+            _notify_transfer('upload', 'error')
             return None
         except Exception as e:
             err = f"Failed to upload file to S3: {e}"
             logger.error(err)
+            _notify_transfer('upload', 'error')
             return None
-    
+
+    def upload_bytes(self, data, s3_path):
+        if self.s3_client is None:
+            logger.error("S3 client is not initialized")
+            return None
+
+        try:
+            normalized_s3_path = self._normalize_s3_path(s3_path)
+            self.check_bucket()
+            start = time.perf_counter()
+            self.s3_client.upload_fileobj(io.BytesIO(data), self.bucket_name, normalized_s3_path, Config=TRANSFER_CONFIG)
+            throughput = self._record_transfer('upload', len(data), time.perf_counter() - start)
+            logger.info(f"Uploaded {len(data)} bytes to /{normalized_s3_path} ({throughput})")
+            return normalized_s3_path
+        except NoCredentialsError:
+            err = "Credentials not available or not valid."
+            logger.error(err)
+            _notify_transfer('upload', 'error')
+            return None
+        except Exception as e:
+            err = f"Failed to upload data to S3: {e}"
+            logger.error(err)
+            _notify_transfer('upload', 'error')
+            return None
+
+    def upload_many(self, transfers):
+        """Upload (local_path, s3_path) pairs concurrently, returning the S3 paths (or None) in order."""
+        with ThreadPoolExecutor(max_workers=S3_BATCH_WORKERS) as executor:
+            return list(executor.map(lambda transfer: self.upload_file(*transfer), transfers))
+
+    def download_many(self, transfers):
+        """Download (s3_path, local_path) pairs concurrently, returning the local paths (or None) in order."""
+        with ThreadPoolExecutor(max_workers=S3_BATCH_WORKERS) as executor:
+            return list(executor.map(lambda transfer: self.download_file(*transfer), transfers))
+
+    def get_transfer_stats(self):
+        with self.transfer_lock:
+            return {direction: stats.copy() for direction, stats in self.transfer_stats.items()}
+
+    def _record_transfer(self, direction, size, elapsed):
+        with self.transfer_lock:
+            stats = self.transfer_stats[direction]
+            stats['count'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += elapsed
+
+        _notify_transfer(direction, 'success', size, elapsed)
+        throughput = size / elapsed / (1024 * 1024) if elapsed > 0 else 0
+        return f"{size} bytes in {elapsed:.2f}s, {throughput:.1f} MiB/s"
+
+    def get_presigned_url(self, s3_path, expires_in=3600):
+        if self.s3_client is None:
+            logger.error("S3 client is not initialized")
+            return None
+
+        try:
+            normalized_s3_path = self._normalize_s3_path(s3_path)
+            return self.s3_client.generate_presigned_url(
+                'get_object',
+                Params={'Bucket': self.bucket_name, 'Key': normalized_s3_path},
+                ExpiresIn=expires_in
+            )
+        except Exception as e:
+            err = f"Failed to create presigned URL: {e}"
+            logger.error(err)
+            return None
+
     def get_save_path(self, filename_prefix, image_width=0, image_height=0):
         def map_filename(filename):
             prefix_len = len(os.path.basename(filename_prefix))
@@ -212,27 +393,117 @@ class S3:
         filename = os.path.basename(os.path.normpath(filename_prefix))
         
         full_output_folder_s3 = os.path.join(self.output_dir, subfolder).replace('\\', '/').replace('//', '/')
-        
-        # Check if the output folder exists, create it if it doesn't
-        if not self.does_folder_exist(full_output_folder_s3):
-            self.create_folder(full_output_folder_s3)
+        # Keyed like the folder of the keys passed to upload_file, so that claim_save_key finds it
+        key = (self._normalize_s3_path(full_output_folder_s3).rstrip('/'), filename)
 
-        try:
-            # Continue with the counter calculation
-            files = self.get_files(full_output_folder_s3)
-            counter = max(
-                filter(
-                    lambda a: a[1][:-1] == filename and a[1][-1] == "_",
-                    map(map_filename, files)
-                )
-            )[0] + 1
-        except (ValueError, KeyError):
-            counter = 1
+        with self.counter_lock:
+            seeded = key in self.counters
+            folder_known = full_output_folder_s3 in self.known_folders
+
+        # The bucket is listed without holding the lock so that other saves are not held up
+        if not seeded:
+            # Check if the output folder exists, create it if it doesn't
+            if not folder_known:
+                if not self.does_folder_exist(full_output_folder_s3):
+                    self.create_folder(full_output_folder_s3)
+
+            try:
+                # Seed the counter from the files already saved with this filename
+                files = self.get_files_with_prefix(full_output_folder_s3, f"{filename}_")
+                last_counter = max(
+                    filter(
+                        lambda a: a[1][:-1] == filename and a[1][-1] == "_",
+                        map(map_filename, files)
+                    )
+                )[0]
+            except (ValueError, KeyError):
+                last_counter = 0
+
+            with self.counter_lock:
+                self.known_folders.add(full_output_folder_s3)
+                self.counters[key] = max(self.counters.get(key, 0), last_counter)
+
+        with self.counter_lock:
+            self.counters[key] += 1
+            counter = self.counters[key]
         
         return full_output_folder_s3, filename, counter, subfolder, filename_prefix
 
+    def claim_save_key(self, key):
+        """
+        Claim a key named after a counter from get_save_path with a conditional put
+        of an empty object before it is uploaded, so that workers sharing the output
+        folder never overwrite each other's files. When the name is taken the counter
+        is bumped until a free one is found. Returns the key to upload to.
+        """
+        self.check_bucket()
+        folder, name = posixpath.split(key)
+        match = SAVE_NAME_PATTERN.match(name)
+
+        if match is None:
+            return key
+
+        filename, counter, rest = match.group(1), int(match.group(2)), match.group(3)
+        counter_key = (folder, filename)
+
+        with self.counter_lock:
+            if counter_key not in self.counters or not self.conditional_puts:
+                return key
+
+        for _ in range(SAVE_CLAIM_ATTEMPTS):
+            claimed_key = posixpath.join(folder, f"{filename}_{counter:05}_{rest}")
+
+            try:
+                self.s3_client.put_object(Bucket=self.bucket_name, Key=claimed_key, Body=b"", IfNoneMatch="*")
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+
+                if code in KEY_TAKEN_CODES:
+                    counter += 1
+                    continue
+
+                if code != "NotImplemented":
+                    raise
+
+                logger.warning(f"Conditional puts are not supported, saving without claiming names: {e}")
+                self.conditional_puts = False
+                return claimed_key
+
+            # Nodes number the images of a batch from the counter they got, so keep up with them
+            with self.counter_lock:
+                self.counters[counter_key] = max(self.counters[counter_key], counter)
+
+            if claimed_key != key:
+                logger.warning(f"{key} was saved by another worker, saving to {claimed_key} instead")
+
+            return claimed_key
+
+        raise Exception(f"No free name found for {key} after {SAVE_CLAIM_ATTEMPTS} attempts")
+
+    def get_files_with_prefix(self, folder, name_prefix):
+        """List the files of a folder whose name starts with name_prefix, relative to the folder."""
+        if self.s3_client is None:
+            logger.error("S3 client is not initialized")
+            return []
+
+        try:
+            normalized_folder = self._normalize_s3_path(folder)
+            folder_prefix = normalized_folder if normalized_folder.endswith('/') else f"{normalized_folder}/"
+            files = [key[len(folder_prefix):] for key in self.list_keys(f"{folder_prefix}{name_prefix}")]
+            return [f for f in files if f and not f.endswith('/')]
+        except Exception as e:
+            err = f"Failed to get files from S3: {e}"
+            logger.error(err)
+            return []
+
 
 def get_s3_instance():
+    """Return the S3 instance shared by the whole process, creating it on first use."""
+    global _s3_instance
+
+    if _s3_instance is not None:
+        return _s3_instance
+
     try:
         s3_instance = S3(
             region=os.getenv("S3_REGION"),
@@ -241,8 +512,37 @@ def get_s3_instance():
             bucket_name=os.getenv("S3_BUCKET_NAME"),
             endpoint_url=os.getenv("S3_ENDPOINT_URL")
         )
-        return s3_instance
     except Exception as e:
         err = f"Failed to create S3 instance: {e} Please check your environment variables."
         logger.error(err)
         return None
+
+    with _lock:
+        if _s3_instance is None:
+            _s3_instance = s3_instance
+
+        return _s3_instance
+
+
+def _add_stats_route():
+    """
+    Serve the transfer totals on /comfys3/stats when running inside ComfyUI, so
+    that the RunPod handler can export the transfers made by the comfys3 nodes.
+    """
+    try:
+        import server
+        from aiohttp import web
+    except ImportError:
+        return
+
+    prompt_server = getattr(getattr(server, "PromptServer", None), "instance", None)
+
+    if prompt_server is None:
+        return
+
+    @prompt_server.routes.get("/comfys3/stats")
+    async def get_stats(request):
+        return web.json_response(get_transfer_totals())
+
+
+_add_stats_route()
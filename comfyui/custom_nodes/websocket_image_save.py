@@ -1,6 +1,8 @@
 from PIL import Image
-import numpy as np
 import comfy.utils
+import server
+import torch
+import io
 import time
 
 #You can use this node to save full size images through the websocket, the
@@ -8,13 +10,35 @@ import time
 #binary images on the websocket with a 8 byte header indicating the type
 #of binary message (first 4 bytes) and the image format (next 4 bytes).
 
+#Besides the JPEG (1) and PNG (2) formats used by the previews, images can be
+#sent as WEBP (3) or as RAW (4) RGB pixels, which are prefixed with their
+#width and height (4 bytes each) so they can be read back without decoding.
+
 #Note that no metadata will be put in the images saved with this node.
 
+IMAGE_FORMATS = {
+    "JPEG": 1,
+    "PNG": 2,
+    "WEBP": 3,
+    "RAW": 4,
+}
+CONVERT_CHUNK_NUMEL = 16 * 1024 * 1024
+# Larger batches get a host buffer of their own that is freed once they are sent
+PIXELS_BUFFER_MAX_NUMEL = 64 * 1024 * 1024
+
 class SaveImageWebsocket:
+    def __init__(self):
+        # Reused across executions so that batches up to PIXELS_BUFFER_MAX_NUMEL don't allocate a new buffer every time
+        self.pixels = None
+        self.buffer = io.BytesIO()
+
     @classmethod
     def INPUT_TYPES(s):
         return {"required":
-                    {"images": ("IMAGE", ),}
+                    {"images": ("IMAGE", ),},
+                "optional":
+                    {"format": (list(IMAGE_FORMATS), {"default": "PNG"}),
+                     "quality": ("INT", {"default": 95, "min": 1, "max": 100}),}
                 }
 
     RETURN_TYPES = ()
@@ -24,19 +48,70 @@ class SaveImageWebsocket:
 
     CATEGORY = "api/image"
 
-    def save_images(self, images):
+    def to_uint8(self, images):
+        images = images.detach()
+        frame_numel = images[0].numel()
+        numel = images.numel()
+        # Convert as many frames at once as fit in CONVERT_CHUNK_NUMEL to bound the temporaries
+        chunk = max(1, CONVERT_CHUNK_NUMEL // frame_numel)
+
+        if numel > PIXELS_BUFFER_MAX_NUMEL:
+            pixels = torch.empty(numel, dtype=torch.uint8, pin_memory=images.is_cuda)
+        else:
+            if self.pixels is None or self.pixels.numel() < numel:
+                self.pixels = torch.empty(numel, dtype=torch.uint8, pin_memory=images.is_cuda)
+
+            pixels = self.pixels[:numel]
+
+        pixels = pixels.view(images.shape)
+
+        for start in range(0, images.shape[0], chunk):
+            frames = images[start:start + chunk]
+            # The caching allocator hands the memory of the previous chunk back to this one
+            scaled = torch.mul(frames, 255.).clamp_(0, 255)
+            # Casts and transfers in one copy, truncating like astype(np.uint8) did
+            pixels[start:start + chunk].copy_(scaled)
+
+        return pixels.numpy()
+
+    def encode(self, pixels, image_format, quality):
+        buffer = self.buffer
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(IMAGE_FORMATS[image_format].to_bytes(4, "big"))
+
+        if image_format == "RAW":
+            height, width = pixels.shape[:2]
+            buffer.write(width.to_bytes(4, "big"))
+            buffer.write(height.to_bytes(4, "big"))
+            buffer.write(memoryview(pixels))
+        else:
+            img = Image.fromarray(pixels)
+
+            if image_format == "PNG":
+                img.save(buffer, format="PNG", compress_level=1)
+            else:
+                img.save(buffer, format=image_format, quality=quality)
+
+        return buffer.getvalue()
+
+    def save_images(self, images, format="PNG", quality=95):
+        prompt_server = server.PromptServer.instance
         pbar = comfy.utils.ProgressBar(images.shape[0])
-        step = 0
-        for image in images:
-            i = 255. * image.cpu().numpy()
-            img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
-            pbar.update_absolute(step, images.shape[0], ("PNG", img, None))
-            step += 1
+        pixels = self.to_uint8(images)
+
+        if format == "RAW" and pixels.shape[-1] != 3:
+            raise ValueError("RAW images must have 3 channels")
+
+        for step, frame in enumerate(pixels):
+            message = self.encode(frame, format, quality)
+            prompt_server.send_sync(server.BinaryEventTypes.PREVIEW_IMAGE, message, prompt_server.client_id)
+            pbar.update_absolute(step + 1, images.shape[0])
 
         return {}
 
     @classmethod
-    def IS_CHANGED(s, images):
+    def IS_CHANGED(s, images, format="PNG", quality=95):
         return time.time()
 
 NODE_CLASS_MAPPINGS = {
@@ -8,411 +8,3378 @@ import base64
 import uuid
 import logging
 import logging.handlers
+import asyncio
+import threading
+import contextvars
+import collections
+import multiprocessing
+import concurrent.futures
+import sys
+import importlib
+import importlib.util
+import re
+import hashlib
+import bisect
+import http.server
+import mimetypes
+import contextlib
+import queue
 import runpod
+import websocket
 from runpod.serverless.utils.rp_validator import validate
-from runpod.serverless.modules.rp_logger import RunPodLogger
+from runpod.serverless.modules.rp_logger import RunPodLogger, LOG_LEVELS
 from requests.adapters import HTTPAdapter, Retry
-from schemas.input import INPUT_SCHEMA
+from schemas.input import INPUT_SCHEMA, OUTPUT_SCHEMA
+from schemas.workflows import WORKFLOW_BINDINGS, WORKFLOW_WARMUP
 from PIL import Image
+from dotenv import load_dotenv
+from json.encoder import encode_basestring_ascii as encode_json_string
 
 APP_NAME = 'runpod-worker-comfyui'
 BASE_URI = 'http://127.0.0.1:3000'
+WS_URI = 'ws://127.0.0.1:3000'
+CLIENT_ID = str(uuid.uuid4())
 VOLUME_MOUNT_PATH = '' # we are using the local comfy instance (used to be /runpod-volume)
 LOG_FILE = 'comfyui-worker.log'
 TIMEOUT = 600
 LOG_LEVEL = 'INFO'
+WS_CONNECT_TIMEOUT = 10
+WS_RECV_TIMEOUT = 30
+WS_RECONNECT_DELAY = 1
+WS_WAIT_INTERVAL = 5
+MAX_TRACKED_PROMPTS = 1000
+POLL_INTERVAL_MIN = 0.1
+POLL_INTERVAL_MAX = 2
+POLL_BACKOFF = 1.5
+# Binary websocket messages start with a 4 byte event type and a 4 byte image format
+WS_BINARY_HEADER_SIZE = 8
+WS_BINARY_PREVIEW_IMAGE = 1
+WS_BINARY_IMAGE_FORMATS = {
+    1: 'jpeg',
+    2: 'png',
+    3: 'webp',
+    4: 'raw'
+}
+OUTPUT_ENCODE_WORKERS = int(os.getenv('OUTPUT_ENCODE_WORKERS', min(8, os.cpu_count() or 1)))
+OUTPUT_UPLOAD_WORKERS = int(os.getenv('OUTPUT_UPLOAD_WORKERS', 8))
+OUTPUT_PRESIGN_EXPIRY = int(os.getenv('OUTPUT_PRESIGN_EXPIRY', 3600))
+COMFYS3_PATH = '/comfyui/custom_nodes/comfys3'
+WORKFLOWS_DIR = '/workflows'
+INPUT_DIR = f'{VOLUME_MOUNT_PATH}/comfyui/input'
+COMFYUI_LOG_PATH = '/comfyui-logs/comfyui-serverless.log'
+STARTUP_TIMEOUT = int(os.getenv('STARTUP_TIMEOUT', 900))
+STARTUP_POLL_INTERVAL = 0.1
+WARMUP = os.getenv('WARMUP', 'false').lower() == 'true'
+WARMUP_TIMEOUT = int(os.getenv('WARMUP_TIMEOUT', 600))
+INPUT_CACHE_SUBFOLDER = 'prefetch'
+INPUT_CACHE_MAX_BYTES = int(os.getenv('INPUT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+INPUT_FETCH_WORKERS = int(os.getenv('INPUT_FETCH_WORKERS', 8))
+# How many times a prompt is queued again after a transient error, with exponential backoff
+TRANSIENT_RETRIES = int(os.getenv('TRANSIENT_RETRIES', 2))
+TRANSIENT_RETRY_DELAY = 1
+HEALTH_CHECK_TIMEOUT = 5
+# Errors after which the GPU or ComfyUI can't be trusted anymore and the worker must be refreshed
+POISONED_ERROR_PATTERN = re.compile(
+    r'out of memory|OutOfMemoryError|not enough memory|CUDA error|CUBLAS_STATUS|cuDNN error|device-side assert|HIP error',
+    re.IGNORECASE
+)
+# Unload the ComfyUI models between prompts when the next workflow would not fit in the free memory
+RESOURCE_GOVERNOR = os.getenv('RESOURCE_GOVERNOR', 'false').lower() == 'true'
+RESOURCE_HEADROOM_BYTES = int(os.getenv('RESOURCE_HEADROOM_BYTES', 1024 * 1024 * 1024))
+RESOURCE_MIN_FREE_FRACTION = float(os.getenv('RESOURCE_MIN_FREE_FRACTION', 0.2))
+MODEL_FILE_EXTENSIONS = ('.safetensors', '.sft', '.ckpt', '.pt', '.pth', '.bin', '.gguf')
+# Check graphs against the /object_info node definitions before queuing them
+VALIDATE_GRAPHS = os.getenv('VALIDATE_GRAPHS', 'true').lower() == 'true'
+# Return the stored result of a graph that has already been executed instead of queuing it again
+RESULT_CACHE = os.getenv('RESULT_CACHE', 'false').lower() == 'true'
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '/result-cache')
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+RESULT_CACHE_TTL = int(os.getenv('RESULT_CACHE_TTL', 24 * 60 * 60))
+# How long a job waits for an identical prompt that is already in flight
+PROMPT_FLIGHT_TIMEOUT = int(os.getenv('PROMPT_FLIGHT_TIMEOUT', 60 * 60))
+
+# Input names of the nodes that load an image from the ComfyUI input directory
+INPUT_IMAGE_NODES = {
+    'LoadImage': 'image',
+    'LoadImageMask': 'image'
+}
+# Input names of the output nodes whose names create_unique_filename_prefix replaces
+OUTPUT_NAME_INPUTS = {
+    'SaveImage': 'filename_prefix',
+    'SaveText|pysssss': 'file'
+}
+IMAGE_FORMATS = {
+    'webp': 'WEBP',
+    'png': 'PNG',
+    'jpeg': 'JPEG',
+    'avif': 'AVIF'
+}
+
+# Server-side default output policy, individual requests can override any of these
+DEFAULT_OUTPUT_POLICY = {
+    'format': os.getenv('OUTPUT_FORMAT', 'webp'),
+    'quality': int(os.getenv('OUTPUT_QUALITY')) if os.getenv('OUTPUT_QUALITY') else None,
+    'lossless': os.getenv('OUTPUT_LOSSLESS', 'false').lower() == 'true',
+    'effort': int(os.getenv('OUTPUT_EFFORT')) if os.getenv('OUTPUT_EFFORT') else None,
+    'max_dimension': int(os.getenv('OUTPUT_MAX_DIMENSION')) if os.getenv('OUTPUT_MAX_DIMENSION') else None,
+    'passthrough': os.getenv('OUTPUT_PASSTHROUGH', 'false').lower() == 'true',
+    'delivery': os.getenv('OUTPUT_DELIVERY', 'inline'),
+    'inline_max_bytes': int(os.getenv('OUTPUT_INLINE_MAX_BYTES', 1024 * 1024)),
+    'presign': os.getenv('OUTPUT_PRESIGN', 'true').lower() == 'true',
+    'capture': os.getenv('OUTPUT_CAPTURE', 'file')
+}
+
+JOB_CONCURRENCY = int(os.getenv('JOB_CONCURRENCY', 1))
+STREAM_OUTPUTS = os.getenv('STREAM_OUTPUTS', 'false').lower() == 'true'
+# Log the aggregated job timings every this many jobs, 0 disables collecting them
+TIMINGS_LOG_INTERVAL = int(os.getenv('TIMINGS_LOG_INTERVAL', 0))
+TIMING_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Serve the metrics in the Prometheus text format on this port, 0 disables the endpoint
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+
+# Id of the job being handled, set per job so that concurrent jobs log their own id
+job_id_context = contextvars.ContextVar('job_id', default=None)
+# Timer of the job being handled, None unless its timings were requested or are being aggregated
+job_timer_context = contextvars.ContextVar('job_timer', default=None)
+encode_pool = None
+encode_pool_lock = threading.Lock()
+s3 = None
+s3_lock = threading.Lock()
 
 
 class SnapLogHandler(logging.Handler):
+    # RunPod logger level and method for each logging level, anything else is logged as info
+    RUNPOD_LEVELS = {
+        logging.DEBUG: ('DEBUG', 'debug'),
+        logging.INFO: ('INFO', 'info'),
+        logging.WARNING: ('WARN', 'warn'),
+        logging.ERROR: ('ERROR', 'error'),
+        logging.CRITICAL: ('ERROR', 'error')
+    }
+
     def __init__(self, app_name: str):
         super().__init__()
         self.app_name = app_name
         self.rp_logger = RunPodLogger()
         self.rp_logger.set_level(LOG_LEVEL)
-        self.runpod_endpoint_id = os.getenv('RUNPOD_ENDPOINT_ID')
-        self.runpod_cpu_count = os.getenv('RUNPOD_CPU_COUNT')
-        self.runpod_pod_id = os.getenv('RUNPOD_POD_ID')
-        self.runpod_gpu_size = os.getenv('RUNPOD_GPU_SIZE')
-        self.runpod_mem_gb = os.getenv('RUNPOD_MEM_GB')
-        self.runpod_gpu_count = os.getenv('RUNPOD_GPU_COUNT')
-        self.runpod_volume_id = os.getenv('RUNPOD_VOLUME_ID')
-        self.runpod_pod_hostname = os.getenv('RUNPOD_POD_HOSTNAME')
-        self.runpod_debug_level = os.getenv('RUNPOD_DEBUG_LEVEL')
-        self.runpod_dc_id = os.getenv('RUNPOD_DC_ID')
-        self.runpod_gpu_name = os.getenv('RUNPOD_GPU_NAME')
         self.log_api_endpoint = os.getenv('LOG_API_ENDPOINT')
         self.log_api_timeout = os.getenv('LOG_API_TIMEOUT', 5)
         self.log_api_timeout = int(self.log_api_timeout)
         self.log_token = os.getenv('LOG_API_TOKEN')
+        self.log_api_batch_size = int(os.getenv('LOG_API_BATCH_SIZE', 100))
+        self.log_api_flush_interval = float(os.getenv('LOG_API_FLUSH_INTERVAL', 1))
+        self.log_api_queue_size = int(os.getenv('LOG_API_QUEUE_SIZE', 10000))
+
+        # The pod metadata never changes, so it is serialised once and spliced into every record
+        self.static_fields = json.dumps({
+            'app_name': self.app_name,
+            'runpod_endpoint_id': os.getenv('RUNPOD_ENDPOINT_ID'),
+            'runpod_cpu_count': os.getenv('RUNPOD_CPU_COUNT'),
+            'runpod_pod_id': os.getenv('RUNPOD_POD_ID'),
+            'runpod_gpu_size': os.getenv('RUNPOD_GPU_SIZE'),
+            'runpod_mem_gb': os.getenv('RUNPOD_MEM_GB'),
+            'runpod_gpu_count': os.getenv('RUNPOD_GPU_COUNT'),
+            'runpod_volume_id': os.getenv('RUNPOD_VOLUME_ID'),
+            'runpod_pod_hostname': os.getenv('RUNPOD_POD_HOSTNAME'),
+            'runpod_debug_level': os.getenv('RUNPOD_DEBUG_LEVEL'),
+            'runpod_dc_id': os.getenv('RUNPOD_DC_ID'),
+            'runpod_gpu_name': os.getenv('RUNPOD_GPU_NAME')
+        })[1:-1]
+
+        # Bound RunPod logger methods of the levels it prints, resolved once instead of per record
+        self.rp_sinks = {}
+
+        for levelno, (rp_level, method) in self.RUNPOD_LEVELS.items():
+            if self.rp_logger.level != 'NOTSET' and LOG_LEVELS.index(self.rp_logger.level) <= LOG_LEVELS.index(rp_level):
+                self.rp_sinks[levelno] = getattr(self.rp_logger, method)
+
+        self.rp_default_sink = self.rp_sinks.get(logging.INFO)
+        self.asctime_second = None
+        self.asctime_prefix = None
+
+        # Records are shipped to the log API in batches by a background thread so that
+        # a slow log API never blocks the handler. When the buffer is full the oldest
+        # records are dropped.
+        self.log_queue = collections.deque(maxlen=self.log_api_queue_size)
+        self.log_condition = threading.Condition()
+        self.log_in_flight = 0
+        self.log_flush_requested = False
+        self.log_closed = False
+        self.records_shipped = 0
+        self.records_dropped = 0
+        self.batches_sent = 0
+        self.batch_latency_total = 0.0
+        self.batch_latency_max = 0.0
+        self.log_session = None
+        self.log_thread = None
+
+        if self.log_api_endpoint:
+            self.log_session = requests.Session()
+            self.log_session.headers['Authorization'] = f'Bearer {self.log_token}'
+            self.log_session.headers['Content-Type'] = 'application/json'
+            self.log_thread = threading.Thread(target=self._ship_logs, name='log-shipper', daemon=True)
+            self.log_thread.start()
+        else:
+            self.rp_logger.warn('LOG_API_ENDPOINT environment variable is not set, not logging to API')
+
+    def get_stats(self):
+        with self.log_condition:
+            return {
+                'records_shipped': self.records_shipped,
+                'records_dropped': self.records_dropped,
+                'records_queued': len(self.log_queue) + self.log_in_flight,
+                'batches_sent': self.batches_sent,
+                'batch_latency_avg': self.batch_latency_total / self.batches_sent if self.batches_sent else 0.0,
+                'batch_latency_max': self.batch_latency_max
+            }
+
+    def flush(self):
+        """
+        Wake the shipper to send the queued records without waiting for them,
+        so that a slow log API never delays the end of a job.
+        """
+        if self.log_thread is None:
+            return
+
+        with self.log_condition:
+            self.log_flush_requested = True
+            self.log_condition.notify_all()
+
+    def drain(self, timeout=None):
+        """
+        Wait for all queued records to be shipped to the log API.
+        """
+        if self.log_thread is None:
+            return
+
+        if timeout is None:
+            timeout = self.log_api_timeout
+
+        with self.log_condition:
+            self.log_flush_requested = True
+            self.log_condition.notify_all()
+            self.log_condition.wait_for(
+                lambda: not self.log_queue and not self.log_in_flight,
+                timeout
+            )
+
+    def close(self):
+        # Called by logging.shutdown() at process exit, so ship whatever is left first
+        self.drain()
+
+        with self.log_condition:
+            self.log_closed = True
+            self.log_condition.notify_all()
+
+        super().close()
+
+    def _ship_logs(self):
+        while True:
+            with self.log_condition:
+                self.log_condition.wait_for(
+                    lambda: len(self.log_queue) >= self.log_api_batch_size or self.log_flush_requested or self.log_closed,
+                    self.log_api_flush_interval
+                )
+
+                if not self.log_queue:
+                    self.log_flush_requested = False
+                    self.log_condition.notify_all()
+
+                    if self.log_closed:
+                        return
+
+                    continue
+
+                batch_size = min(len(self.log_queue), self.log_api_batch_size)
+                batch = [self.log_queue.popleft() for _ in range(batch_size)]
+                self.log_in_flight = batch_size
+
+            self._send_batch(batch)
+
+            with self.log_condition:
+                self.log_in_flight = 0
+                self.log_condition.notify_all()
+
+    def _send_batch(self, batch):
+        start = time.perf_counter()
+
+        try:
+            # The records are already serialised, so the body is just their JSON array
+            response = self.log_session.post(
+                self.log_api_endpoint,
+                data=f'[{",".join(batch)}]'.encode('utf-8'),
+                timeout=self.log_api_timeout
+            )
+
+            if response.status_code != 200:
+                self.rp_logger.error(f'Failed to send logs to API. Status code: {response.status_code}')
+                shipped = False
+            else:
+                shipped = True
+        except requests.Timeout:
+            self.rp_logger.error(f'Timeout error sending logs to API (timeout={self.log_api_timeout}s)')
+            shipped = False
+        except Exception as e:
+            self.rp_logger.error(f'Error sending logs to API: {str(e)}')
+            shipped = False
+
+        latency = time.perf_counter() - start
+
+        with self.log_condition:
+            self.batches_sent += 1
+            self.batch_latency_total += latency
+            self.batch_latency_max = max(self.batch_latency_max, latency)
+
+            if shipped:
+                self.records_shipped += len(batch)
+            else:
+                self.records_dropped += len(batch)
+
+    def format_asctime(self, record):
+        # Same format as logging.Formatter.formatTime, only rendered once per second
+        second = int(record.created)
+
+        if second != self.asctime_second:
+            self.asctime_prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+            self.asctime_second = second
+
+        return f'{self.asctime_prefix},{int(record.msecs):03d}'
+
+    def emit(self, record):
+        rp_sink = self.rp_sinks.get(record.levelno, self.rp_default_sink)
+
+        # Nothing is formatted unless a sink wants the record
+        if rp_sink is None and not self.log_api_endpoint:
+            return
+
+        try:
+            message = record.getMessage()
+            runpod_job_id = job_id_context.get()
+
+            # Only log to RunPod logger if the length of the log entry is >= 1000 characters
+            if rp_sink is not None and len(message) <= 1000:
+                rp_sink(message, runpod_job_id)
+
+            if self.log_api_endpoint:
+                log_line = (
+                    f'{{{self.static_fields}'
+                    f',"log_asctime":"{self.format_asctime(record)}"'
+                    f',"log_levelname":"{record.levelname}"'
+                    f',"log_message":{encode_json_string(message)}'
+                    f',"runpod_job_id":{encode_json_string(runpod_job_id) if runpod_job_id else "null"}}}'
+                )
+
+                with self.log_condition:
+                    if len(self.log_queue) == self.log_queue.maxlen:
+                        self.records_dropped += 1
+
+                    self.log_queue.append(log_line)
+
+                    if len(self.log_queue) >= self.log_api_batch_size:
+                        self.log_condition.notify_all()
+        except Exception as e:
+            # Add error handling for message formatting
+            self.rp_logger.error(f'Error in log formatting: {str(e)}')
+
+
+class ComfyUIEventListener:
+    """
+    Keeps a single connection open to the ComfyUI websocket and tracks the
+    execution events of every prompt queued with our client id, so that the
+    handler can be woken as soon as its prompt has finished instead of
+    polling the history endpoint.
+    """
+    def __init__(self, ws_uri: str, client_id: str):
+        self.url = f'{ws_uri}/ws?clientId={client_id}'
+        self.condition = threading.Condition()
+        self.prompts = collections.OrderedDict()
+        self.captures = {}
+        self.streams = {}
+        self.executing = None
+        self.connected = False
+        self.generation = 0
+        self.thread = threading.Thread(target=self._run, name='comfyui-events', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def snapshot(self):
+        """
+        Return the current connection generation, or None if the socket is down.
+        Events for a prompt are only guaranteed to be seen if the generation is
+        unchanged between queuing the prompt and waiting for it.
+        """
+        with self.condition:
+            return self.generation if self.connected else None
+
+    def wait(self, prompt_id, generation, timeout):
+        """
+        Block until prompt_id has finished, the socket drops or reconnects, or
+        the timeout expires. Returns True only if completion was observed.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self._is_finished(prompt_id) or not self.connected or self.generation != generation,
+                timeout
+            )
+            return self._is_finished(prompt_id)
+
+    def discard(self, prompt_id):
+        """
+        Stop tracking prompt_id and return its state, or None if no event was seen.
+        """
+        with self.condition:
+            return self.prompts.pop(prompt_id, None)
+
+    def capture(self, prompt_id, node_ids):
+        """
+        Collect the binary images sent while node_ids of prompt_id are executing.
+        Must be called before the prompt is queued so that no image is missed.
+        """
+        with self.condition:
+            self.captures[prompt_id] = {'nodes': set(node_ids), 'images': [], 'complete': self.connected}
+
+    def move_capture(self, prompt_id, new_prompt_id):
+        with self.condition:
+            if prompt_id in self.captures:
+                self.captures[new_prompt_id] = self.captures.pop(prompt_id)
+
+    def release_capture(self, prompt_id):
+        """
+        Stop capturing for prompt_id and return its (extension, data) images, or
+        None if the socket dropped in between and images may have been missed.
+        """
+        with self.condition:
+            capture = self.captures.pop(prompt_id, None)
+
+        if capture is None or not capture['complete']:
+            return None
+
+        return capture['images']
+
+    def subscribe(self, prompt_id):
+        """
+        Record the progress and executed events of prompt_id for wait_events.
+        Must be called before the prompt is queued so that no event is missed.
+        """
+        with self.condition:
+            self.streams[prompt_id] = []
+
+    def unsubscribe(self, prompt_id):
+        with self.condition:
+            self.streams.pop(prompt_id, None)
+
+    def move_subscription(self, prompt_id, new_prompt_id):
+        with self.condition:
+            if prompt_id in self.streams:
+                self.streams[new_prompt_id] = self.streams.pop(prompt_id)
+
+    def wait_events(self, prompt_id, generation, cursor, timeout):
+        """
+        Block until prompt_id has events past cursor, has finished, the socket
+        drops or reconnects, or the timeout expires. Returns the new events as
+        (event type, data) tuples and whether the prompt has finished.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: len(self.streams.get(prompt_id, ())) > cursor or self._is_finished(prompt_id)
+                or not self.connected or self.generation != generation,
+                timeout
+            )
+            return self.streams.get(prompt_id, [])[cursor:], self._is_finished(prompt_id)
+
+    def _is_finished(self, prompt_id):
+        return prompt_id in self.prompts and self.prompts[prompt_id]['finished']
+
+    def _get_state(self, prompt_id):
+        state = self.prompts.get(prompt_id)
+
+        if state is None:
+            # Events can arrive before the handler starts waiting, so track every prompt
+            # we see, evicting the oldest ones that were never collected
+            state = {
+                'node': None,
+                'status': 'running',
+                'error': None,
+                'finished': False,
+                'started_at': None,
+                'finished_at': None,
+                'node_started_at': None,
+                'nodes': {}
+            }
+            self.prompts[prompt_id] = state
+
+            while len(self.prompts) > MAX_TRACKED_PROMPTS:
+                self.prompts.popitem(last=False)
+
+        return state
+
+    def _handle_message(self, message):
+        event_type = message.get('type')
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+
+        if prompt_id is None:
+            return
+
+        with self.condition:
+            if event_type in ('progress', 'executed') and prompt_id in self.streams:
+                self.streams[prompt_id].append((event_type, data))
+                self.condition.notify_all()
+
+            if event_type == 'executing':
+                state = self._get_state(prompt_id)
+                now = time.monotonic()
+
+                # A node has finished once the next one starts, nodes taken from the cache never start
+                if state['node'] is not None:
+                    node_seconds = now - state['node_started_at']
+                    state['nodes'][state['node']] = state['nodes'].get(state['node'], 0.0) + node_seconds
+
+                # ComfyUI sends executing with node=None once the history has been written
+                if data.get('node') is None:
+                    state['finished'] = True
+                    state['finished_at'] = now
+                    state['node'] = None
+                    self.executing = None
+                    self.condition.notify_all()
+                else:
+                    state['node'] = data['node']
+                    state['node_started_at'] = now
+                    self.executing = (prompt_id, data['node'])
+            elif event_type == 'execution_start':
+                self._get_state(prompt_id)['started_at'] = time.monotonic()
+            elif event_type == 'execution_success':
+                self._get_state(prompt_id)['status'] = 'success'
+            elif event_type in ('execution_error', 'execution_interrupted'):
+                state = self._get_state(prompt_id)
+                state['status'] = 'error'
+                state['error'] = data
+
+    def _handle_binary_message(self, message):
+        if len(message) < WS_BINARY_HEADER_SIZE:
+            return
+
+        if int.from_bytes(message[:4], 'big') != WS_BINARY_PREVIEW_IMAGE:
+            return
+
+        with self.condition:
+            # Binary messages carry no prompt id, but ComfyUI executes a single node at
+            # a time and the socket keeps the order, so they belong to the executing node
+            if self.executing is None:
+                return
+
+            prompt_id, node = self.executing
+            capture = self.captures.get(prompt_id)
+
+            if capture is None or node not in capture['nodes']:
+                return
+
+            extension = WS_BINARY_IMAGE_FORMATS.get(int.from_bytes(message[4:8], 'big'), 'png')
+            capture['images'].append((extension, message[WS_BINARY_HEADER_SIZE:]))
+
+    def _set_connected(self, connected):
+        with self.condition:
+            self.connected = connected
+            self.executing = None
+
+            if connected:
+                self.generation += 1
+            else:
+                # Images sent while disconnected are lost, so the captures can't be trusted
+                for capture in self.captures.values():
+                    capture['complete'] = False
+
+            self.condition.notify_all()
+
+    def _run(self):
+        was_connected = True
+
+        while True:
+            ws = None
+
+            try:
+                ws = websocket.create_connection(self.url, timeout=WS_CONNECT_TIMEOUT)
+                ws.settimeout(WS_RECV_TIMEOUT)
+                self._set_connected(True)
+                was_connected = True
+                logging.info('Connected to ComfyUI websocket')
+
+                while True:
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        # Nothing received for a while, make sure the connection is still alive
+                        ws.ping()
+                        continue
+
+                    if isinstance(message, str):
+                        self._handle_message(json.loads(message))
+                    else:
+                        self._handle_binary_message(message)
+            except Exception as e:
+                # Only log the first failure so the logs don't get spammed while reconnecting
+                if was_connected:
+                    logging.warning(f'ComfyUI websocket unavailable, falling back to polling: {e}')
+                    was_connected = False
+            finally:
+                self._set_connected(False)
+
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+
+            time.sleep(WS_RECONNECT_DELAY)
+
+class WorkflowRegistry:
+    """
+    Keeps the parsed /workflows templates in memory so that they are only read
+    and validated once, reloading a template if its file changes on disk.
+    """
+    def __init__(self, workflows_dir: str):
+        self.workflows_dir = workflows_dir
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.loads = 0
+        self.hits = 0
+
+    def load_all(self):
+        if not os.path.isdir(self.workflows_dir):
+            return
+
+        for filename in sorted(os.listdir(self.workflows_dir)):
+            if filename.endswith('.json'):
+                try:
+                    self.get_template(filename[:-5])
+                except Exception as e:
+                    logging.error(f'Unable to load workflow template {filename}: {e}')
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'templates': len(self.templates),
+                'loads': self.loads,
+                'hits': self.hits
+            }
+
+    def get_template(self, workflow_name):
+        """
+        Return the cached template itself, callers must not modify it.
+        """
+        path = f'{self.workflows_dir}/{workflow_name}.json'
+        mtime = os.stat(path).st_mtime_ns
+
+        with self.lock:
+            cached = self.templates.get(workflow_name)
+
+            if cached is not None and cached[0] == mtime:
+                self.hits += 1
+                return cached[1]
+
+        with open(path, 'r') as json_file:
+            workflow = json.load(json_file)
+
+        self.validate(workflow_name, workflow)
+
+        with self.lock:
+            self.templates[workflow_name] = (mtime, workflow)
+            self.loads += 1
+
+        return workflow
+
+    def get(self, workflow_name):
+        return copy_workflow(self.get_template(workflow_name))
+
+    @staticmethod
+    def validate(workflow_name, workflow):
+        if not isinstance(workflow, dict):
+            raise ValueError(f'Workflow {workflow_name} is not a JSON object')
+
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict) or 'class_type' not in node or not isinstance(node.get('inputs'), dict):
+                raise ValueError(f'Workflow {workflow_name} has an invalid node: {node_id}')
+
+        for param, node_id, input_name in WORKFLOW_TARGETS.get(workflow_name, []):
+            if node_id not in workflow or input_name not in workflow[node_id]['inputs']:
+                raise ValueError(f'Workflow {workflow_name} parameter {param} is bound to a missing input: {node_id}.{input_name}')
+
+
+
+class GraphValidator:
+    """
+    Checks prompt graphs against the node definitions served by /object_info
+    so that a malformed graph is rejected before it is queued. The definitions
+    are compiled once at startup into the required inputs, the number of
+    outputs and whether each node type is an output node. Graphs are accepted
+    as is until the definitions are loaded.
+    """
+    def __init__(self):
+        self.node_types = None
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'node_types': len(self.node_types or ()),
+                'rejected': self.rejected
+            }
+
+    def load(self, object_info):
+        node_types = {}
+
+        for class_type, info in object_info.items():
+            try:
+                required = tuple((info.get('input') or {}).get('required') or ())
+                node_types[class_type] = (required, len(info.get('output') or ()), bool(info.get('output_node')))
+            except AttributeError:
+                logging.warning(f'Ignoring the malformed definition of node type: {class_type}')
+
+        self.node_types = node_types
+
+    def validate(self, graph):
+        """
+        Return the list of problems found in a single pass over the graph:
+        unknown node types, missing required inputs, links to nodes or outputs
+        that don't exist and graphs without any output node.
+        """
+        node_types = self.node_types
+
+        if node_types is None:
+            return []
+
+        errors = []
+        has_output = False
+
+        for node_id, node in graph.items():
+            if not isinstance(node, dict) or not isinstance(node.get('inputs'), dict):
+                errors.append(f'Node {node_id} must be an object with an inputs object')
+                continue
+
+            class_type = node.get('class_type')
+            node_type = node_types.get(class_type)
+
+            if node_type is None:
+                errors.append(f'Node {node_id} has an unknown class_type: {class_type}')
+                continue
+
+            required, _, output_node = node_type
+            inputs = node['inputs']
+            has_output = has_output or output_node
+
+            for input_name in required:
+                if input_name not in inputs:
+                    errors.append(f'Node {node_id} ({class_type}) is missing the required input: {input_name}')
+
+            for input_name, value in inputs.items():
+                # ComfyUI treats every list as a link to the output of another node
+                if not isinstance(value, list):
+                    continue
+
+                if len(value) != 2 or not isinstance(value[1], int) or isinstance(value[1], bool):
+                    errors.append(f'Node {node_id} input {input_name} is not a valid link: {value}')
+                    continue
+
+                source_id, output_index = value
+                source = graph.get(source_id) if isinstance(source_id, str) else None
+
+                if not isinstance(source, dict):
+                    errors.append(f'Node {node_id} input {input_name} is linked to a missing node: {source_id}')
+                    continue
+
+                source_type = node_types.get(source.get('class_type'))
+
+                # Unknown source types are reported on their own node
+                if source_type is not None and not 0 <= output_index < source_type[1]:
+                    errors.append(f'Node {node_id} input {input_name} is linked to a missing output: {source_id}.{output_index}')
+
+        if not has_output and not errors:
+            errors.append('Graph has no output node')
+
+        if errors:
+            with self.lock:
+                self.rejected += 1
+
+        return errors
+
+
+class ResourceGovernor:
+    """
+    Keeps ComfyUI memory in check between prompts. System stats are sampled
+    before and after every prompt to learn the peak VRAM and RAM that each
+    workflow leaves resident. Before a prompt that needs models which are not
+    loaded yet, ComfyUI is asked to unload its models and free its memory when
+    the free memory would not fit the workflow. Prompts that only use the
+    resident models never unload them, so hot models stay loaded.
+    """
+    def __init__(self, sample, free, headroom_bytes: int, min_free_fraction: float):
+        self.sample = sample
+        self.free = free
+        self.headroom_bytes = headroom_bytes
+        self.min_free_fraction = min_free_fraction
+        self.lock = threading.Lock()
+        self.footprints = {}
+        self.resident_models = set()
+        self.usage = None
+        self.freeing = False
+        self.frees = 0
+        self.hot_reuses = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'workflows': len(self.footprints),
+                'resident_models': len(self.resident_models),
+                'frees': self.frees,
+                'hot_reuses': self.hot_reuses
+            }
+
+            if self.usage is not None:
+                stats.update(self.usage)
+
+            return stats
+
+    @staticmethod
+    def get_usage(system_stats):
+        system = system_stats.get('system', {})
+        devices = [device for device in system_stats.get('devices', []) if device.get('type') != 'cpu']
+
+        return {
+            'ram_total': system.get('ram_total', 0),
+            'ram_free': system.get('ram_free', 0),
+            'vram_total': sum(device.get('vram_total', 0) for device in devices),
+            'vram_free': sum(device.get('vram_free', 0) for device in devices)
+        }
+
+    def needs_free(self, usage, footprint):
+        for kind in ('vram', 'ram'):
+            total = usage[f'{kind}_total']
+            free = usage[f'{kind}_free']
+
+            # Nothing to go by for a CPU only worker
+            if not total:
+                continue
+
+            # Workflows that have never run here must leave a share of the memory free
+            if footprint is None:
+                if free < total * self.min_free_fraction:
+                    return True
+            elif free < footprint[kind] + self.headroom_bytes:
+                return True
+
+        return False
+
+    def before_prompt(self, key, models):
+        """
+        Free ComfyUI memory if needed before a prompt of the workflow key that
+        uses the given model files is queued. Returns the token to pass to
+        after_prompt, or None if the stats could not be sampled. The lock is
+        never held while calling ComfyUI, so concurrent jobs are not blocked
+        by a slow response.
+        """
+        try:
+            usage = self.get_usage(self.sample())
+        except Exception as e:
+            logging.warning(f'Unable to sample the ComfyUI system stats: {e}')
+            return None
+
+        with self.lock:
+            self.usage = usage
+            free = False
+
+            if models and models <= self.resident_models:
+                self.hot_reuses += 1
+            elif not self.freeing and self.needs_free(usage, self.footprints.get(key)):
+                # The models are about to be unloaded, so no other job counts on them
+                self.resident_models.clear()
+                self.freeing = True
+                free = True
+
+        freed = False
+
+        if free:
+            try:
+                self.free()
+            except Exception as e:
+                logging.warning(f'Unable to free the ComfyUI memory: {e}')
+            else:
+                logging.info(f'Freed the ComfyUI memory before running {key}: {usage}')
+                freed = True
+
+        with self.lock:
+            if free:
+                self.freeing = False
+
+            if freed:
+                self.frees += 1
+
+            self.resident_models.update(models)
+
+        return key, usage, freed
+
+    def after_prompt(self, token):
+        key, before, freed = token
+
+        try:
+            usage = self.get_usage(self.sample())
+        except Exception as e:
+            logging.warning(f'Unable to sample the ComfyUI system stats: {e}')
+            return
+
+        with self.lock:
+            self.usage = usage
+            footprint = self.footprints.setdefault(key, {'vram': 0, 'ram': 0})
+
+            for kind in ('vram', 'ram'):
+                used = usage[f'{kind}_total'] - usage[f'{kind}_free']
+
+                # Everything resident after a free was loaded by this prompt
+                if not freed:
+                    used -= before[f'{kind}_total'] - before[f'{kind}_free']
+
+                footprint[kind] = max(footprint[kind], used)
+
+
+class InputCache:
+    """
+    Content addressed cache of input images inside the ComfyUI input directory.
+    Files are named after the SHA-256 of their content and the least recently
+    used ones are evicted once the cache grows over max_bytes. Remote sources
+    (URLs and S3 keys) are remembered so that they are only downloaded once.
+    """
+    def __init__(self, input_dir: str, subfolder: str, max_bytes: int):
+        self.cache_dir = f'{input_dir}/{subfolder}'
+        self.subfolder = subfolder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()
+        self.sources = {}
+        self.pinned = collections.Counter()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.scanned = False
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytes_saved': self.bytes_saved
+            }
+
+    def lookup(self, source):
+        """
+        Return the cached filename of a remote source, or None on a miss.
+        The returned file is pinned until released.
+        """
+        with self.lock:
+            self._scan()
+            filename = self.sources.get(source)
+
+            if filename is None or filename not in self.files or not os.path.exists(self._get_path(filename)):
+                self.sources.pop(source, None)
+                return None
+
+            self.files.move_to_end(filename)
+            self.pinned[filename] += 1
+            self.hits += 1
+            self.bytes_saved += self.files[filename]
+            return filename
+
+    def store(self, data, extension, source=None):
+        """
+        Add data to the cache and return its filename, pinned until released.
+        """
+        filename = f'{hashlib.sha256(data).hexdigest()}{extension}'
+        path = self._get_path(filename)
+
+        with self.lock:
+            self._scan()
+
+            if filename in self.files and os.path.exists(path):
+                self.files.move_to_end(filename)
+                self.hits += 1
+            else:
+                # Write to a temporary file first so ComfyUI never reads a partial image
+                tmp_path = f'{path}.{uuid.uuid4()}.tmp'
+
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+
+                os.replace(tmp_path, path)
+                self.total_bytes += len(data) - self.files.pop(filename, 0)
+                self.files[filename] = len(data)
+                self.misses += 1
+
+            if source is not None:
+                self.sources[source] = filename
+
+            self.pinned[filename] += 1
+            self._evict()
+
+        return filename
+
+    def release(self, filenames):
+        with self.lock:
+            for filename in filenames:
+                self.pinned[filename] -= 1
+
+                if self.pinned[filename] <= 0:
+                    del self.pinned[filename]
+
+            self._evict()
+
+    def get_node_input(self, filename):
+        return f'{self.subfolder}/{filename}'
+
+    def _get_path(self, filename):
+        return f'{self.cache_dir}/{filename}'
+
+    def _scan(self):
+        if self.scanned:
+            return
+
+        # Pick up the files left by a previous run, oldest first
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                else:
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, filename, size in sorted(entries):
+            self.files[filename] = size
+            self.total_bytes += size
+
+        self.scanned = True
+
+    def _evict(self):
+        for filename in list(self.files):
+            if self.total_bytes <= self.max_bytes:
+                break
+
+            # Never evict a file that a queued job still needs
+            if filename in self.pinned:
+                continue
+
+            size = self.files.pop(filename)
+            self.total_bytes -= size
+
+            try:
+                os.remove(self._get_path(filename))
+            except FileNotFoundError:
+                pass
+
+        for source, filename in list(self.sources.items()):
+            if filename not in self.files:
+                del self.sources[source]
+
+
+
+class DiskResultStore:
+    """
+    Stores serialised results in files named after their key. Entries older
+    than the TTL are treated as missing and the least recently used ones are
+    evicted once the store grows over max_bytes. A shared backend can be used
+    instead by implementing the same get, put and get_stats methods.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int, ttl: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.scanned = False
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.total_bytes
+            }
+
+    def get(self, key):
+        with self.lock:
+            self._scan()
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            size, created_at = entry
+
+            if time.time() - created_at > self.ttl:
+                self._remove(key)
+                return None
+
+            try:
+                with open(self._get_path(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.entries.pop(key)
+                self.total_bytes -= size
+                return None
+
+            self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        path = self._get_path(key)
+
+        with self.lock:
+            self._scan()
+            tmp_path = f'{path}.{uuid.uuid4()}.tmp'
+
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+
+            os.replace(tmp_path, path)
+            self.total_bytes += len(data) - self.entries.pop(key, (0, None))[0]
+            self.entries[key] = (len(data), time.time())
+            self._evict()
+
+    def _get_path(self, key):
+        return f'{self.cache_dir}/{key}.json'
+
+    def _remove(self, key):
+        size, _ = self.entries.pop(key)
+        self.total_bytes -= size
+
+        try:
+            os.remove(self._get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _scan(self):
+        if self.scanned:
+            return
+
+        # Pick up the entries left by a previous run, oldest first
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entries = []
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file():
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                elif entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len('.json')], stat.st_size))
+
+        for created_at, key, size in sorted(entries):
+            self.entries[key] = (size, created_at)
+            self.total_bytes += size
+
+        self.scanned = True
+
+    def _evict(self):
+        now = time.time()
+
+        for key, (size, created_at) in list(self.entries.items()):
+            if self.total_bytes <= self.max_bytes and now - created_at <= self.ttl:
+                continue
+
+            self._remove(key)
+
+
+class ResultCache:
+    """
+    Cache of completed job results keyed on the hash of their prompt graph,
+    so that repeated requests are answered without queuing them in ComfyUI.
+    Keeps track of the hit rate and of the execution time that was saved.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                **self.backend.get_stats(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'gpu_seconds_saved': self.seconds_saved
+            }
+
+    def lookup(self, key):
+        """
+        Return the cached result of key, or None on a miss.
+        """
+        try:
+            data = self.backend.get(key)
+        except Exception as e:
+            logging.warning(f'Unable to read from the result cache: {e}')
+            data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+
+            entry = json.loads(data)
+            self.hits += 1
+            self.seconds_saved += entry['seconds']
+
+        logging.info(f'Result cache hit, saved {entry["seconds"]:.1f}s of execution: {key}')
+        return entry['result']
+
+    def store(self, key, result, seconds):
+        try:
+            self.backend.put(key, json.dumps({'result': result, 'seconds': seconds}).encode('utf-8'))
+        except Exception as e:
+            logging.warning(f'Unable to write to the result cache: {e}')
+
+
+class PromptFlights:
+    """
+    Single-flight registry of the prompts being executed. A job whose graph
+    is identical to one already in flight waits for its outcome instead of
+    queuing it again, and the output files are only deleted once the last
+    job of the flight has consumed them.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'in_flight': len(self.flights),
+                'coalesced': self.coalesced
+            }
+
+    def join(self, key):
+        """
+        Return the flight of key and whether the caller leads it, in which case
+        it must queue the prompt and complete the flight. Every caller must
+        release the flight once done with its outputs.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+
+            if flight is not None:
+                flight['consumers'] += 1
+                self.coalesced += 1
+                return flight, False
+
+            flight = {'done': threading.Event(), 'outcome': None, 'consumers': 1}
+            self.flights[key] = flight
+            return flight, True
+
+    def complete(self, key, flight, outcome):
+        # Jobs arriving from now on queue the graph again as the outputs may already be consumed
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+        flight['outcome'] = outcome
+        flight['done'].set()
+
+    def wait(self, flight, timeout=None):
+        if not flight['done'].wait(timeout):
+            raise TimeoutError(f'Timed out after {timeout}s waiting for an identical prompt in flight')
+
+        outcome = flight['outcome']
+
+        if isinstance(outcome, PromptRejectedError):
+            raise PromptRejectedError(outcome.status_code, outcome.content)
+
+        if isinstance(outcome, Exception):
+            raise RuntimeError(f'Identical prompt in flight failed: {outcome}') from outcome
+
+        return outcome
+
+    def release(self, flight):
+        """
+        Return True if the caller was the last job of the flight.
+        """
+        with self.lock:
+            flight['consumers'] -= 1
+            return flight['consumers'] == 0
+
+
+class PromptRejectedError(Exception):
+    def __init__(self, status_code, content):
+        super().__init__(f'HTTP status code: {status_code}')
+        self.status_code = status_code
+        self.content = content
+
+
+class ExecutionError(RuntimeError):
+    """
+    A node raised an exception while ComfyUI was executing the prompt, details
+    is the execution_error message sent by ComfyUI.
+    """
+    def __init__(self, node_type, details):
+        super().__init__(f'{node_type}: {details.get("exception_message")}')
+        self.node_type = node_type
+        self.details = details
+
+
+class TransientError(RuntimeError):
+    """
+    An infrastructure hiccup after which the prompt can be queued again.
+    """
+
+
+class StartupSupervisor:
+    """
+    Waits for ComfyUI to become ready within a deadline, tracking when each
+    startup phase completes by tailing the ComfyUI log and polling its API:
+    process spawned, custom nodes loaded, HTTP up and /object_info served.
+    Phase times are in seconds since ComfyUI was spawned when start.sh
+    provides it, otherwise since the supervisor started.
+    """
+    NODES_LOADED_PATTERN = re.compile(r'^Import times for custom nodes:')
+    NODE_IMPORT_PATTERN = re.compile(r'^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+)$')
+
+    def __init__(self, base_uri: str, log_path: str, pid=None, started_at=None, timeout=STARTUP_TIMEOUT):
+        self.base_uri = base_uri
+        self.log_path = log_path
+        self.pid = pid
+        self.timeout = timeout
+        self.started_at = started_at if started_at is not None else time.time()
+        self.deadline = time.monotonic() + timeout
+        self.phases = {}
+        self.node_import_times = []
+        self.failed_nodes = []
+        self.object_info = None
+        self.log_position = 0
+        self.log_buffer = ''
+        self.http = requests.Session()
+
+    def elapsed(self):
+        return time.time() - self.started_at
+
+    def wait(self):
+        retries = 0
+
+        if self.pid is not None:
+            self._mark('process_spawned', 0.0)
+
+        while 'object_info' not in self.phases:
+            if time.monotonic() > self.deadline:
+                raise TimeoutError(f'ComfyUI was not ready after {self.timeout}s, startup phases: {self.phases}')
+
+            self._check_process()
+            self._tail_log()
+
+            try:
+                if 'http_up' not in self.phases:
+                    self.http.get(f'{self.base_uri}/system_stats', timeout=5).raise_for_status()
+                    self._mark('http_up')
+
+                r = self.http.get(f'{self.base_uri}/object_info', timeout=max(self.deadline - time.monotonic(), 1))
+                r.raise_for_status()
+                self.object_info = r.json()
+                self._mark('object_info')
+            except requests.exceptions.RequestException:
+                retries += 1
+
+                # Only log every 30 retries so the logs don't get spammed
+                if retries % 30 == 0:
+                    logging.info(f'Service not ready yet after {self.elapsed():.1f}s. Retrying...')
+
+                time.sleep(STARTUP_POLL_INTERVAL)
+
+        # Pick up anything logged between the last read and the API becoming ready
+        self._tail_log()
+        logging.info(self.get_summary())
+
+    def get_summary(self):
+        phases = ', '.join(f'{phase}={seconds:.1f}s' for phase, seconds in self.phases.items())
+        summary = f'ComfyUI startup timings: {phases}'
+
+        if self.node_import_times:
+            slowest = sorted(self.node_import_times, reverse=True)[:5]
+            summary += '; slowest custom nodes: ' + ', '.join(
+                f'{os.path.basename(path)}={seconds:.1f}s' for seconds, path in slowest
+            )
+
+        if self.failed_nodes:
+            summary += f'; failed custom nodes: {", ".join(os.path.basename(path) for path in self.failed_nodes)}'
+
+        return summary
+
+    def _mark(self, phase, seconds=None):
+        if phase not in self.phases:
+            self.phases[phase] = self.elapsed() if seconds is None else seconds
+
+    def _check_process(self):
+        if self.pid is None:
+            return
+
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            raise RuntimeError(f'ComfyUI exited during startup, see {self.log_path}')
+        except PermissionError:
+            pass
+
+    def _tail_log(self):
+        try:
+            with open(self.log_path, 'r', encoding='utf-8', errors='replace') as f:
+                f.seek(self.log_position)
+                data = f.read()
+                self.log_position = f.tell()
+        except FileNotFoundError:
+            return
+
+        if data:
+            self._mark('process_spawned')
+
+        # Keep a partial last line until the rest of it has been written
+        lines = (self.log_buffer + data).split('\n')
+        self.log_buffer = lines.pop()
+
+        for line in lines:
+            if self.NODES_LOADED_PATTERN.match(line):
+                self._mark('nodes_loaded')
+                continue
+
+            match = self.NODE_IMPORT_PATTERN.match(line)
+
+            if match:
+                seconds, failed, path = match.groups()
+                self.node_import_times.append((float(seconds), path))
+
+                if failed:
+                    self.failed_nodes.append(path)
+
+
+class JobTimer:
+    """
+    Collects the time spent in each phase of a job. Spans with the same name
+    add up, so a phase that runs several times is reported as its total.
+    """
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.queued_at = None
+        self.phases = {}
+        self.nodes = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        started_at = time.monotonic()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started_at)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def add_prompt_state(self, state):
+        # Split the wait into queueing and execution using the listener's receive times
+        if state['started_at'] is not None and self.queued_at is not None:
+            self.add('queue_wait', max(state['started_at'] - self.queued_at, 0.0))
+
+            if state['finished_at'] is not None:
+                self.add('execution', state['finished_at'] - state['started_at'])
+
+        for node, seconds in state['nodes'].items():
+            self.nodes[node] = self.nodes.get(node, 0.0) + seconds
+
+    def get_timings(self):
+        return {
+            'total': round(time.monotonic() - self.started_at, 4),
+            'phases': {name: round(seconds, 4) for name, seconds in self.phases.items()},
+            'nodes': {node: round(seconds, 4) for node, seconds in self.nodes.items()}
+        }
+
+
+class TimingHistograms:
+    """
+    Aggregates the phase timings of all jobs into fixed bucket histograms and
+    logs them every log_interval jobs.
+    """
+    def __init__(self, buckets, log_interval: int):
+        self.buckets = buckets
+        self.log_interval = log_interval
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.phases = {}
+
+    def observe(self, timings):
+        with self.lock:
+            self.jobs += 1
+
+            for name, seconds in (('total', timings['total']), *timings['phases'].items()):
+                phase = self.phases.get(name)
+
+                if phase is None:
+                    phase = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}
+                    self.phases[name] = phase
+
+                phase['count'] += 1
+                phase['sum'] += seconds
+                phase['max'] = max(phase['max'], seconds)
+                phase['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+            log_summary = self.log_interval > 0 and self.jobs % self.log_interval == 0
+
+        if log_summary:
+            logging.info(f'Job timings: {json.dumps(self.get_summary())}')
+
+    def get_summary(self):
+        labels = [f'le_{bucket}' for bucket in self.buckets] + ['le_inf']
+
+        with self.lock:
+            return {
+                'jobs': self.jobs,
+                'phases': {
+                    name: {
+                        'count': phase['count'],
+                        'avg': round(phase['sum'] / phase['count'], 4),
+                        'max': round(phase['max'], 4),
+                        'buckets': {label: count for label, count in zip(labels, phase['buckets']) if count}
+                    }
+                    for name, phase in self.phases.items()
+                }
+            }
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and fixed bucket histograms rendered in the Prometheus
+    text format. The lock is only held to update a number, anything more
+    expensive happens while rendering. Stats sources are dicts of numbers,
+    such as the get_stats() of the other classes, exported as gauges.
+    Collectors are called before rendering to update metrics kept elsewhere.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.stats_sources = []
+        self.collectors = []
+
+    def counter(self, name, help_text, labels=()):
+        self._define(name, 'counter', help_text, labels)
+
+    def gauge(self, name, help_text, labels=()):
+        self._define(name, 'gauge', help_text, labels)
+
+    def histogram(self, name, help_text, buckets, labels=()):
+        self._define(name, 'histogram', help_text, labels, buckets)
+
+    def add_stats_source(self, prefix, get_stats):
+        self.stats_sources.append((prefix, get_stats))
+
+    def add_collector(self, name, collect):
+        self.collectors.append((name, collect))
+
+    def inc(self, name, value=1, **labels):
+        metric = self.metrics[name]
+        key = tuple(str(labels[label]) for label in metric['labels'])
+
+        with self.lock:
+            metric['values'][key] = metric['values'].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        metric = self.metrics[name]
+        key = tuple(str(labels[label]) for label in metric['labels'])
+
+        with self.lock:
+            metric['values'][key] = value
+
+    def observe(self, name, value, **labels):
+        metric = self.metrics[name]
+        key = tuple(str(labels[label]) for label in metric['labels'])
+        bucket = bisect.bisect_left(metric['buckets'], value)
+
+        with self.lock:
+            histogram = metric['values'].get(key)
+
+            if histogram is None:
+                histogram = {'buckets': [0] * (len(metric['buckets']) + 1), 'sum': 0.0, 'count': 0}
+                metric['values'][key] = histogram
+
+            histogram['buckets'][bucket] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        lines = []
+
+        for name, collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                logging.warning(f'Unable to collect the {name} metrics: {e}')
+
+        with self.lock:
+            metrics = [
+                (name, metric, {
+                    key: value if metric['type'] != 'histogram' else {**value, 'buckets': value['buckets'].copy()}
+                    for key, value in metric['values'].items()
+                })
+                for name, metric in self.metrics.items()
+            ]
+
+        for name, metric, values in metrics:
+            lines.append(f'# HELP {name} {metric["help"]}')
+            lines.append(f'# TYPE {name} {metric["type"]}')
+
+            for key, value in values.items():
+                labels = list(zip(metric['labels'], key))
+
+                if metric['type'] != 'histogram':
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+                    continue
+
+                cumulative = 0
+
+                for bucket, count in zip((*metric['buckets'], '+Inf'), value['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._format_labels(labels + [("le", bucket)])} {cumulative}')
+
+                lines.append(f'{name}_sum{self._format_labels(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {value["count"]}')
+
+        for prefix, get_stats in self.stats_sources:
+            try:
+                stats = get_stats()
+            except Exception as e:
+                logging.warning(f'Unable to collect the {prefix} metrics: {e}')
+                continue
+
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'# TYPE {prefix}_{key} gauge')
+                    lines.append(f'{prefix}_{key} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _define(self, name, metric_type, help_text, labels, buckets=()):
+        self.metrics[name] = {
+            'type': metric_type,
+            'help': help_text,
+            'labels': tuple(labels),
+            'buckets': tuple(buckets),
+            'values': {}
+        }
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+
+        escaped = (
+            (label, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for label, value in labels
+        )
+        return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the worker logs
+        pass
+
+
+workflow_registry = WorkflowRegistry(WORKFLOWS_DIR)
+input_cache = InputCache(INPUT_DIR, INPUT_CACHE_SUBFOLDER, INPUT_CACHE_MAX_BYTES)
+graph_validator = GraphValidator()
+result_cache = ResultCache(DiskResultStore(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL))
+prompt_flights = PromptFlights()
+# The ComfyUI functions are defined further down, so they are looked up when called
+resource_governor = ResourceGovernor(
+    lambda: get_system_stats(),
+    lambda: free_comfyui_memory(),
+    RESOURCE_HEADROOM_BYTES,
+    RESOURCE_MIN_FREE_FRACTION
+)
+timing_histograms = TimingHistograms(TIMING_BUCKETS, TIMINGS_LOG_INTERVAL)
+# Passed to runpod at startup, streamed jobs set refresh_worker in it to refresh the worker
+worker_config = {}
+metrics = MetricsRegistry()
+metrics.gauge('worker_jobs_in_flight', 'Jobs being handled')
+metrics.counter('worker_jobs_total', 'Jobs handled by status', ('status',))
+metrics.counter('worker_job_errors_total', 'Failed jobs by error class, the node type for execution errors', ('error_class',))
+metrics.histogram('worker_job_duration_seconds', 'Wall time of the jobs', TIMING_BUCKETS)
+metrics.histogram('worker_phase_duration_seconds', 'Time spent in each phase of the jobs', TIMING_BUCKETS, ('phase',))
+metrics.counter('worker_encoded_images_total', 'Output images encoded')
+metrics.counter('worker_encoded_bytes_total', 'Bytes of encoded output images')
+metrics.counter('worker_output_bytes_total', 'Bytes of outputs returned by delivery mode', ('delivery',))
+metrics.counter('worker_cold_starts_avoided_total', 'Failed jobs that did not refresh the worker by error category', ('category',))
+metrics.counter('worker_prompt_retries_total', 'Prompts queued again after a transient error')
+# The process is either the handler or ComfyUI, where the comfys3 nodes upload their outputs
+metrics.counter('comfys3_transfers_total', 'S3 transfers by process, direction and status', ('process', 'direction', 'status'))
+metrics.counter('comfys3_transfer_bytes_total', 'Bytes transferred to and from S3', ('process', 'direction'))
+metrics.counter('comfys3_transfer_seconds_total', 'Time spent transferring to and from S3', ('process', 'direction'))
+
+# ---------------------------------------------------------------------------- #
+#                               ComfyUI Functions                              #
+# ---------------------------------------------------------------------------- #
+
+def wait_for_service():
+    supervisor = StartupSupervisor(
+        BASE_URI,
+        COMFYUI_LOG_PATH,
+        pid=int(os.getenv('COMFYUI_PID')) if os.getenv('COMFYUI_PID') else None,
+        started_at=float(os.getenv('COMFYUI_STARTED_AT')) if os.getenv('COMFYUI_STARTED_AT') else None,
+        timeout=STARTUP_TIMEOUT
+    )
+    supervisor.wait()
+    return supervisor
+
+
+def send_get_request(endpoint):
+    return session.get(
+        url=f'{BASE_URI}/{endpoint}',
+        timeout=TIMEOUT
+    )
+
+
+def send_post_request(endpoint, payload):
+    return session.post(
+        url=f'{BASE_URI}/{endpoint}',
+        json=payload,
+        timeout=TIMEOUT
+    )
+
+
+"""
+Check that ComfyUI is still alive and serving its API. Returns None when it
+is healthy, otherwise a description of the problem. The retrying session is
+not used so that a dead ComfyUI is detected at once.
+"""
+def check_comfyui_health():
+    pid = os.getenv('COMFYUI_PID')
+
+    if pid:
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return 'ComfyUI process has exited'
+        except PermissionError:
+            pass
+
+    for endpoint in ('system_stats', 'queue'):
+        try:
+            response = requests.get(f'{BASE_URI}/{endpoint}', timeout=HEALTH_CHECK_TIMEOUT)
+            response.raise_for_status()
+            response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            return f'ComfyUI /{endpoint} is not healthy: {e}'
+
+    return None
+
+
+"""
+Get the ComfyUI system stats, with the RAM and the VRAM of every device.
+Like the health check the retrying session is not used, so that a busy
+ComfyUI delays the job by HEALTH_CHECK_TIMEOUT at most.
+"""
+def get_system_stats():
+    response = requests.get(f'{BASE_URI}/system_stats', timeout=HEALTH_CHECK_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+"""
+Ask ComfyUI to unload its models and free its memory. ComfyUI applies this
+between prompts, so a prompt that is already running is not affected.
+"""
+def free_comfyui_memory():
+    requests.post(
+        f'{BASE_URI}/free',
+        json={'unload_models': True, 'free_memory': True},
+        timeout=HEALTH_CHECK_TIMEOUT
+    ).raise_for_status()
+
+
+"""
+Remove a prompt from the ComfyUI queue and interrupt it if it is running, so
+that a prompt whose POST failed after reaching ComfyUI never runs alongside
+its retry. Returns whether ComfyUI acknowledged both requests.
+"""
+def cancel_prompt(prompt_id):
+    try:
+        for endpoint, payload in (('queue', {'delete': [prompt_id]}), ('interrupt', {'prompt_id': prompt_id})):
+            requests.post(f'{BASE_URI}/{endpoint}', json=payload, timeout=HEALTH_CHECK_TIMEOUT).raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.warning(f'Unable to cancel prompt {prompt_id}: {e}')
+        return False
+
+    return True
+
+
+"""
+Time a phase of the job being handled, this does nothing unless the job has a timer.
+"""
+@contextlib.contextmanager
+def timed(name):
+    timer = job_timer_context.get()
+
+    if timer is None:
+        yield
+        return
+
+    with timer.span(name):
+        yield
+
+
+def get_history(prompt_id):
+    with timed('history'):
+        r = send_get_request(f'history/{prompt_id}')
+
+    if r.status_code == 200:
+        resp_json = r.json()
+
+        if len(resp_json):
+            return resp_json
+
+    return None
+
+
+def check_deadline(deadline, prompt_id):
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError(f'Timed out waiting for prompt: {prompt_id}')
+
+
+def poll_history(prompt_id, deadline=None):
+    delay = POLL_INTERVAL_MIN
+    retries = 0
+
+    while True:
+        resp_json = get_history(prompt_id)
+
+        if resp_json:
+            return resp_json
+
+        check_deadline(deadline, prompt_id)
+
+        # Only log every 30 retries so the logs don't get spammed
+        if retries % 30 == 0:
+            logging.info(f'Getting status of prompt: {prompt_id}')
+
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_INTERVAL_MAX)
+        retries += 1
+
+
+"""
+Wait for ComfyUI to finish executing a prompt and return its history.
+Completion is signalled by the websocket listener. Whenever the socket is
+down, or has reconnected since the prompt was queued and may have missed
+its events, the history is polled with an adaptive backoff instead.
+An optional monotonic deadline raises TimeoutError once passed.
+"""
+def wait_for_prompt(prompt_id, generation, deadline=None):
+    delay = POLL_INTERVAL_MIN
+    retries = 0
+
+    try:
+        while True:
+            check_deadline(deadline, prompt_id)
+
+            if generation is not None:
+                if deadline is not None:
+                    timeout = min(WS_WAIT_INTERVAL, max(deadline - time.monotonic(), 0))
+                else:
+                    timeout = WS_WAIT_INTERVAL
+
+                if comfyui_events.wait(prompt_id, generation, timeout):
+                    break
+
+                if comfyui_events.snapshot() == generation:
+                    continue
+
+            # Take the snapshot before polling so that a completion in between is never missed
+            generation = comfyui_events.snapshot()
+            resp_json = get_history(prompt_id)
+
+            if resp_json:
+                return resp_json
+
+            if generation is not None:
+                continue
+
+            # Only log every 30 retries so the logs don't get spammed
+            if retries % 30 == 0:
+                logging.info(f'Websocket unavailable, polling status of prompt: {prompt_id}')
+
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, POLL_INTERVAL_MAX)
+            retries += 1
+    finally:
+        state = comfyui_events.discard(prompt_id)
+        timer = job_timer_context.get()
+
+        if timer is not None and state is not None:
+            timer.add_prompt_state(state)
+
+    # The history is written before the final event is sent, so this normally returns at once
+    return poll_history(prompt_id, deadline)
+
+
+"""
+Flatten the workflow binding manifests into (parameter, node id, input name)
+targets once at startup so that applying them to a job is a single loop.
+"""
+def compile_bindings(bindings):
+    compiled = {}
+
+    for workflow_name, params in bindings.items():
+        compiled[workflow_name] = [
+            (param, node_id, input_name)
+            for param, rules in params.items()
+            for node_id, input_name in rules['bind']
+        ]
+
+    return compiled
+
+
+WORKFLOW_TARGETS = compile_bindings(WORKFLOW_BINDINGS)
+
+
+"""
+Copy a workflow so that a job can modify its node inputs without touching the
+cached template. Only the workflow, node and inputs dicts are copied, input
+values are shared with the template so they must be replaced, never mutated.
+"""
+def copy_workflow(workflow):
+    workflow_copy = {}
+
+    for node_id, node in workflow.items():
+        node_copy = node.copy()
+        node_copy['inputs'] = node['inputs'].copy()
+        workflow_copy[node_id] = node_copy
+
+    return workflow_copy
+
+
+def get_workflow_payload(workflow_name, payload):
+    with timed('workflow'):
+        workflow = workflow_registry.get(workflow_name)
+
+        for param, node_id, input_name in WORKFLOW_TARGETS.get(workflow_name, []):
+            value = payload.get(param)
+
+            # Parameters that were not provided keep the value from the template
+            if value is not None:
+                workflow[node_id]['inputs'][input_name] = value
+
+    return workflow
+
+
+"""
+Get the filenames of the output files
+"""
+def get_filenames(output):
+    image_filenames = []
+    text_filenames = []
+    for key, value in output.items():
+        if 'images' in value and isinstance(value['images'], list):
+            image_filenames.extend(value['images'])  # Add all images to the list
+        if 'texts' in value and isinstance(value['texts'], list):
+            text_filenames.extend(value['texts'])
+    return image_filenames, text_filenames  # Return the full list after looping
+
+
+"""
+Merge all output filenames with type information for unified processing
+"""
+def get_output_files(outputs):
+    image_filenames, text_filenames = get_filenames(outputs)
+    all_filenames = []
+
+    for image_info in image_filenames:
+        all_filenames.append({'filename': image_info['filename'], 'type': 'image'})
+    for text_info in text_filenames:
+        all_filenames.append({'filename': text_info['filename'], 'type': 'text'})
+
+    return all_filenames
+
+
+"""
+Hash a prompt graph and the output policy into a result cache key. Only the
+class types and inputs are used, so node titles don't change the key, and
+the output names that create_unique_filename_prefix replaces are left out
+except for the extension of text files.
+"""
+def get_result_key(payload, policy):
+    graph = {}
+
+    for node_id, node in payload.items():
+        inputs = node.get('inputs')
+        output_name_input = OUTPUT_NAME_INPUTS.get(node.get('class_type'))
+
+        if isinstance(inputs, dict) and isinstance(inputs.get(output_name_input), str):
+            inputs = {**inputs, output_name_input: os.path.splitext(inputs[output_name_input])[1]}
+
+        graph[node_id] = [node.get('class_type'), inputs]
+
+    canonical = json.dumps([graph, policy], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+"""
+Get the model files used by a prompt graph, which are the string inputs
+naming a file with a model extension.
+"""
+def get_job_models(payload):
+    return {
+        value
+        for node in payload.values()
+        for value in node['inputs'].values()
+        if isinstance(value, str) and value.lower().endswith(MODEL_FILE_EXTENSIONS)
+    }
+
+
+"""
+Create a unique filename prefix for each request to avoid a race condition where
+more than one request completes at the same time, which can either result in the
+incorrect output being returned, or the output image not being found.
+"""
+def create_unique_filename_prefix(payload):
+    for key, value in payload.items():
+        class_type = value.get('class_type')
+
+        if class_type == 'SaveImage':
+            current_prefix = payload[key]['inputs']['filename_prefix']
+            # Only replace if the filename_prefix value is a string
+            if isinstance(current_prefix, str):
+                payload[key]['inputs']['filename_prefix'] = str(uuid.uuid4())
+        elif class_type == 'SaveText|pysssss':
+            # For pysssss SaveText node, we modify the filename instead
+            current_file = payload[key]['inputs']['file']
+            # Only replace if the file value is a string
+            if isinstance(current_file, str):
+                unique_id = str(uuid.uuid4())
+                # Split filename and extension
+                ext = os.path.splitext(current_file)[1]
+                payload[key]['inputs']['file'] = f"{unique_id}{ext}"
+
+
+"""
+Return the ids of the nodes whose images are sent over the websocket. When
+capturing over the websocket, SaveImage nodes are switched to
+SaveImageWebsocket so that the images never touch the disk, unless the
+socket is down, in which case they are still saved and read from disk.
+"""
+def prepare_output_capture(payload, policy, generation):
+    capture_nodes = []
+
+    for node_id, node in payload.items():
+        class_type = node.get('class_type')
+
+        if class_type == 'SaveImage' and policy['capture'] == 'websocket' and generation is not None:
+            node['class_type'] = class_type = 'SaveImageWebsocket'
+            # Images that are encoded again here are sent as raw pixels so that ComfyUI doesn't encode them first
+            node['inputs'] = {'images': node['inputs']['images'], 'format': 'PNG' if policy['passthrough'] else 'RAW'}
+
+        if class_type == 'SaveImageWebsocket':
+            capture_nodes.append(node_id)
+
+    return capture_nodes
+
+# ---------------------------------------------------------------------------- #
+#                               Input Processing                               #
+# ---------------------------------------------------------------------------- #
+
+def get_image_extension(name, content_type=None):
+    if content_type:
+        extension = mimetypes.guess_extension(content_type.split(';')[0].strip())
+
+        if extension:
+            return extension
+
+    extension = os.path.splitext(name)[1].lower()
+
+    if extension in ('.png', '.jpg', '.jpeg', '.webp', '.gif', '.bmp', '.tiff'):
+        return extension
+
+    return ''
+
+
+def decode_base64_image(value):
+    if value.startswith('data:'):
+        header, _, data = value.partition(',')
+        return base64.b64decode(data), get_image_extension('', header[5:].split(';')[0])
+
+    # A plain filename is never this long, so treat long strings as raw base64
+    if len(value) >= 1024:
+        try:
+            return base64.b64decode(value, validate=True), ''
+        except ValueError:
+            return None
+
+    return None
+
+
+"""
+Fetch a single input image reference into the input cache and return its
+cache filename. Returns None if the value is a plain ComfyUI input filename.
+"""
+def fetch_input_image(value):
+    if value.startswith(('http://', 'https://')):
+        filename = input_cache.lookup(value)
+
+        if filename is None:
+            r = download_session.get(value, timeout=TIMEOUT)
+            r.raise_for_status()
+            extension = get_image_extension(value.split('?')[0], r.headers.get('Content-Type'))
+            filename = input_cache.store(r.content, extension, source=value)
+
+        return filename
+
+    if value.startswith('s3://'):
+        filename = input_cache.lookup(value)
+
+        if filename is None:
+            if get_s3() is None:
+                raise RuntimeError(f'S3 is not configured, unable to fetch input image: {value}')
+
+            tmp_path = f'{input_cache.cache_dir}/{uuid.uuid4()}.tmp'
+
+            if get_s3().download_file(value[5:], tmp_path) is None:
+                raise RuntimeError(f'Unable to download input image from S3: {value}')
+
+            try:
+                with open(tmp_path, 'rb') as f:
+                    data = f.read()
+            finally:
+                os.remove(tmp_path)
+
+            filename = input_cache.store(data, get_image_extension(value), source=value)
+
+        return filename
+
+    decoded = decode_base64_image(value)
+
+    if decoded is not None:
+        data, extension = decoded
+        return input_cache.store(data, extension)
+
+    return None
+
+
+"""
+Fetch the images referenced by the image loader nodes of a workflow (URLs,
+s3:// keys or base64 data) concurrently into the input cache and point the
+nodes at the cached files. Returns the cache filenames used by the job, which
+must be released once the job is done.
+"""
+def prefetch_input_images(payload):
+    references = []
+
+    for node_id, node in payload.items():
+        input_name = INPUT_IMAGE_NODES.get(node.get('class_type'))
+
+        if input_name is not None and isinstance(node.get('inputs', {}).get(input_name), str):
+            references.append((node_id, input_name, node['inputs'][input_name]))
+
+    if not references:
+        return []
+
+    stats = input_cache.get_stats()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=INPUT_FETCH_WORKERS) as pool:
+        futures = [pool.submit(fetch_input_image, value) for _, _, value in references]
+
+    filenames = [future.result() for future in futures if future.exception() is None and future.result() is not None]
+
+    for future in futures:
+        if future.exception() is not None:
+            # Release whatever was fetched successfully before failing the job
+            input_cache.release(filenames)
+            raise future.exception()
+
+    for (node_id, input_name, _), future in zip(references, futures):
+        if future.result() is not None:
+            payload[node_id]['inputs'][input_name] = input_cache.get_node_input(future.result())
+
+    if filenames:
+        new_stats = input_cache.get_stats()
+        logging.info(
+            f'Input images prefetched: {new_stats["hits"] - stats["hits"]} cached, '
+            f'{new_stats["misses"] - stats["misses"]} fetched, cache: {new_stats}'
+        )
+
+    return filenames
+
+# ---------------------------------------------------------------------------- #
+#                               Output Processing                              #
+# ---------------------------------------------------------------------------- #
+
+def get_encode_pool():
+    global encode_pool
+
+    with encode_pool_lock:
+        if encode_pool is None:
+            # Spawn rather than fork, the handler process runs background threads
+            encode_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=OUTPUT_ENCODE_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+        return encode_pool
+
+
+def warm_encode_pool():
+    # Spawning the workers imports this module, so do it at startup rather than in the first job
+    if OUTPUT_ENCODE_WORKERS > 1:
+        pool = get_encode_pool()
+
+        for _ in range(OUTPUT_ENCODE_WORKERS):
+            pool.submit(os.getpid)
+
+
+"""
+Merge the output options of a request with the server-side defaults.
+Returns the policy and a list of validation errors.
+"""
+def get_output_policy(output):
+    validated_output = validate(output, OUTPUT_SCHEMA)
+
+    if 'errors' in validated_output:
+        return None, validated_output['errors']
+
+    policy = DEFAULT_OUTPUT_POLICY.copy()
+
+    for key, value in validated_output['validated_input'].items():
+        if value is not None:
+            policy[key] = value
+
+    if policy['delivery'] not in ('inline', 's3'):
+        return None, [f'Unsupported output delivery: {policy["delivery"]}']
+
+    if policy['format'] not in IMAGE_FORMATS:
+        return None, [f'Unsupported output format: {policy["format"]}']
+
+    if policy['capture'] not in ('file', 'websocket'):
+        return None, [f'Unsupported output capture: {policy["capture"]}']
+
+    # Make sure all the Pillow plugins are registered before checking for encoder support
+    Image.init()
+
+    if IMAGE_FORMATS[policy['format']] not in Image.SAVE and not policy['passthrough']:
+        return None, [f'Output format {policy["format"]} is not supported by this worker']
+
+    return policy, []
+
+
+def get_images_format(policy, images):
+    if policy['passthrough']:
+        if len(images):
+            return os.path.splitext(images[0]['filename'])[1][1:].lower() or 'png'
+
+        return 'png'
+
+    return policy['format']
+
+
+def get_image_save_options(policy, width, height):
+    image_format = policy['format']
+    quality = policy['quality']
+    effort = policy['effort']
+    options = {'format': IMAGE_FORMATS[image_format]}
+
+    if image_format == 'webp':
+        # Determine the quality based on the dimensions
+        if quality is None:
+            if width <= 1024 and height <= 1024:
+                quality = 100
+            else:
+                quality = 95
+
+        options['quality'] = quality
+        options['lossless'] = policy['lossless']
+
+        if effort is not None:
+            options['method'] = min(effort, 6)
+    elif image_format == 'png':
+        if effort is not None:
+            options['compress_level'] = effort
+    elif image_format == 'jpeg':
+        if quality is not None:
+            options['quality'] = quality
+
+        options['optimize'] = effort is not None and effort >= 5
+    elif image_format == 'avif':
+        if policy['lossless']:
+            options['quality'] = 100
+            options['subsampling'] = '4:4:4'
+        elif quality is not None:
+            options['quality'] = quality
+
+        if effort is not None:
+            options['speed'] = 10 - effort
+
+    return options
+
+
+"""
+Encode an output image according to the output policy, the source is either
+the path of a file saved by ComfyUI, or the image data or decoded raw pixels
+captured from the websocket. This runs in the encode pool so it must stay a
+module level function.
+"""
+def encode_image(source, policy):
+    if isinstance(source, Image.Image):
+        image_file = source
+    elif isinstance(source, bytes):
+        image_file = Image.open(io.BytesIO(source))
+    else:
+        image_file = Image.open(source)
+
+    with image_file as img:
+        # Get the dimensions of the image
+        width, height = img.size
+        max_dimension = policy['max_dimension']
+        resize = max_dimension is not None and max(width, height) > max_dimension
+
+        # Raw pixels have no original file to pass through so they are saved as PNG
+        if policy['passthrough'] and not resize and not isinstance(source, Image.Image):
+            if isinstance(source, bytes):
+                return source
+
+            with open(source, 'rb') as f:
+                return f.read()
+
+        if resize:
+            img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            width, height = img.size
+
+        if policy['passthrough']:
+            # Resized pass-through images keep their original format
+            options = {'format': img.format or 'PNG'}
+        else:
+            options = get_image_save_options(policy, width, height)
+
+            if options['format'] == 'JPEG' and img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+
+        buffer = io.BytesIO()
+        img.save(buffer, **options)
+
+    return buffer.getvalue()
+
+
+def read_text_file(file_path, filename):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read()
+
+    # Try to parse as JSON if the file extension is .json
+    if file_path.lower().endswith('.json'):
+        try:
+            # Parse JSON and add as structured data
+            json_data = json.loads(content)
+            return {
+                'filename': filename,
+                'content_raw': content,
+                'content_parsed': json_data,
+                'type': 'json'
+            }
+        except json.JSONDecodeError:
+            # If JSON parsing fails, treat as plain text
+            pass
+
+    return {
+        'filename': filename,
+        'content_raw': content,
+        'type': 'text'
+    }
+
+
+def delete_output_file(file_path):
+    logging.info(f'Deleting output file: {file_path}')
+    os.remove(file_path)
+
+
+def delete_flight_outputs(flight):
+    prompt = flight['outcome']
+
+    # Nothing was written if the prompt failed to run
+    if not isinstance(prompt, dict):
+        return
+
+    outputs = prompt['history'][prompt['prompt_id']].get('outputs', {})
+
+    for file_info in get_output_files(outputs):
+        file_path = f'{VOLUME_MOUNT_PATH}/comfyui/output/{file_info["filename"]}'
+
+        if os.path.exists(file_path):
+            delete_output_file(file_path)
+
+
+"""
+Read and encode the output files of a prompt, followed by any images that
+were captured from the websocket. Images are encoded concurrently in the
+encode pool with a bounded number in flight, texts are read while the
+images are being encoded, and the original output order is preserved.
+Files are deleted once read unless delete is False.
+"""
+def process_output_files(all_filenames, policy, captured_images=(), delete=True):
+    images = []
+    texts = []
+    in_flight = collections.deque()
+    image_count = sum(1 for file_info in all_filenames if file_info['type'] == 'image') + len(captured_images)
+
+    # Not worth the inter-process round-trip for a single image or when not re-encoding
+    if image_count > 1 and OUTPUT_ENCODE_WORKERS > 1 and not policy['passthrough']:
+        pool = get_encode_pool()
+    else:
+        pool = None
+
+    def collect_image():
+        file_path, filename, future = in_flight.popleft()
+
+        with timed('encode'):
+            data = future.result()
+
+        images.append({'filename': filename, 'data': data})
+        metrics.inc('worker_encoded_images_total')
+        metrics.inc('worker_encoded_bytes_total', len(data))
+
+        if file_path is not None and delete:
+            delete_output_file(file_path)
+
+    def add_image(source, filename, file_path=None):
+        if pool is None:
+            with timed('encode'):
+                data = encode_image(source, policy)
+
+            images.append({'filename': filename, 'data': data})
+            metrics.inc('worker_encoded_images_total')
+            metrics.inc('worker_encoded_bytes_total', len(data))
+
+            if file_path is not None and delete:
+                delete_output_file(file_path)
+
+            return
+
+        # Bound the number of encoded images held in memory at once
+        if len(in_flight) >= OUTPUT_ENCODE_WORKERS * 2:
+            collect_image()
+
+        in_flight.append((file_path, filename, pool.submit(encode_image, source, policy)))
+
+    for file_info in all_filenames:
+        filename = file_info['filename']
+        file_type = file_info['type']
+        file_path = f'{VOLUME_MOUNT_PATH}/comfyui/output/{filename}'
+
+        if not os.path.exists(file_path):
+            logging.error(f'Output file {file_path} not found')
+            continue
+
+        if file_type == 'image':
+            add_image(file_path, filename, file_path)
+        elif file_type == 'text':
+            with timed('read'):
+                texts.append(read_text_file(file_path, filename))
+
+            if delete:
+                delete_output_file(file_path)
+
+    for filename, data in captured_images:
+        add_image(data, filename)
+
+    while in_flight:
+        collect_image()
+
+    return images, texts
+
+
+def get_s3():
+    global s3
+
+    # Concurrent jobs must not add the transfer observer twice
+    with s3_lock:
+        if s3 is None:
+            # The comfys3 settings are written to its .env by create_env.py at startup
+            load_dotenv(f'{COMFYS3_PATH}/.env')
+            try:
+                s3_client = import_comfys3_module('s3_client')
+                s3 = s3_client.get_s3_instance()
+
+                if s3 is not None:
+                    s3_client.add_transfer_observer(observe_s3_transfer)
+            except ImportError as e:
+                logging.error(f'Unable to import comfys3: {e}')
+
+        return s3
+
+
+def observe_s3_transfer(direction, status, size, seconds):
+    metrics.inc('comfys3_transfers_total', process='handler', direction=direction, status=status)
+    metrics.inc('comfys3_transfer_bytes_total', size, process='handler', direction=direction)
+    metrics.inc('comfys3_transfer_seconds_total', seconds, process='handler', direction=direction)
+
+
+"""
+Copy the totals of the S3 transfers made inside ComfyUI, which comfys3 serves
+on /comfys3/stats, into the metrics. Nothing is copied if the route is missing
+because comfys3 has not been loaded by ComfyUI.
+"""
+def collect_comfyui_s3_transfers():
+    response = requests.get(f'{BASE_URI}/comfys3/stats', timeout=HEALTH_CHECK_TIMEOUT)
+
+    if response.status_code == 404:
+        return
+
+    response.raise_for_status()
+    totals = collections.defaultdict(lambda: [0, 0.0])
+
+    for stats in response.json():
+        direction = stats['direction']
+        metrics.set('comfys3_transfers_total', stats['count'], process='comfyui', direction=direction, status=stats['status'])
+        totals[direction][0] += stats['bytes']
+        totals[direction][1] += stats['seconds']
+
+    for direction, (size, seconds) in totals.items():
+        metrics.set('comfys3_transfer_bytes_total', size, process='comfyui', direction=direction)
+        metrics.set('comfys3_transfer_seconds_total', seconds, process='comfyui', direction=direction)
+
+
+"""
+Import a module from the comfys3 custom node without running the package
+__init__, which registers the ComfyUI nodes and needs the ComfyUI runtime.
+"""
+def import_comfys3_module(name):
+    if 'comfys3' not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            'comfys3',
+            f'{COMFYS3_PATH}/__init__.py',
+            submodule_search_locations=[COMFYS3_PATH]
+        )
+        sys.modules['comfys3'] = importlib.util.module_from_spec(spec)
+
+    return importlib.import_module(f'comfys3.{name}')
+
+
+"""
+Replace the presigned URLs of a cached result, which may have expired since
+the result was stored.
+"""
+def refresh_presigned_urls(result, policy):
+    if not policy['presign'] or get_s3() is None:
+        return result
+
+    images = []
+    texts = []
+
+    for image in result['images']:
+        if isinstance(image, dict):
+            image = {**image, 'url': get_s3().get_presigned_url(image['s3_key'], OUTPUT_PRESIGN_EXPIRY)}
+
+        images.append(image)
+
+    for text in result['texts']:
+        if 's3_key' in text:
+            text = {**text, 'url': get_s3().get_presigned_url(text['s3_key'], OUTPUT_PRESIGN_EXPIRY)}
+
+        texts.append(text)
+
+    return {**result, 'images': images, 'texts': texts}
+
 
-    def emit(self, record):
-        runpod_job_id = os.getenv('RUNPOD_JOB_ID')
+def upload_output(data, s3_path, policy):
+    s3_key = get_s3().upload_bytes(data, s3_path)
 
-        try:
-            # Handle string formatting and extra arguments
-            if hasattr(record, 'msg') and hasattr(record, 'args'):
-                if record.args:
-                    if isinstance(record.args, dict):
-                        message = record.msg % record.args if '%' in str(record.msg) else record.msg
-                    else:
-                        message = str(record.msg) % record.args if '%' in str(record.msg) else record.msg
-                else:
-                    message = record.msg
-            else:
-                message = str(record)
+    if s3_key is None:
+        return None
 
-            # # Extract extra arguments (like job_id) if present
-            # extra = record.args[len(record.msg.split('%'))-1:] if isinstance(record.args, (list, tuple)) else []
-            #
-            # # Append extra arguments to the message
-            # if extra:
-            #     message += f" (Extra: {', '.join(map(str, extra))})"
+    output = {'s3_key': s3_key}
 
-            # Only log to RunPod logger if the length of the log entry is >= 1000 characters
-            if len(message) <= 1000:
-                level_mapping = {
-                    logging.DEBUG: self.rp_logger.debug,
-                    logging.INFO: self.rp_logger.info,
-                    logging.WARNING: self.rp_logger.warn,
-                    logging.ERROR: self.rp_logger.error,
-                    logging.CRITICAL: self.rp_logger.error
-                }
+    if policy['presign']:
+        output['url'] = get_s3().get_presigned_url(s3_key, OUTPUT_PRESIGN_EXPIRY)
 
-                # Wrapper to invoke RunPodLogger logging
-                rp_logger = level_mapping.get(record.levelno, self.rp_logger.info)
+    return output
 
-                if runpod_job_id:
-                    rp_logger(message, runpod_job_id)
-                else:
-                    rp_logger(message)
 
-            if self.log_api_endpoint:
-                try:
-                    headers = {'Authorization': f'Bearer {self.log_token}'}
-
-                    log_payload = {
-                        'app_name': self.app_name,
-                        'log_asctime': self.formatter.formatTime(record),
-                        'log_levelname': record.levelname,
-                        'log_message': message,
-                        'runpod_endpoint_id': self.runpod_endpoint_id,
-                        'runpod_cpu_count': self.runpod_cpu_count,
-                        'runpod_pod_id': self.runpod_pod_id,
-                        'runpod_gpu_size': self.runpod_gpu_size,
-                        'runpod_mem_gb': self.runpod_mem_gb,
-                        'runpod_gpu_count': self.runpod_gpu_count,
-                        'runpod_volume_id': self.runpod_volume_id,
-                        'runpod_pod_hostname': self.runpod_pod_hostname,
-                        'runpod_debug_level': self.runpod_debug_level,
-                        'runpod_dc_id': self.runpod_dc_id,
-                        'runpod_gpu_name': self.runpod_gpu_name,
-                        'runpod_job_id': runpod_job_id
-                    }
+"""
+Build the images and texts returned to the client. With the s3 delivery mode,
+outputs larger than inline_max_bytes are uploaded concurrently and replaced
+by their S3 key (and a presigned URL), smaller ones are still returned inline.
+Outputs that fail to upload are returned inline as well.
+"""
+def deliver_outputs(images, texts, policy, job_id):
+    images_format = get_images_format(policy, images)
+    uploads = {}
 
-                    response = requests.post(
-                        self.log_api_endpoint,
-                        json=log_payload,
-                        headers=headers,
-                        timeout=self.log_api_timeout
-                    )
-
-                    if response.status_code != 200:
-                        self.rp_logger.error(f'Failed to send log to API. Status code: {response.status_code}')
-                except requests.Timeout:
-                    self.rp_logger.error(f'Timeout error sending log to API (timeout={self.log_api_timeout}s)')
-                except Exception as e:
-                    self.rp_logger.error(f'Error sending log to API: {str(e)}')
-            else:
-                self.rp_logger.warn('LOG_API_ENDPOINT environment variable is not set, not logging to API')
-        except Exception as e:
-            # Add error handling for message formatting
-            self.rp_logger.error(f'Error in log formatting: {str(e)}')
+    if policy['delivery'] == 's3' and get_s3() is None:
+        logging.error('S3 is not configured, returning outputs inline')
+    elif policy['delivery'] == 's3':
+        s3_dir = f'{get_s3().output_dir}/{job_id}'
+
+        with timed('upload'), concurrent.futures.ThreadPoolExecutor(max_workers=OUTPUT_UPLOAD_WORKERS) as pool:
+            for index, image in enumerate(images):
+                if len(image['data']) > policy['inline_max_bytes']:
+                    name = os.path.splitext(image['filename'])[0]
+                    s3_path = f'{s3_dir}/{name}.{images_format}'
+                    uploads[('image', index)] = pool.submit(upload_output, image['data'], s3_path, policy)
+
+            for index, text in enumerate(texts):
+                data = text['content_raw'].encode('utf-8')
+
+                if len(data) > policy['inline_max_bytes']:
+                    s3_path = f'{s3_dir}/{text["filename"]}'
+                    uploads[('text', index)] = pool.submit(upload_output, data, s3_path, policy)
+
+            uploads = {key: future.result() for key, future in uploads.items()}
+
+    delivered_images = []
+    delivered_texts = []
+
+    for index, image in enumerate(images):
+        uploaded = uploads.get(('image', index))
+
+        if uploaded is not None:
+            delivered_images.append(uploaded)
+            metrics.inc('worker_output_bytes_total', len(image['data']), delivery='s3')
+        else:
+            with timed('base64'):
+                delivered_images.append(base64.b64encode(image['data']).decode('utf-8'))
+
+            metrics.inc('worker_output_bytes_total', len(delivered_images[-1]), delivery='inline')
+
+    for index, text in enumerate(texts):
+        uploaded = uploads.get(('text', index))
+        size = len(text['content_raw'].encode('utf-8'))
+
+        if uploaded is not None:
+            delivered_texts.append({
+                'filename': text['filename'],
+                'type': text['type'],
+                **uploaded
+            })
+            metrics.inc('worker_output_bytes_total', size, delivery='s3')
+        else:
+            delivered_texts.append(text)
+            metrics.inc('worker_output_bytes_total', size, delivery='inline')
+
+    failed_uploads = sum(1 for uploaded in uploads.values() if uploaded is None)
+
+    if failed_uploads:
+        logging.warning(f'{failed_uploads} output(s) failed to upload to S3, returning them inline')
+
+    return delivered_images, images_format, delivered_texts
 
 # ---------------------------------------------------------------------------- #
-#                               ComfyUI Functions                              #
+#                                    Warmup                                    #
 # ---------------------------------------------------------------------------- #
 
-def wait_for_service(url):
-    retries = 0
+def remove_nodes(workflow, node_ids):
+    removed = set(node_ids)
 
+    # Also remove every node that takes an input from a removed node
     while True:
-        try:
-            requests.get(url)
-            return
-        except requests.exceptions.RequestException:
-            retries += 1
+        dependents = {
+            node_id for node_id, node in workflow.items()
+            if node_id not in removed and any(
+                isinstance(value, list) and len(value) == 2 and value[0] in removed
+                for value in node['inputs'].values()
+            )
+        }
 
-            # Only log every 15 retries so the logs don't get spammed
-            if retries % 30 == 0:
-                logging.info('Service not ready yet. Retrying...')
-        except Exception as err:
-            logging.error(f'Error: {err}')
+        if not dependents:
+            break
 
-        time.sleep(0.1)
+        removed |= dependents
 
+    for node_id in removed:
+        workflow.pop(node_id, None)
 
-def send_get_request(endpoint):
-    return session.get(
-        url=f'{BASE_URI}/{endpoint}',
-        timeout=TIMEOUT
-    )
 
+def get_warmup_payload(workflow_name):
+    warmup = WORKFLOW_WARMUP[workflow_name]
+    validated_params = validate(warmup['params'], WORKFLOW_BINDINGS.get(workflow_name, {}))
 
-def send_post_request(endpoint, payload):
-    return session.post(
-        url=f'{BASE_URI}/{endpoint}',
-        json=payload,
-        timeout=TIMEOUT
-    )
+    if 'errors' in validated_params:
+        raise ValueError('\n'.join(validated_params['errors']))
 
+    payload = get_workflow_payload(workflow_name, validated_params['validated_input'])
+    remove_nodes(payload, warmup.get('exclude_nodes', []))
+    create_unique_filename_prefix(payload)
+    return payload
 
-def get_txt2img_payload(workflow, payload):
-    workflow["3"]["inputs"]["seed"] = payload["seed"]
-    workflow["3"]["inputs"]["steps"] = payload["steps"]
-    workflow["3"]["inputs"]["cfg"] = payload["cfg_scale"]
-    workflow["3"]["inputs"]["sampler_name"] = payload["sampler_name"]
-    workflow["4"]["inputs"]["ckpt_name"] = payload["ckpt_name"]
-    workflow["5"]["inputs"]["batch_size"] = payload["batch_size"]
-    workflow["5"]["inputs"]["width"] = payload["width"]
-    workflow["5"]["inputs"]["height"] = payload["height"]
-    workflow["6"]["inputs"]["text"] = payload["prompt"]
-    workflow["7"]["inputs"]["text"] = payload["negative_prompt"]
-    return workflow
 
+def delete_warmup_outputs(resp_json, prompt_id):
+    image_filenames, text_filenames = get_filenames(resp_json[prompt_id].get('outputs', {}))
 
-def get_workflow_payload(workflow_name, payload):
-    with open(f'/workflows/{workflow_name}.json', 'r') as json_file:
-        workflow = json.load(json_file)
+    for file_info in image_filenames + text_filenames:
+        if file_info.get('type', 'output') == 'output':
+            file_path = os.path.join(f'{VOLUME_MOUNT_PATH}/comfyui/output', file_info.get('subfolder', ''), file_info['filename'])
 
-    if workflow_name == 'txt2img':
-        workflow = get_txt2img_payload(workflow, payload)
+            if os.path.exists(file_path):
+                os.remove(file_path)
 
-    return workflow
+    send_post_request('history', {'delete': [prompt_id]})
 
 
 """
-Get the filenames of the output files
+Queue a minimal job for every workflow with a warmup configuration so that
+its models are loaded (and compiled) before the first request. Results are
+discarded and the whole warmup is bounded by timeout seconds.
 """
-def get_filenames(output):
-    image_filenames = []
-    text_filenames = []
-    for key, value in output.items():
-        if 'images' in value and isinstance(value['images'], list):
-            image_filenames.extend(value['images'])  # Add all images to the list
-        if 'texts' in value and isinstance(value['texts'], list):
-            text_filenames.extend(value['texts'])
-    return image_filenames, text_filenames  # Return the full list after looping
+def run_warmup(timeout=WARMUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    warmup_start = time.perf_counter()
+    warmup_image = io.BytesIO()
+    Image.new('RGB', (64, 64)).save(warmup_image, format='PNG')
 
+    for workflow_name in sorted(WORKFLOW_WARMUP):
+        if time.monotonic() > deadline:
+            logging.warning(f'Warmup deadline reached, skipping workflow: {workflow_name}')
+            continue
 
-"""
-Create a unique filename prefix for each request to avoid a race condition where
-more than one request completes at the same time, which can either result in the
-incorrect output being returned, or the output image not being found.
-"""
-def create_unique_filename_prefix(payload):
-    for key, value in payload.items():
-        class_type = value.get('class_type')
+        start = time.perf_counter()
+        input_files = []
+        prompt_id = None
 
-        if class_type == 'SaveImage':
-            current_prefix = payload[key]['inputs']['filename_prefix']
-            # Only replace if the filename_prefix value is a string
-            if isinstance(current_prefix, str):
-                payload[key]['inputs']['filename_prefix'] = str(uuid.uuid4())
-        elif class_type == 'SaveText|pysssss':
-            # For pysssss SaveText node, we modify the filename instead
-            current_file = payload[key]['inputs']['file']
-            # Only replace if the file value is a string
-            if isinstance(current_file, str):
-                unique_id = str(uuid.uuid4())
-                # Split filename and extension
-                ext = os.path.splitext(current_file)[1]
-                payload[key]['inputs']['file'] = f"{unique_id}{ext}"
+        try:
+            payload = get_warmup_payload(workflow_name)
+
+            # The template image is unlikely to exist on this worker, use a blank one instead
+            for node in payload.values():
+                input_name = INPUT_IMAGE_NODES.get(node['class_type'])
+
+                if input_name is not None:
+                    filename = input_cache.store(warmup_image.getvalue(), '.png')
+                    input_files.append(filename)
+                    node['inputs'][input_name] = input_cache.get_node_input(filename)
+
+            generation = comfyui_events.snapshot()
+            queue_response = send_post_request('prompt', {'prompt': payload, 'client_id': CLIENT_ID})
+
+            if queue_response.status_code != 200:
+                raise RuntimeError(f'HTTP status code: {queue_response.status_code}: {queue_response.text}')
+
+            prompt_id = queue_response.json()['prompt_id']
+            resp_json = wait_for_prompt(prompt_id, generation, deadline)
+            status = resp_json[prompt_id]['status']['status_str']
+            delete_warmup_outputs(resp_json, prompt_id)
+            logging.info(f'Warmup of {workflow_name} finished with status {status} in {time.perf_counter() - start:.1f}s')
+        except TimeoutError:
+            logging.warning(f'Warmup of {workflow_name} did not finish before the deadline, interrupting it')
+
+            # Make sure the first real job does not queue behind the warmup
+            if prompt_id is not None:
+                cancel_prompt(prompt_id)
+        except Exception as e:
+            logging.error(f'Warmup of {workflow_name} failed after {time.perf_counter() - start:.1f}s: {e}')
+        finally:
+            input_cache.release(input_files)
+
+    logging.info(f'Warmup finished in {time.perf_counter() - warmup_start:.1f}s')
 
 # ---------------------------------------------------------------------------- #
 #                                RunPod Handler                                #
 # ---------------------------------------------------------------------------- #
-def handler(event):
+"""
+Process and publish the outputs of every node as soon as ComfyUI reports it
+as executed, along with the progress of the prompt, until the prompt has
+finished or the socket has dropped and events may have been missed.
+Returns the ids of the nodes whose outputs have been published.
+"""
+def publish_outputs(prompt_id, generation, policy, job_id, publish):
+    published_nodes = set()
+    cursor = 0
+
+    while generation is not None:
+        events, finished = comfyui_events.wait_events(prompt_id, generation, cursor, WS_WAIT_INTERVAL)
+        cursor += len(events)
+
+        for event_type, data in events:
+            if event_type == 'progress':
+                publish({
+                    'type': 'progress',
+                    'node': data.get('node'),
+                    'value': data.get('value'),
+                    'max': data.get('max')
+                })
+                continue
+
+            node = data.get('node')
+            images, texts = process_output_files(get_output_files({node: data.get('output') or {}}), policy)
+            published_nodes.add(node)
+
+            if images or texts:
+                images, images_format, texts = deliver_outputs(images, texts, policy, job_id)
+                logging.info(f'Published the outputs of node {node} for prompt: {prompt_id}')
+
+                publish({
+                    'type': 'output',
+                    'node': node,
+                    'images': images,
+                    'images_format': images_format,
+                    'texts': texts
+                })
+
+        if finished or comfyui_events.snapshot() != generation:
+            break
+
+    return published_nodes
+
+
+"""
+Queue a prompt in ComfyUI and wait for it to finish. Returns its id and
+history, the images captured from the websocket (None if some may have been
+missed) and the nodes whose outputs have already been published.
+"""
+def run_prompt(payload, output_policy, publish):
+    logging.debug('Queuing prompt')
+    generation = comfyui_events.snapshot()
+    capture_nodes = prepare_output_capture(payload, output_policy, generation)
+    published_nodes = set()
+
+    # Choose the prompt id ourselves so that capturing starts before the prompt can run
+    prompt_id = str(uuid.uuid4())
+
+    if capture_nodes:
+        comfyui_events.capture(prompt_id, capture_nodes)
+
+    if publish is not None:
+        comfyui_events.subscribe(prompt_id)
+
+    try:
+        with timed('queue'):
+            try:
+                queue_response = send_post_request(
+                    'prompt',
+                    {
+                        'prompt': payload,
+                        'client_id': CLIENT_ID,
+                        'prompt_id': prompt_id
+                    }
+                )
+            except requests.exceptions.RequestException as e:
+                # ComfyUI may have queued the prompt before the request failed
+                if not cancel_prompt(prompt_id):
+                    raise
+
+                raise TransientError(f'Failed to queue prompt {prompt_id}: {e}') from e
+
+        queued_at = time.monotonic()
+        timer = job_timer_context.get()
+
+        if timer is not None:
+            timer.queued_at = queued_at
+
+        if queue_response.status_code != 200:
+            try:
+                queue_response_content = queue_response.json()
+            except Exception as e:
+                queue_response_content = str(queue_response.content)
+
+            raise PromptRejectedError(queue_response.status_code, queue_response_content)
+
+        resp_json = queue_response.json()
+
+        if resp_json['prompt_id'] != prompt_id:
+            # Older ComfyUI versions ignore the requested prompt id
+            comfyui_events.move_capture(prompt_id, resp_json['prompt_id'])
+            comfyui_events.move_subscription(prompt_id, resp_json['prompt_id'])
+            prompt_id = resp_json['prompt_id']
+
+        logging.info(f'Prompt queued successfully: {prompt_id}')
+
+        if publish is not None:
+            published_nodes = publish_outputs(prompt_id, generation, output_policy, job_id_context.get(), publish)
+
+        with timed('wait'):
+            resp_json = wait_for_queued_prompt(prompt_id, generation)
+
+        captured = comfyui_events.release_capture(prompt_id) if capture_nodes else []
+
+        if captured is None:
+            raise TransientError(f'Lost the websocket connection while capturing the outputs of prompt: {prompt_id}')
+
+        return {
+            'prompt_id': prompt_id,
+            'history': resp_json,
+            'captured': captured,
+            'published_nodes': published_nodes,
+            'execution_seconds': time.monotonic() - queued_at
+        }
+    finally:
+        comfyui_events.release_capture(prompt_id)
+        comfyui_events.unsubscribe(prompt_id)
+
+
+"""
+Wait for a prompt that ComfyUI has accepted. When fetching its history fails
+the same prompt is waited for again by polling while ComfyUI is healthy, as
+queuing it again would run the graph twice.
+"""
+def wait_for_queued_prompt(prompt_id, generation):
+    attempt = 0
+
+    while True:
+        try:
+            return wait_for_prompt(prompt_id, generation)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if attempt >= TRANSIENT_RETRIES:
+                raise
+
+            problem = check_comfyui_health()
+
+            if problem is not None:
+                logging.error(f'Not waiting for prompt {prompt_id} anymore: {problem}')
+                raise
+
+            logging.warning(f'Waiting again for prompt {prompt_id} after a transient error: {e}')
+            time.sleep(TRANSIENT_RETRY_DELAY * 2 ** attempt)
+            # The events of the prompt were discarded, so it is polled from now on
+            generation = None
+            attempt += 1
+
+
+"""
+Run a prompt, queuing it again while ComfyUI is still healthy when it could
+not be queued or its captured outputs were lost. Any other error happens
+after ComfyUI accepted the prompt and is not retried. Streamed jobs are not
+retried as some of their outputs may already have been published.
+"""
+def run_prompt_with_retries(payload, output_policy, publish):
+    attempt = 0
+
+    while True:
+        try:
+            return run_prompt(payload, output_policy, publish)
+        except Exception as e:
+            retryable = isinstance(e, TransientError) or (isinstance(e, PromptRejectedError) and e.status_code >= 500)
+
+            if publish is not None or attempt >= TRANSIENT_RETRIES or not retryable:
+                raise
+
+            problem = check_comfyui_health()
+
+            if problem is not None:
+                logging.error(f'Not retrying the prompt: {problem}')
+                raise
+
+            logging.warning(f'Retrying the prompt after a transient error: {e}')
+            metrics.inc('worker_prompt_retries_total')
+            time.sleep(TRANSIENT_RETRY_DELAY * 2 ** attempt)
+            attempt += 1
+
+
+"""
+Classify the exception that failed a job:
+- user: the job itself is at fault, like a node failing on its inputs
+- transient: an infrastructure hiccup that may succeed when retried
+- poisoned: the GPU or ComfyUI are left in a state that needs a refresh
+Returns None when the exception is not recognised.
+"""
+def classify_error(e):
+    if isinstance(e, ExecutionError):
+        exception = f'{e.details.get("exception_type", "")}: {e.details.get("exception_message", "")}'
+        return 'poisoned' if POISONED_ERROR_PATTERN.search(exception) else 'user'
+
+    if isinstance(e, PromptRejectedError):
+        return 'transient' if e.status_code >= 500 else 'user'
+
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return 'transient' if e.response.status_code >= 500 else 'user'
+
+    if isinstance(e, (TransientError, requests.exceptions.ConnectionError, requests.exceptions.Timeout, ConnectionError)):
+        return 'transient'
+
+    if POISONED_ERROR_PATTERN.search(str(e)):
+        return 'poisoned'
+
+    # Jobs coalesced into a failed prompt raise with the error of the prompt as the cause
+    if e.__cause__ is not None:
+        return classify_error(e.__cause__)
+
+    return None
+
+
+"""
+Decide whether the worker must be refreshed after a job failed. Poisoned
+states always need a refresh and user errors never do, anything else only
+when ComfyUI fails its health check.
+"""
+def should_refresh_worker(e):
+    category = classify_error(e)
+
+    if category == 'poisoned':
+        problem = str(e)
+    elif category == 'user':
+        problem = None
+    else:
+        problem = check_comfyui_health()
+
+    if problem is not None:
+        logging.error(f'Refreshing the worker after a {category or "unclassified"} error: {problem}')
+        return True
+
+    logging.info(f'Keeping the worker after a {category or "unclassified"} error')
+    metrics.inc('worker_cold_starts_avoided_total', category=category or 'unclassified')
+    return False
+
+
+"""
+Handle a job. When publish is set, progress and outputs are passed to it as
+soon as they are available and only the remaining outputs are returned.
+"""
+def handler(event, publish=None):
     job_id = event['id']
-    os.environ['RUNPOD_JOB_ID'] = job_id
+    job_id_token = job_id_context.set(job_id)
+    input_files = []
+    flight = None
+    started_at = time.monotonic()
+    job_status = 'invalid'
+    error_class = None
+    cache_key = None
+
+    # Only time the job when its timings are returned or aggregated
+    if isinstance(event['input'], dict) and event['input'].get('timings') is True or TIMINGS_LOG_INTERVAL > 0 or METRICS_PORT > 0:
+        timer = JobTimer()
+    else:
+        timer = None
+
+    job_timer_token = job_timer_context.set(timer)
+    metrics.inc('worker_jobs_in_flight')
 
     try:
-        validated_input = validate(event['input'], INPUT_SCHEMA)
+        with timed('validate'):
+            validated_input = validate(event['input'], INPUT_SCHEMA)
+
+            if 'errors' in validated_input:
+                return {
+                    'error': '\n'.join(validated_input['errors'])
+                }
 
-        if 'errors' in validated_input:
+            payload = validated_input['validated_input']
+            workflow_name = payload['workflow']
+            callback = payload['callback']
+            return_timings = payload['timings']
+            use_cache = payload['cache']
+            output_policy, errors = get_output_policy(payload['output'])
+            payload = payload['payload']
+
+        if errors:
             return {
-                'error': '\n'.join(validated_input['errors'])
+                'error': '\n'.join(errors)
             }
 
-        payload = validated_input['validated_input']
-        workflow_name = payload['workflow']
-        callback = payload['callback']
-        payload = payload['payload']
+        logging.info(f'Workflow: {workflow_name}')
+
+        if workflow_name in WORKFLOW_BINDINGS:
+            with timed('validate'):
+                validated_params = validate(payload, WORKFLOW_BINDINGS[workflow_name])
+
+            if 'errors' in validated_params:
+                return {
+                    'error': '\n'.join(validated_params['errors'])
+                }
 
-        logging.info(f'Workflow: {workflow_name}', job_id)
+            payload = validated_params['validated_input']
 
         if workflow_name != 'custom':
             try:
                 payload = get_workflow_payload(workflow_name, payload)
             except Exception as e:
-                logging.error(f'Unable to load workflow payload for: {workflow_name}', job_id)
+                logging.error(f'Unable to load workflow payload for: {workflow_name}')
                 raise
 
-        create_unique_filename_prefix(payload)
-        logging.debug('Queuing prompt', job_id)
+        with timed('validate'):
+            graph_errors = graph_validator.validate(payload)
 
-        queue_response = send_post_request(
-            'prompt',
-            {
-                'prompt': payload
+        if graph_errors:
+            return {
+                'error': '\n'.join(graph_errors)
             }
-        )
 
-        if queue_response.status_code == 200:
-            resp_json = queue_response.json()
-            prompt_id = resp_json['prompt_id']
-            logging.info(f'Prompt queued successfully: {prompt_id}', job_id)
-            retries = 0
+        with timed('inputs'):
+            input_files = prefetch_input_images(payload)
 
-            while True:
-                # Only log every 30 retries so the logs don't get spammed
-                if retries == 0 or retries % 30 == 0:
-                    logging.info(f'Getting status of prompt: {prompt_id}', job_id)
+        if RESULT_CACHE and use_cache:
+            # Prefetched images are named after their content, so the same images give the same key
+            cache_key = get_result_key(payload, output_policy)
+            cached_result = result_cache.lookup(cache_key)
 
-                r = send_get_request(f'history/{prompt_id}')
-                resp_json = r.json()
+            if cached_result is not None:
+                result = {
+                    'callback': callback,
+                    **refresh_presigned_urls(cached_result, output_policy)
+                }
 
-                if r.status_code == 200 and len(resp_json):
-                    break
+                if return_timings:
+                    result['timings'] = timer.get_timings()
 
-                time.sleep(0.1)
-                retries += 1
+                job_status = 'cached'
+                return result
 
-            status = resp_json[prompt_id]['status']
-
-            if status['status_str'] == 'success' and status['completed']:
-                # Job was processed successfully
-                outputs = resp_json[prompt_id]['outputs']
-
-                if len(outputs):
-                    logging.info(f'Files generated successfully for prompt: {prompt_id}', job_id)
-                    image_filenames, text_filenames = get_filenames(outputs)
-                    images = []
-                    texts = []
-
-                    # Merge all filenames with type information for unified processing
-                    all_filenames = []
-                    for image_info in image_filenames:
-                        all_filenames.append({'filename': image_info['filename'], 'type': 'image'})
-                    for text_info in text_filenames:
-                        all_filenames.append({'filename': text_info['filename'], 'type': 'text'})
-
-                    for file_info in all_filenames:
-                        filename = file_info['filename']
-                        file_type = file_info['type']
-                        file_path = f'{VOLUME_MOUNT_PATH}/comfyui/output/{filename}'
-
-                        if os.path.exists(file_path):
-                            if file_type == 'image':
-                                # Process image file
-                                with Image.open(file_path) as img:
-                                    # Get the dimensions of the image
-                                    width, height = img.size
-
-                                    # Determine the quality based on the dimensions
-                                    if width <= 1024 and height <= 1024:
-                                        quality = 100
-                                    else:
-                                        quality = 95
-                                    
-                                    # Convert to WebP in-memory
-                                    buffer = io.BytesIO()
-                                    img.save(buffer, format='WEBP', quality=quality)
-                                    buffer.seek(0)
-                                    images.append(base64.b64encode(buffer.read()).decode('utf-8'))
-
-                            elif file_type == 'text':
-                                # Process text file
-                                with open(file_path, 'r', encoding='utf-8') as f:
-                                    content = f.read()
-                                    
-                                    # Try to parse as JSON if the file extension is .json
-                                    if file_path.lower().endswith('.json'):
-                                        try:
-                                            # Parse JSON and add as structured data
-                                            json_data = json.loads(content)
-                                            texts.append({
-                                                'filename': filename,
-                                                'content_raw': content,
-                                                'content_parsed': json_data,
-                                                'type': 'json'
-                                            })
-                                        except json.JSONDecodeError:
-                                            # If JSON parsing fails, treat as plain text
-                                            texts.append({
-                                                'filename': filename,
-                                                'content_raw': content,
-                                                'type': 'text'
-                                            })
-                                    else:
-                                        # Plain text file
-                                        texts.append({
-                                            'filename': filename,
-                                            'content_raw': content,
-                                            'type': 'text'
-                                        })
-
-                            logging.info(f'Deleting output file: {file_path}', job_id)
-                            os.remove(file_path)
-                        else:
-                            logging.error(f'Output file {file_path} not found')
-
-                    return {
-                        'callback': callback,
-                        'images': images,
-                        'images_format': 'webp',
-                        'texts': texts
-                    }
-                else:
-                    raise RuntimeError(f'No output found for prompt id: {prompt_id}')
-            else:
-                # Job did not process successfully
-                for message in status['messages']:
-                    key, value = message
-
-                    if key == 'execution_error':
-                        if 'node_type' in value and 'exception_message' in value:
-                            node_type = value['node_type']
-                            exception_message = value['exception_message']
-                            raise RuntimeError(f'{node_type}: {exception_message}')
-                        else:
-                            # Log to file instead of RunPod because the output tends to be too verbose
-                            # and gets dropped by RunPod logging
-                            error_msg = f'Job did not process successfully for prompt_id: {prompt_id}'
-                            logging.error(error_msg)
-                            logging.info(f'{job_id}: Response JSON: {resp_json}')
-                            raise RuntimeError(error_msg)
+        if publish is None:
+            # Streamed jobs delete the outputs as they are published so they are never coalesced
+            flight_key = get_result_key(payload, output_policy['capture'])
+            flight, leads_flight = prompt_flights.join(flight_key)
 
-        else:
+        if flight is None or leads_flight:
+            # Whatever fails the leader must complete the flight, or its followers would wait for nothing
             try:
-                queue_response_content = queue_response.json()
+                create_unique_filename_prefix(payload)
+                governor_token = None
+
+                if RESOURCE_GOVERNOR:
+                    models = get_job_models(payload)
+                    # Custom graphs are told apart by the models they use
+                    workflow_key = workflow_name if workflow_name != 'custom' else f'custom:{",".join(sorted(models))}'
+
+                    with timed('governor'):
+                        governor_token = resource_governor.before_prompt(workflow_key, models)
+
+                try:
+                    prompt = run_prompt_with_retries(payload, output_policy, publish)
+                finally:
+                    if governor_token is not None:
+                        with timed('governor'):
+                            resource_governor.after_prompt(governor_token)
             except Exception as e:
-                queue_response_content = str(queue_response.content)
+                if flight is not None:
+                    prompt_flights.complete(flight_key, flight, e)
+
+                raise
 
-            logging.error(f'HTTP Status code: {queue_response.status_code}', job_id)
-            logging.error(queue_response_content, job_id)
+            if flight is not None:
+                prompt_flights.complete(flight_key, flight, prompt)
+        else:
+            logging.info('Waiting for an identical prompt that is already in flight')
+
+            with timed('coalesced'):
+                prompt = prompt_flights.wait(flight, PROMPT_FLIGHT_TIMEOUT)
+
+        prompt_id = prompt['prompt_id']
+        resp_json = prompt['history']
+        published_nodes = prompt['published_nodes']
+        status = resp_json[prompt_id]['status']
+
+        if status['status_str'] == 'success' and status['completed']:
+            # Job was processed successfully, outputs that were already published are skipped
+            outputs = resp_json[prompt_id]['outputs']
+            outputs = {node: output for node, output in outputs.items() if node not in published_nodes}
+            captured_images = []
+
+            for index, (extension, data) in enumerate(prompt['captured']):
+                if extension == 'raw':
+                    # Raw RGB pixels are prefixed with the width and height of the image
+                    size = (int.from_bytes(data[:4], 'big'), int.from_bytes(data[4:8], 'big'))
+                    data = Image.frombytes('RGB', size, data[8:])
+                    extension = 'png'
+
+                captured_images.append((f'{prompt_id}_{index:05}.{extension}', data))
+
+            if len(outputs) or captured_images or published_nodes:
+                logging.info(f'Files generated successfully for prompt: {prompt_id}')
+                all_filenames = get_output_files(outputs)
+                # The files of a flight are deleted by its last job once every job has read them
+                images, texts = process_output_files(all_filenames, output_policy, captured_images, delete=flight is None)
+                images, images_format, texts = deliver_outputs(images, texts, output_policy, job_id)
+
+                result = {
+                    'callback': callback,
+                    'images': images,
+                    'images_format': images_format,
+                    'texts': texts
+                }
 
-            return {
-                'error': f'HTTP status code: {queue_response.status_code}',
-                'output': queue_response_content
-            }
-    except Exception as e:
-        logging.error(f'An exception was raised: {e}', job_id)
+                # Streamed results are incomplete, the published outputs are not part of them
+                if cache_key is not None and publish is None:
+                    result_cache.store(cache_key, {
+                        'images': images,
+                        'images_format': images_format,
+                        'texts': texts
+                    }, prompt['execution_seconds'])
+
+                if return_timings:
+                    result['timings'] = timer.get_timings()
+
+                job_status = 'success'
+                return result
+            else:
+                raise RuntimeError(f'No output found for prompt id: {prompt_id}')
+        else:
+            # Job did not process successfully
+            for message in status['messages']:
+                key, value = message
+
+                if key == 'execution_error':
+                    if 'node_type' in value and 'exception_message' in value:
+                        error_class = value['node_type']
+                        raise ExecutionError(value['node_type'], value)
+                    else:
+                        # Log to file instead of RunPod because the output tends to be too verbose
+                        # and gets dropped by RunPod logging
+                        error_msg = f'Job did not process successfully for prompt_id: {prompt_id}'
+                        logging.error(error_msg)
+                        logging.info(f'{job_id}: Response JSON: {resp_json}')
+                        raise RuntimeError(error_msg)
+    except PromptRejectedError as e:
+        logging.error(f'HTTP Status code: {e.status_code}')
+        logging.error(e.content)
+        job_status = 'error'
+        error_class = f'http_{e.status_code}'
 
         return {
-            'error': traceback.format_exc(),
-            'refresh_worker': True
+            'error': f'HTTP status code: {e.status_code}',
+            'output': e.content
+        }
+    except Exception as e:
+        logging.error(f'An exception was raised: {e}')
+        job_status = 'error'
+        error_class = error_class or type(e).__name__
+        result = {
+            'error': traceback.format_exc()
         }
 
+        if should_refresh_worker(e):
+            result['refresh_worker'] = True
+
+        return result
+    finally:
+        if flight is not None and prompt_flights.release(flight):
+            delete_flight_outputs(flight)
+
+        input_cache.release(input_files)
+
+        metrics.inc('worker_jobs_in_flight', -1)
+        metrics.inc('worker_jobs_total', status=job_status)
+        metrics.observe('worker_job_duration_seconds', time.monotonic() - started_at)
+
+        if job_status == 'error':
+            metrics.inc('worker_job_errors_total', error_class=error_class)
+
+        if timer is not None:
+            timings = timer.get_timings()
+
+            for phase, seconds in timings['phases'].items():
+                metrics.observe('worker_phase_duration_seconds', seconds, phase=phase)
+
+            if TIMINGS_LOG_INTERVAL > 0:
+                timing_histograms.observe(timings)
+
+        flush_logs()
+        job_timer_context.reset(job_timer_token)
+        job_id_context.reset(job_id_token)
+
+
+async def async_handler(event):
+    # Run the blocking handler in a thread so that several jobs can be in progress at
+    # once, to_thread copies the current context so every job keeps its own job id
+    return await asyncio.to_thread(handler, event)
+
+
+"""
+Generator handler used when streaming outputs, the handler runs in its own
+thread and everything it publishes is yielded, followed by its result.
+"""
+def stream_handler(event):
+    updates = queue.Queue()
+
+    def run():
+        updates.put(('result', handler(event, lambda update: updates.put(('update', update)))))
+
+    threading.Thread(target=run, name='stream-handler', daemon=True).start()
+
+    while True:
+        kind, update = updates.get()
+
+        if kind == 'result' and update.get('error'):
+            update = get_stream_error(update)
+
+        yield update
+
+        if kind == 'result':
+            return
+
+
+"""
+runpod keeps nothing but the error of a failed streamed job and ignores its
+refresh_worker, which only works for plain handlers. The refresh is asked for
+through the worker config instead, which runpod checks once the job is done,
+and anything else the result carries is added to the error.
+"""
+def get_stream_error(result):
+    result = result.copy()
+
+    if result.pop('refresh_worker', False):
+        logging.warning('Refreshing the worker once the streamed job is done')
+        worker_config['refresh_worker'] = True
+
+    error = result.pop('error')
+
+    if result:
+        error = f'{error}\n{json.dumps(result, default=str)}'
+
+    return {
+        'error': error
+    }
+
+
+async def async_stream_handler(event):
+    updates = stream_handler(event)
+
+    # Wait for every update in a thread so that other jobs keep running meanwhile
+    while (update := await asyncio.to_thread(next, updates, None)) is not None:
+        yield update
+
+
+def concurrency_modifier(current_concurrency):
+    return JOB_CONCURRENCY
+
+
+def flush_logs():
+    for log_handler in logging.getLogger().handlers:
+        log_handler.flush()
+
+
+def start_metrics_server():
+    for log_handler in logging.getLogger().handlers:
+        if isinstance(log_handler, SnapLogHandler):
+            metrics.add_stats_source('worker_log', log_handler.get_stats)
+
+    metrics.add_stats_source('worker_input_cache', input_cache.get_stats)
+    metrics.add_stats_source('worker_result_cache', result_cache.get_stats)
+    metrics.add_stats_source('worker_prompt_flights', prompt_flights.get_stats)
+    metrics.add_stats_source('worker_graph_validator', graph_validator.get_stats)
+    metrics.add_stats_source('worker_resource_governor', resource_governor.get_stats)
+    metrics.add_stats_source('worker_workflows', workflow_registry.get_stats)
+    metrics.add_collector('comfys3', collect_comfyui_s3_transfers)
+    server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f'Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+    return server
+
 
 def setup_logging():
     root_logger = logging.getLogger()
@@ -432,12 +3399,41 @@ if __name__ == '__main__':
     session = requests.Session()
     retries = Retry(total=10, backoff_factor=0.1, status_forcelist=[502, 503, 504])
     session.mount('http://', HTTPAdapter(max_retries=retries))
+    download_session = requests.Session()
     setup_logging()
-    wait_for_service(url=f'{BASE_URI}/system_stats')
+
+    if METRICS_PORT > 0:
+        start_metrics_server()
+
+    supervisor = wait_for_service()
     logging.info('ComfyUI API is ready')
+
+    if VALIDATE_GRAPHS:
+        graph_validator.load(supervisor.object_info)
+
+    comfyui_events = ComfyUIEventListener(WS_URI, CLIENT_ID)
+    comfyui_events.start()
+    warm_encode_pool()
+    workflow_registry.load_all()
+    logging.info(f'Workflow templates loaded: {workflow_registry.get_stats()}')
+
+    if WARMUP:
+        run_warmup()
     logging.info('Starting RunPod Serverless...')
-    runpod.serverless.start(
-        {
-            'handler': handler
-        }
-    )
+
+    if JOB_CONCURRENCY > 1:
+        # Queue the next prompts into ComfyUI while earlier jobs are still being post-processed
+        worker_config.update({
+            'handler': async_stream_handler if STREAM_OUTPUTS else async_handler,
+            'concurrency_modifier': concurrency_modifier
+        })
+    else:
+        worker_config.update({
+            'handler': stream_handler if STREAM_OUTPUTS else handler
+        })
+
+    if STREAM_OUTPUTS:
+        # Each output is streamed as soon as its node has executed, /run still returns all of them
+        worker_config['return_aggregate_stream'] = True
+
+    runpod.serverless.start(worker_config)
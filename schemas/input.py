@@ -1,12 +1,11 @@
+from schemas.workflows import WORKFLOW_BINDINGS
+
 INPUT_SCHEMA = {
     'workflow': {
         'type': str,
         'required': False,
         'default': 'custom',
-        'constraints': lambda workflow: workflow in [
-            'txt2img',
-            'custom'
-        ]
+        'constraints': lambda workflow: workflow == 'custom' or workflow in WORKFLOW_BINDINGS
     },
     'callback': {
         'type': dict,
@@ -15,5 +14,98 @@ INPUT_SCHEMA = {
     'payload': {
         'type': dict,
         'required': True
+    },
+    'output': {
+        'type': dict,
+        'required': False,
+        'default': {}
+    },
+    # Return how long each phase of the job took
+    'timings': {
+        'type': bool,
+        'required': False,
+        'default': False
+    },
+    # Allow returning the stored result of an identical graph when the result cache is enabled
+    'cache': {
+        'type': bool,
+        'required': False,
+        'default': True
+    }
+}
+
+# Options for the returned images, anything not set falls back to the server-side default
+OUTPUT_SCHEMA = {
+    'format': {
+        'type': str,
+        'required': False,
+        'default': None,
+        'constraints': lambda image_format: image_format is None or image_format in [
+            'webp',
+            'png',
+            'jpeg',
+            'avif'
+        ]
+    },
+    'quality': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda quality: quality is None or 1 <= quality <= 100
+    },
+    'lossless': {
+        'type': bool,
+        'required': False,
+        'default': None
+    },
+    # Encoder effort from 0 (fastest) to 9 (smallest output)
+    'effort': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda effort: effort is None or 0 <= effort <= 9
+    },
+    'max_dimension': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda max_dimension: max_dimension is None or max_dimension > 0
+    },
+    # Return the files exactly as ComfyUI saved them without re-encoding
+    'passthrough': {
+        'type': bool,
+        'required': False,
+        'default': None
+    },
+    # Upload outputs larger than inline_max_bytes to S3 instead of returning them inline
+    'delivery': {
+        'type': str,
+        'required': False,
+        'default': None,
+        'constraints': lambda delivery: delivery is None or delivery in [
+            'inline',
+            's3'
+        ]
+    },
+    'inline_max_bytes': {
+        'type': int,
+        'required': False,
+        'default': None,
+        'constraints': lambda inline_max_bytes: inline_max_bytes is None or inline_max_bytes >= 0
+    },
+    'presign': {
+        'type': bool,
+        'required': False,
+        'default': None
+    },
+    # Read the images from disk, or capture them from the websocket without touching the disk
+    'capture': {
+        'type': str,
+        'required': False,
+        'default': None,
+        'constraints': lambda capture: capture is None or capture in [
+            'file',
+            'websocket'
+        ]
     }
 }
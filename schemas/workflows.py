@@ -0,0 +1,134 @@
+# Parameters accepted by each named workflow in /workflows. Every parameter is
+# validated like INPUT_SCHEMA and written to the node inputs listed in 'bind'
+# as (node id, input name) pairs. Optional parameters default to None, which
+# keeps the value from the workflow template.
+WORKFLOW_BINDINGS = {
+    'txt2img': {
+        'seed': {
+            'type': int,
+            'required': True,
+            'bind': [('3', 'seed')]
+        },
+        'steps': {
+            'type': int,
+            'required': True,
+            'constraints': lambda steps: steps > 0,
+            'bind': [('3', 'steps')]
+        },
+        'cfg_scale': {
+            'type': float,
+            'required': True,
+            'bind': [('3', 'cfg')]
+        },
+        'sampler_name': {
+            'type': str,
+            'required': True,
+            'bind': [('3', 'sampler_name')]
+        },
+        'ckpt_name': {
+            'type': str,
+            'required': True,
+            'bind': [('4', 'ckpt_name')]
+        },
+        'batch_size': {
+            'type': int,
+            'required': True,
+            'constraints': lambda batch_size: batch_size > 0,
+            'bind': [('5', 'batch_size')]
+        },
+        'width': {
+            'type': int,
+            'required': True,
+            'constraints': lambda width: width > 0,
+            'bind': [('5', 'width')]
+        },
+        'height': {
+            'type': int,
+            'required': True,
+            'constraints': lambda height: height > 0,
+            'bind': [('5', 'height')]
+        },
+        'prompt': {
+            'type': str,
+            'required': True,
+            'bind': [('6', 'text')]
+        },
+        'negative_prompt': {
+            'type': str,
+            'required': True,
+            'bind': [('7', 'text')]
+        }
+    },
+    'wan_2-2_lightning': {
+        'prompt': {
+            'type': str,
+            'required': False,
+            'default': None,
+            'bind': [('6', 'text')]
+        },
+        'negative_prompt': {
+            'type': str,
+            'required': False,
+            'default': None,
+            'bind': [('7', 'text')]
+        },
+        # Filename of the start image in the ComfyUI input directory
+        'image': {
+            'type': str,
+            'required': False,
+            'default': None,
+            'bind': [('52', 'image')]
+        },
+        'seed': {
+            'type': int,
+            'required': False,
+            'default': None,
+            'bind': [('164', 'value')]
+        },
+        'steps': {
+            'type': int,
+            'required': False,
+            'default': None,
+            'constraints': lambda steps: steps is None or steps > 0,
+            'bind': [('96', 'value')]
+        },
+        # Total pixels in kilo pixels: 231 (360p), 400 (480p), 594 (580p), 729 (640p), 922 (720p)
+        'resolution': {
+            'type': int,
+            'required': False,
+            'default': None,
+            'constraints': lambda resolution: resolution is None or resolution > 0,
+            'bind': [('183', 'value')]
+        },
+        # Number of frames at 16 fps: 49 (3s), 81 (5s)
+        'length': {
+            'type': int,
+            'required': False,
+            'default': None,
+            'constraints': lambda length: length is None or length > 0,
+            'bind': [('184', 'value')]
+        },
+        # Used to name the output files, set it to a unique value per request
+        'output_id': {
+            'type': int,
+            'required': False,
+            'default': None,
+            'bind': [('206', 'value'), ('218', 'value')]
+        }
+    }
+}
+
+# Minimal jobs queued at boot so that the models used by each workflow are
+# already loaded when the first request arrives. 'params' are applied like a
+# request payload, and 'exclude_nodes' are removed from the graph together
+# with every node depending on them (e.g. nodes uploading the results).
+WORKFLOW_WARMUP = {
+    'wan_2-2_lightning': {
+        'params': {
+            'steps': 1,
+            'resolution': 231,
+            'length': 5
+        },
+        'exclude_nodes': ['217']
+    }
+}
@@ -22,7 +22,10 @@ echo "Starting ComfyUI API"
 # export PYTHONUNBUFFERED=true
 export HF_HOME="/runpod-volume/huggingface"
 cd /comfyui
+# Let the handler time the startup phases and notice if ComfyUI exits early
+export COMFYUI_STARTED_AT="$(date +%s.%N)"
 python main.py --port 3000 > /comfyui-logs/comfyui-serverless.log 2>&1 &
+export COMFYUI_PID=$!
 # deactivate
 
 echo "Starting RunPod Handler"
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the output encoding stage: encodes N synthetic PNGs the way a
+finished prompt's outputs are encoded, once inline and once in the encode
+pool, and reports the per-image encode time and the total wall time.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from PIL import Image, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rp_handler
+
+"""
+Create a reproducible photo-like image: blurred seeded noise over a gradient,
+which compresses about as badly as a generated image does.
+"""
+def make_image(size, seed):
+    rng = random.Random(seed)
+    width, height = size
+    noise = Image.frombytes('RGB', size, rng.randbytes(width * height * 3)).filter(ImageFilter.GaussianBlur(2))
+    gradient = Image.linear_gradient('L').resize(size).convert('RGB')
+    return Image.blend(noise, gradient, 0.5)
+
+
+def make_corpus(output_dir, count, size):
+    filenames = []
+
+    for index in range(count):
+        filename = f'benchmark_{index:05}_.png'
+        make_image(size, index).save(f'{output_dir}/{filename}', compress_level=1)
+        filenames.append({'filename': filename, 'type': 'image'})
+
+    return filenames
+
+
+def run(all_filenames, policy, workers):
+    rp_handler.OUTPUT_ENCODE_WORKERS = workers
+    start = time.perf_counter()
+    images, _ = rp_handler.process_output_files(all_filenames, policy, delete=False)
+    return time.perf_counter() - start, sum(len(image['data']) for image in images)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=16)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--workers', type=int, default=min(8, os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as volume:
+        output_dir = f'{volume}/comfyui/output'
+        os.makedirs(output_dir)
+        rp_handler.VOLUME_MOUNT_PATH = volume
+        all_filenames = make_corpus(output_dir, args.count, (args.size, args.size))
+        policy = rp_handler.DEFAULT_OUTPUT_POLICY.copy()
+
+        encode_times = []
+
+        for file_info in all_filenames:
+            start = time.perf_counter()
+            rp_handler.encode_image(f'{output_dir}/{file_info["filename"]}', policy)
+            encode_times.append(time.perf_counter() - start)
+
+        print(f'{args.count} images of {args.size}x{args.size}, {os.cpu_count()} cpus')
+        print(f'per image encode: mean {sum(encode_times) / len(encode_times) * 1000:.1f} ms, '
+              f'max {max(encode_times) * 1000:.1f} ms')
+
+        inline_seconds, inline_bytes = run(all_filenames, policy, 1)
+        print(f'inline:             {inline_seconds:.2f} s, {inline_bytes} bytes')
+
+        if args.workers > 1:
+            # Spawn the workers first like the worker does at startup
+            rp_handler.OUTPUT_ENCODE_WORKERS = args.workers
+            rp_handler.warm_encode_pool()
+            pool = rp_handler.get_encode_pool()
+
+            for future in [pool.submit(os.getpid) for _ in range(args.workers)]:
+                future.result()
+
+            pool_seconds, pool_bytes = run(all_filenames, policy, args.workers)
+            print(f'pool of {args.workers} workers: {pool_seconds:.2f} s, {pool_bytes} bytes, '
+                  f'{inline_seconds / pool_seconds:.2f}x')
+            pool.shutdown()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark of GraphValidator: compiles node definitions built from the Wan
+2.2 workflow plus filler node types, then validates the workflow and each
+of the broken variants in BROKEN_GRAPHS.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rp_handler
+
+WAN_WORKFLOW = os.path.join(ROOT, 'workflows', 'wan_2-2_lightning.json')
+OUTPUT_NODES = {'VHS_VideoCombine', 'SaveVideoFilesS3', 'SaveText|pysssss'}
+
+
+def load_wan_workflow():
+    with open(WAN_WORKFLOW, 'r') as json_file:
+        return json.load(json_file)
+
+
+"""
+/object_info for the node types of a workflow: the inputs every node of a
+type sets are required and a type has as many outputs as its links use.
+"""
+def make_object_info(workflow, filler=0):
+    object_info = {}
+
+    for node in workflow.values():
+        info = object_info.setdefault(node['class_type'], {
+            'input': {'required': {input_name: ['*'] for input_name in node['inputs']}},
+            'output': ['*'],
+            'output_node': node['class_type'] in OUTPUT_NODES
+        })
+        required = info['input']['required']
+
+        for input_name in list(required):
+            if input_name not in node['inputs']:
+                del required[input_name]
+
+    for node in workflow.values():
+        for value in node['inputs'].values():
+            if isinstance(value, list):
+                outputs = object_info[workflow[value[0]]['class_type']]['output']
+                outputs.extend(['*'] * (value[1] + 1 - len(outputs)))
+
+    for index in range(filler):
+        object_info[f'FillerNode{index}'] = {
+            'input': {'required': {'value': ['INT'], 'text': ['STRING']}, 'optional': {'seed': ['INT']}},
+            'output': ['INT', 'STRING'],
+            'output_node': False
+        }
+
+    return object_info
+
+
+def set_input(node_id, input_name, value):
+    def mutate(graph):
+        graph[node_id]['inputs'][input_name] = value
+
+    return mutate
+
+
+# Broken variants of the Wan workflow, with the problem the validator must report
+BROKEN_GRAPHS = [
+    ('unknown class', lambda graph: graph['8'].update(class_type='VAEDecodeFast'), 'Node 8 has an unknown class_type: VAEDecodeFast'),
+    ('missing input', lambda graph: graph['8']['inputs'].pop('vae'), 'Node 8 (VAEDecode) is missing the required input: vae'),
+    ('missing node', set_input('8', 'vae', ['999', 0]), 'Node 8 input vae is linked to a missing node: 999'),
+    ('int node id', set_input('8', 'vae', [39, 0]), 'Node 8 input vae is linked to a missing node: 39'),
+    ('bad output index', set_input('8', 'vae', ['39', 5]), 'Node 8 input vae is linked to a missing output: 39.5'),
+    ('short link', set_input('8', 'vae', ['39']), "Node 8 input vae is not a valid link: ['39']"),
+    ('bool index', set_input('8', 'vae', ['39', True]), "Node 8 input vae is not a valid link: ['39', True]"),
+    ('missing inputs', lambda graph: graph['8'].pop('inputs'), 'Node 8 must be an object with an inputs object'),
+    ('non-object node', lambda graph: graph.update({'8': 'VAEDecode'}), 'Node 8 must be an object with an inputs object'),
+    ('no output node', lambda graph: rp_handler.remove_nodes(graph, ['93', '215']), 'Graph has no output node'),
+    ('deleted source node', lambda graph: graph.pop('39'), 'Node 8 input vae is linked to a missing node: 39')
+]
+
+
+def make_broken_graph(workflow, mutate):
+    graph = copy.deepcopy(workflow)
+    mutate(graph)
+    return graph
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        result = function()
+
+    return (time.perf_counter() - start) / repeat * 1e6, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filler', type=int, default=800)
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+    workflow = load_wan_workflow()
+    object_info = make_object_info(workflow, args.filler)
+    validator = rp_handler.GraphValidator()
+
+    seconds, _ = measure(lambda: validator.load(object_info), 10)
+    print(f'compiling {len(object_info)} node types {seconds / 1000:8.2f} ms')
+
+    seconds, errors = measure(lambda: validator.validate(workflow), args.repeat)
+    print(f'{len(workflow)}-node Wan workflow {seconds:12.1f} us, {len(errors)} errors')
+
+    for name, mutate, expected in BROKEN_GRAPHS:
+        graph = make_broken_graph(workflow, mutate)
+        seconds, errors = measure(lambda: validator.validate(graph), args.repeat)
+        print(f'  {name:22} {seconds:8.1f} us, {"rejected" if expected in errors else "NOT REJECTED"}')
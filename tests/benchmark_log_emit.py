@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Benchmark of SnapLogHandler.emit: logs records with the log API enabled and
+stdout discarded, through the emit the handler had before the records were
+pre-rendered and through the current one, then serialises the queued
+records into one batch body the way each shipper does.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The shipper only wakes up when asked to, so nothing is sent while measuring
+os.environ.update({
+    'LOG_API_ENDPOINT': 'http://127.0.0.1:9/logs',
+    'LOG_API_BATCH_SIZE': '10000000',
+    'LOG_API_QUEUE_SIZE': '10000000',
+    'LOG_API_FLUSH_INTERVAL': '3600'
+})
+
+import rp_handler
+
+RUNPOD_FIELDS = [
+    'endpoint_id', 'cpu_count', 'pod_id', 'gpu_size', 'mem_gb', 'gpu_count',
+    'volume_id', 'pod_hostname', 'debug_level', 'dc_id', 'gpu_name'
+]
+
+
+class LegacySnapLogHandler(rp_handler.SnapLogHandler):
+    """
+    The emit of the handler before the records were pre-rendered, queueing
+    one dict per record that the shipper serialises with the whole batch.
+    """
+    def __init__(self, app_name):
+        super().__init__(app_name)
+
+        for field in RUNPOD_FIELDS:
+            setattr(self, f'runpod_{field}', os.getenv(f'RUNPOD_{field.upper()}'))
+
+    def emit(self, record):
+        runpod_job_id = rp_handler.job_id_context.get()
+
+        try:
+            if hasattr(record, 'msg') and hasattr(record, 'args'):
+                if record.args:
+                    if isinstance(record.args, dict):
+                        message = record.msg % record.args if '%' in str(record.msg) else record.msg
+                    else:
+                        message = str(record.msg) % record.args if '%' in str(record.msg) else record.msg
+                else:
+                    message = record.msg
+            else:
+                message = str(record)
+
+            if len(message) <= 1000:
+                level_mapping = {
+                    logging.DEBUG: self.rp_logger.debug,
+                    logging.INFO: self.rp_logger.info,
+                    logging.WARNING: self.rp_logger.warn,
+                    logging.ERROR: self.rp_logger.error,
+                    logging.CRITICAL: self.rp_logger.error
+                }
+                rp_logger = level_mapping.get(record.levelno, self.rp_logger.info)
+
+                if runpod_job_id:
+                    rp_logger(message, runpod_job_id)
+                else:
+                    rp_logger(message)
+
+            if self.log_api_endpoint:
+                log_payload = {
+                    'app_name': self.app_name,
+                    'log_asctime': self.formatter.formatTime(record),
+                    'log_levelname': record.levelname,
+                    'log_message': message
+                }
+                log_payload.update({f'runpod_{field}': getattr(self, f'runpod_{field}') for field in RUNPOD_FIELDS})
+                log_payload['runpod_job_id'] = runpod_job_id
+
+                with self.log_condition:
+                    self.log_queue.append(log_payload)
+        except Exception as e:
+            self.rp_logger.error(f'Error in log formatting: {str(e)}')
+
+
+def make_records(levelno, count):
+    return [
+        logging.LogRecord('benchmark', levelno, __file__, 0, f'Polling status of prompt {index}: "running"', None, None)
+        for index in range(count)
+    ]
+
+
+def measure_emit(log_handler, records):
+    log_handler.log_queue.clear()
+    start = time.perf_counter()
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for record in records:
+            log_handler.emit(record)
+
+    return (time.perf_counter() - start) / len(records) * 1e6
+
+
+def measure_batch(log_handler, serialise):
+    batch = list(log_handler.log_queue)
+    start = time.perf_counter()
+    serialise(batch)
+    return (time.perf_counter() - start) / len(batch) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+    rp_handler.job_id_context.set('benchmark-job')
+    handlers = {'before': LegacySnapLogHandler('benchmark'), 'after': rp_handler.SnapLogHandler('benchmark')}
+    serialisers = {
+        'before': lambda batch: json.dumps(batch).encode('utf-8'),
+        'after': lambda batch: f'[{",".join(batch)}]'.encode('utf-8')
+    }
+    print(f'{args.count} records, LOG_LEVEL={rp_handler.LOG_LEVEL}')
+    print(f'{"":32} {"before":>12} {"after":>12}')
+
+    for handler in handlers.values():
+        handler.setFormatter(logging.Formatter())
+
+    for label, levelno in (('INFO, printed and queued', logging.INFO), ('DEBUG, queued', logging.DEBUG)):
+        records = make_records(levelno, args.count)
+        emit = {name: measure_emit(handler, records) for name, handler in handlers.items()}
+        print(f'{label:32} {emit["before"]:6.2f} us/rec {emit["after"]:6.2f} us/rec')
+
+    batch = {name: measure_batch(handler, serialisers[name]) for name, handler in handlers.items()}
+    print(f'{"batch body":32} {batch["before"]:6.2f} us/rec {batch["after"]:6.2f} us/rec')
+
+    # Nothing is left for the handlers to ship at exit
+    for handler in handlers.values():
+        handler.log_queue.clear()
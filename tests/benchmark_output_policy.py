@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the output policies: encodes a fixed corpus of reproducible
+images with each codec and setting, and reports the encoded bytes and the
+encode time per image.
+"""
+import io
+import os
+import sys
+import time
+import argparse
+from PIL import Image, ImageDraw
+from benchmark_encode_pool import make_image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rp_handler
+
+SETTINGS = [
+    ('webp default', {}),
+    ('webp q95', {'quality': 95}),
+    ('webp q90 effort 0', {'quality': 90, 'effort': 0}),
+    ('webp q90 effort 4', {'quality': 90, 'effort': 4}),
+    ('webp q90 effort 6', {'quality': 90, 'effort': 6}),
+    ('webp lossless', {'lossless': True, 'effort': 0}),
+    ('png effort 1', {'format': 'png', 'effort': 1}),
+    ('png effort 6', {'format': 'png', 'effort': 6}),
+    ('jpeg q95', {'format': 'jpeg', 'quality': 95}),
+    ('jpeg q85 optimize', {'format': 'jpeg', 'quality': 85, 'effort': 5}),
+    ('avif q80', {'format': 'avif', 'quality': 80}),
+    ('avif q60 effort 2', {'format': 'avif', 'quality': 60, 'effort': 2}),
+    ('passthrough', {'passthrough': True}),
+    ('max 512 webp', {'max_dimension': 512})
+]
+
+
+def make_graphic(size):
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+
+    for index in range(0, size[0], 64):
+        draw.rectangle((index, index // 2, index + 48, index // 2 + 96), fill=(index % 256, 80, 160))
+        draw.text((index, size[1] - 40), 'caption', fill='black')
+
+    return image
+
+
+"""
+PNG bytes of the corpus, saved the way ComfyUI saves its outputs.
+"""
+def make_corpus():
+    corpus = {
+        'photo 512': make_image((512, 512), 1),
+        'photo 1024': make_image((1024, 1024), 2),
+        'photo 1536x864': make_image((1536, 864), 3),
+        'graphic 1024': make_graphic((1024, 1024))
+    }
+
+    for name, image in corpus.items():
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=4)
+        corpus[name] = buffer.getvalue()
+
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    corpus = make_corpus()
+    Image.init()
+
+    print(f'{"setting":20} ' + ' '.join(f'{name:>22}' for name in corpus))
+
+    for setting, options in SETTINGS:
+        policy, errors = rp_handler.get_output_policy(options)
+
+        if errors:
+            print(f'{setting:20} skipped: {errors[0]}')
+            continue
+
+        cells = []
+
+        for data in corpus.values():
+            start = time.perf_counter()
+
+            for _ in range(args.repeat):
+                encoded = rp_handler.encode_image(data, policy)
+
+            milliseconds = (time.perf_counter() - start) / args.repeat * 1000
+            cells.append(f'{len(encoded) / 1024:8.0f} KB {milliseconds:7.1f} ms')
+
+        print(f'{setting:20} ' + ' '.join(f'{cell:>22}' for cell in cells))
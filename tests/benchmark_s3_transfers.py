@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the comfys3 transfers: uploads and downloads one large file
+with boto3's default transfer settings and with the tuned TRANSFER_CONFIG,
+then a batch of small files one after the other and with upload_many and
+download_many. Runs against the bucket configured by the S3_* variables, or
+an in-process moto bucket with --moto, which only measures the client side.
+"""
+import os
+import sys
+import time
+import pathlib
+import argparse
+import tempfile
+import boto3
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from conftest import load_comfys3
+
+MB = 1024 * 1024
+
+
+def timed_transfer(label, size, function):
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    print(f'{label:40} {seconds:7.2f} s {size / seconds / MB:8.1f} MiB/s')
+
+
+def run(s3_client, work_dir, args):
+    s3 = s3_client.get_s3_instance()
+    client = s3.s3_client
+    bucket = s3.bucket_name
+    big_file = f'{work_dir}/big.bin'
+
+    with open(big_file, 'wb') as f:
+        for _ in range(args.size_mb):
+            f.write(os.urandom(MB))
+
+    size = args.size_mb * MB
+    print(f'{args.size_mb} MiB file')
+
+    for label, config in (('default TransferConfig', TransferConfig()), ('tuned TRANSFER_CONFIG', s3_client.TRANSFER_CONFIG)):
+        timed_transfer(f'  upload, {label}', size,
+                       lambda: client.upload_file(big_file, bucket, 'benchmark/big.bin', Config=config))
+        timed_transfer(f'  download, {label}', size,
+                       lambda: client.download_file(bucket, 'benchmark/big.bin', f'{work_dir}/big.copy', Config=config))
+
+    small_files = []
+
+    for index in range(args.count):
+        path = f'{work_dir}/small_{index}.bin'
+
+        with open(path, 'wb') as f:
+            f.write(os.urandom(args.small_kb * 1024))
+
+        small_files.append(path)
+
+    size = args.count * args.small_kb * 1024
+    uploads = [(path, f'benchmark/{os.path.basename(path)}') for path in small_files]
+    downloads = [(key, f'{work_dir}/copies/{os.path.basename(key)}') for _, key in uploads]
+    print(f'{args.count} files of {args.small_kb} KiB, {s3_client.S3_BATCH_WORKERS} batch workers')
+    timed_transfer('  upload one by one', size, lambda: [s3.upload_file(*upload) for upload in uploads])
+    timed_transfer('  upload_many', size, lambda: s3.upload_many(uploads))
+    timed_transfer('  download one by one', size, lambda: [s3.download_file(*download) for download in downloads])
+    timed_transfer('  download_many', size, lambda: s3.download_many(downloads))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--small-kb', type=int, default=256)
+    parser.add_argument('--moto', action='store_true')
+    args = parser.parse_args()
+    monkeypatch = pytest.MonkeyPatch()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.moto:
+            import moto
+
+            for name in ('S3_ACCESS_KEY', 'S3_SECRET_KEY', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+                monkeypatch.setenv(name, 'testing')
+
+            monkeypatch.setenv('S3_REGION', 'us-east-1')
+            monkeypatch.setenv('S3_BUCKET_NAME', 'comfys3')
+            monkeypatch.delenv('S3_ENDPOINT_URL', raising=False)
+
+            with moto.mock_aws():
+                boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='comfys3')
+                run(load_comfys3(pathlib.Path(tempfile.mkdtemp(dir=work_dir)), monkeypatch), work_dir, args)
+        else:
+            run(load_comfys3(pathlib.Path(tempfile.mkdtemp(dir=work_dir)), monkeypatch), work_dir, args)
+
+    monkeypatch.undo()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark of SaveImageWebsocket: converts batches of CPU (or --device) image
+tensors to uint8 the way the node did per image and the way it does now in
+chunks, then encodes one frame in every websocket format. Needs torch and a
+ComfyUI install for the node's imports, as found in the worker image.
+"""
+import os
+import sys
+import time
+import argparse
+import importlib.util
+import numpy as np
+
+NODE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'comfyui', 'custom_nodes', 'websocket_image_save.py')
+BATCHES = [(4, 1024, 1024), (16, 1024, 1024), (81, 480, 480)]
+
+
+def load_node(comfyui_path):
+    sys.path.insert(0, comfyui_path)
+    spec = importlib.util.spec_from_file_location('websocket_image_save', NODE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def convert_per_image(images):
+    # What the node did before converting batches at once
+    return [np.clip(255. * image.cpu().numpy(), 0, 255).astype(np.uint8) for image in images]
+
+
+def measure(function, images, torch, repeat):
+    function(images)
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        function(images)
+
+        if images.is_cuda:
+            torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comfyui', default='/comfyui')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    node_module = load_node(args.comfyui)
+
+    import torch
+
+    node = node_module.SaveImageWebsocket()
+    generator = torch.Generator().manual_seed(0)
+    print(f'{"batch":16} {"per image":>12} {"chunked":>12}')
+
+    for count, height, width in BATCHES:
+        images = torch.rand((count, height, width, 3), generator=generator).to(args.device)
+        per_image = measure(convert_per_image, images, torch, args.repeat)
+        chunked = measure(node.to_uint8, images, torch, args.repeat)
+        print(f'{count}x{height}x{width:<8} {per_image:9.1f} ms {chunked:9.1f} ms')
+
+    frame = node.to_uint8(torch.rand((1, 1024, 1024, 3), generator=generator).to(args.device))[0].copy()
+    print(f'\n{"format":8} {"encode":>10} {"bytes":>10}')
+
+    for image_format in node_module.IMAGE_FORMATS:
+        start = time.perf_counter()
+
+        for _ in range(args.repeat):
+            message = node.encode(frame, image_format, 95)
+
+        milliseconds = (time.perf_counter() - start) / args.repeat * 1000
+        print(f'{image_format:8} {milliseconds:7.1f} ms {len(message) / 1024 / 1024:6.2f} MiB')
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the per-job workflow preparation: reads and parses the template
+on every job the way the worker used to, then copies it from the
+WorkflowRegistry, and gives every copy unique output names as a job does.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import rp_handler
+
+
+def load_from_disk(workflows_dir, workflow_name):
+    # What get_workflow_payload did before the templates were kept in memory
+    with open(f'{workflows_dir}/{workflow_name}.json', 'r') as json_file:
+        return json.load(json_file)
+
+
+def measure(function, repeat):
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        rp_handler.create_unique_filename_prefix(function())
+
+    return (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workflows', default=os.path.join(ROOT, 'workflows'))
+    parser.add_argument('--workflow', default='wan_2-2_lightning')
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+    registry = rp_handler.WorkflowRegistry(args.workflows)
+    registry.load_all()
+
+    from_disk = measure(lambda: load_from_disk(args.workflows, args.workflow), args.repeat)
+    from_registry = measure(lambda: registry.get(args.workflow), args.repeat)
+
+    print(f'{args.workflow}, {args.repeat} jobs')
+    print(f'  json.load per job   {from_disk:8.1f} ms')
+    print(f'  WorkflowRegistry    {from_registry:8.1f} ms')
+    print(f'  registry stats      {registry.get_stats()}')
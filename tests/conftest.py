@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import importlib
+import boto3
+import moto
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import rp_handler
+from fake_comfyui import FakeComfyUI
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError('Condition was not met in time')
+
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def fake_comfyui(tmp_path):
+    output_dir = tmp_path / 'comfyui' / 'output'
+    output_dir.mkdir(parents=True)
+    fake = FakeComfyUI(str(output_dir)).start()
+    yield fake
+    fake.stop()
+
+
+"""
+Point the handler at a fake ComfyUI, with its own websocket listener and the
+output directory inside tmp_path.
+"""
+@pytest.fixture
+def comfyui(fake_comfyui, tmp_path, monkeypatch):
+    client_id = str(uuid.uuid4())
+    monkeypatch.setattr(rp_handler, 'BASE_URI', fake_comfyui.base_uri)
+    monkeypatch.setattr(rp_handler, 'CLIENT_ID', client_id)
+    monkeypatch.setattr(rp_handler, 'VOLUME_MOUNT_PATH', str(tmp_path))
+    monkeypatch.setattr(rp_handler, 'WS_RECONNECT_DELAY', 0.1, raising=False)
+    monkeypatch.setattr(rp_handler, 'session', requests.Session(), raising=False)
+    events = rp_handler.ComfyUIEventListener(fake_comfyui.ws_uri, client_id)
+    monkeypatch.setattr(rp_handler, 'comfyui_events', events, raising=False)
+    events.start()
+    wait_until(lambda: events.snapshot() is not None)
+    return fake_comfyui
+
+
+"""
+Import a fresh copy of comfys3's s3_client, as a package of its own with a
+stand-in for the logger module that comes with the comfys3 node.
+"""
+def load_comfys3(tmp_path, monkeypatch):
+    name = f'comfys3_{uuid.uuid4().hex}'
+    package = tmp_path / name
+    package.mkdir()
+    shutil.copy(f'{os.path.dirname(rp_handler.__file__)}/comfyui/custom_nodes/comfys3/s3_client.py', package)
+    (package / '__init__.py').write_text('')
+    (package / 'logger.py').write_text('import logging\nlogger = logging.getLogger("comfys3")\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return importlib.import_module(f'{name}.s3_client')
+
+
+"""
+comfys3's s3_client configured for a bucket of a local moto S3.
+"""
+@pytest.fixture
+def comfys3(tmp_path, monkeypatch):
+    for name, value in {
+        'S3_REGION': 'us-east-1',
+        'S3_ACCESS_KEY': 'testing',
+        'S3_SECRET_KEY': 'testing',
+        'S3_BUCKET_NAME': 'comfys3',
+        'S3_INPUT_DIR': 'input',
+        'S3_OUTPUT_DIR': 'output',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing'
+    }.items():
+        monkeypatch.setenv(name, value)
+
+    monkeypatch.delenv('S3_ENDPOINT_URL', raising=False)
+
+    with moto.mock_aws():
+        boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='comfys3')
+        yield load_comfys3(tmp_path, monkeypatch)
@@ -0,0 +1,261 @@
+import uuid
+import socket
+import asyncio
+import threading
+from aiohttp import web, WSMsgType
+from PIL import Image
+
+class FakeComfyUI:
+    """
+    A stand-in for the ComfyUI API that runs in a background thread, so that
+    the worker can be exercised without a GPU. It serves the endpoints the
+    worker uses and "executes" prompts by walking their nodes in order,
+    sending the same websocket events as ComfyUI, one prompt at a time.
+    SaveImage nodes write a PNG of image_size pixels to the output directory
+    and SaveText|pysssss nodes write their text. A node type listed in errors
+    fails with that execution_error, and while reject is set to a (status,
+    body) tuple every prompt is rejected. The next responses of a route, like
+    '/history/{prompt_id}', are held back by the seconds listed in
+    response_delays[route] after the request has been handled, and prompts
+    deleted from the queue or interrupted stop before their next node.
+    """
+    def __init__(self, output_dir, node_delay=0.01, image_size=64):
+        self.output_dir = output_dir
+        self.node_delay = node_delay
+        self.image_size = image_size
+        self.errors = {}
+        self.reject = None
+        self.s3_transfers = None
+        self.response_delays = {}
+        self.cancelled = set()
+        self.object_info = {}
+        self.websocket_enabled = True
+        self.prompts = []
+        self.history = {}
+        self.history_requests = 0
+        self.requests = []
+        self.sockets = {}
+        self.loop = asyncio.new_event_loop()
+        self.execution_lock = None
+        self.runner = None
+        self.port = None
+
+    @property
+    def base_uri(self):
+        return f'http://127.0.0.1:{self.port}'
+
+    @property
+    def ws_uri(self):
+        return f'ws://127.0.0.1:{self.port}'
+
+    def start(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+
+        threading.Thread(target=self.loop.run_forever, name='fake-comfyui', daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result(5)
+        return self
+
+    def stop(self):
+        # Open websockets would otherwise hold up the shutdown
+        self.drop_websockets()
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def drop_websockets(self):
+        """
+        Close every websocket and refuse new ones until websocket_enabled is set again.
+        """
+        self.websocket_enabled = False
+        asyncio.run_coroutine_threadsafe(self._close_sockets(), self.loop).result(5)
+
+    def count_requests(self, method, path):
+        return sum(1 for request in self.requests if request == (method, path))
+
+    async def _start(self):
+        self.execution_lock = asyncio.Lock()
+        app = web.Application()
+        app.router.add_get('/ws', self._ws)
+        app.router.add_post('/prompt', self._prompt)
+        app.router.add_get('/history/{prompt_id}', self._get_history)
+        app.router.add_post('/history', self._delete_history)
+        app.router.add_get('/system_stats', self._system_stats)
+        app.router.add_get('/queue', self._queue)
+        app.router.add_post('/queue', self._delete)
+        app.router.add_post('/interrupt', self._interrupt)
+        app.router.add_post('/free', self._ok)
+        app.router.add_get('/object_info', self._object_info)
+        app.router.add_get('/comfys3/stats', self._comfys3_stats)
+        app.middlewares.append(self._record)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+
+    @web.middleware
+    async def _record(self, request, handler):
+        self.requests.append((request.method, request.path))
+        response = await handler(request)
+        delays = self.response_delays.get(request.match_info.route.resource.canonical)
+
+        if delays:
+            await asyncio.sleep(delays.pop(0))
+
+        return response
+
+    async def _close_sockets(self):
+        for ws in list(self.sockets.values()):
+            await ws.close()
+
+    async def _ws(self, request):
+        if not self.websocket_enabled:
+            raise web.HTTPServiceUnavailable()
+
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get('clientId')
+        self.sockets[client_id] = ws
+        await ws.send_json({'type': 'status', 'data': {'status': {'exec_info': {'queue_remaining': 0}}, 'sid': client_id}})
+
+        async for message in ws:
+            if message.type == WSMsgType.ERROR:
+                break
+
+        if self.sockets.get(client_id) is ws:
+            del self.sockets[client_id]
+
+        return ws
+
+    async def _send(self, client_id, event_type, data):
+        ws = self.sockets.get(client_id)
+
+        if ws is not None and not ws.closed:
+            await ws.send_json({'type': event_type, 'data': data})
+
+    async def _prompt(self, request):
+        body = await request.json()
+
+        if self.reject is not None:
+            return web.json_response(self.reject[1], status=self.reject[0])
+
+        prompt_id = body.get('prompt_id') or str(uuid.uuid4())
+        self.prompts.append(body)
+        asyncio.ensure_future(self._execute(prompt_id, body['prompt'], body.get('client_id')))
+        return web.json_response({'prompt_id': prompt_id, 'number': len(self.prompts), 'node_errors': {}})
+
+    async def _execute(self, prompt_id, prompt, client_id):
+        async with self.execution_lock:
+            await self._run_prompt(prompt_id, prompt, client_id)
+
+    async def _run_prompt(self, prompt_id, prompt, client_id):
+        await self._send(client_id, 'execution_start', {'prompt_id': prompt_id})
+        outputs = {}
+        messages = []
+
+        for node_id, node in prompt.items():
+            await asyncio.sleep(self.node_delay)
+
+            if prompt_id in self.cancelled:
+                return
+
+            class_type = node['class_type']
+            await self._send(client_id, 'executing', {'node': node_id, 'prompt_id': prompt_id})
+
+            if class_type in self.errors:
+                error = dict(self.errors[class_type], prompt_id=prompt_id, node_id=node_id, node_type=class_type)
+                messages.append(['execution_error', error])
+                await self._send(client_id, 'execution_error', error)
+                break
+
+            output = self._run_node(node_id, node)
+
+            if output is not None:
+                outputs[node_id] = output
+                await self._send(client_id, 'executed', {'node': node_id, 'output': output, 'prompt_id': prompt_id})
+
+        if not messages:
+            messages.append(['execution_success', {'prompt_id': prompt_id}])
+            await self._send(client_id, 'execution_success', {'prompt_id': prompt_id})
+
+        # Like ComfyUI the history is written before the final executing event
+        self.history[prompt_id] = {
+            'prompt': [len(self.prompts), prompt_id, prompt, {}, list(outputs)],
+            'outputs': outputs,
+            'status': {
+                'status_str': 'error' if messages[-1][0] == 'execution_error' else 'success',
+                'completed': messages[-1][0] == 'execution_success',
+                'messages': messages
+            }
+        }
+        await self._send(client_id, 'executing', {'node': None, 'prompt_id': prompt_id})
+
+    def _run_node(self, node_id, node):
+        inputs = node['inputs']
+
+        if node['class_type'] == 'SaveImage':
+            filename = f'{inputs["filename_prefix"]}_00001_.png'
+            Image.new('RGB', (self.image_size, self.image_size), 'red').save(f'{self.output_dir}/{filename}')
+            return {'images': [{'filename': filename, 'subfolder': '', 'type': 'output'}]}
+
+        if node['class_type'] == 'SaveText|pysssss':
+            with open(f'{self.output_dir}/{inputs["file"]}', 'w') as f:
+                f.write(inputs['text'])
+
+            return {'texts': [{'filename': inputs['file'], 'subfolder': '', 'type': 'output'}]}
+
+        return None
+
+    async def _get_history(self, request):
+        self.history_requests += 1
+        prompt_id = request.match_info['prompt_id']
+
+        if prompt_id not in self.history:
+            return web.json_response({})
+
+        return web.json_response({prompt_id: self.history[prompt_id]})
+
+    async def _delete_history(self, request):
+        body = await request.json()
+
+        for prompt_id in body.get('delete', []):
+            self.history.pop(prompt_id, None)
+
+        return web.Response()
+
+    async def _system_stats(self, request):
+        return web.json_response({
+            'system': {'os': 'posix', 'ram_total': 64 * 1024 ** 3, 'ram_free': 60 * 1024 ** 3},
+            'devices': [{
+                'name': 'cuda:0 fake',
+                'type': 'cuda',
+                'index': 0,
+                'vram_total': 24 * 1024 ** 3,
+                'vram_free': 22 * 1024 ** 3
+            }]
+        })
+
+    async def _queue(self, request):
+        return web.json_response({'queue_running': [], 'queue_pending': []})
+
+    async def _object_info(self, request):
+        return web.json_response(self.object_info)
+
+    async def _comfys3_stats(self, request):
+        # Like ComfyUI without comfys3 loaded when no transfers are set
+        if self.s3_transfers is None:
+            raise web.HTTPNotFound()
+
+        return web.json_response(self.s3_transfers)
+
+    async def _delete(self, request):
+        body = await request.json()
+        self.cancelled.update(body.get('delete', []))
+        return web.Response()
+
+    async def _interrupt(self, request):
+        body = await request.json()
+        self.cancelled.add(body.get('prompt_id'))
+        return web.Response()
+
+    async def _ok(self, request):
+        return web.Response()
@@ -0,0 +1,141 @@
+import os
+import time
+import runpy
+import uuid
+import threading
+import collections
+import boto3
+from moto.core import DEFAULT_ACCOUNT_ID
+from moto.s3.models import s3_backends
+from dotenv import dotenv_values
+import rp_handler
+from conftest import load_comfys3
+
+
+def test_transfers_through_one_shared_client(comfys3, tmp_path):
+    s3 = comfys3.get_s3_instance()
+    sources = []
+
+    for index in range(8):
+        source = tmp_path / f'source_{index}.txt'
+        source.write_text(f'file {index}')
+        sources.append(source)
+
+    uploaded = s3.upload_many([(str(source), f'output/{source.name}') for source in sources])
+    downloaded = s3.download_many([(key, str(tmp_path / 'copies' / f'copy_{index}.txt')) for index, key in enumerate(uploaded)])
+
+    assert comfys3.get_s3_instance() is s3
+    assert not hasattr(s3.s3_client, 'Bucket')
+    assert uploaded == [f'output/source_{index}.txt' for index in range(8)]
+    assert [open(path).read() for path in downloaded] == [f'file {index}' for index in range(8)]
+    assert s3.get_files('output/') == [f'source_{index}.txt' for index in range(8)]
+    assert s3.upload_bytes(b'data', 'output/data.bin') == 'output/data.bin'
+    assert 'output/data.bin' in s3.get_presigned_url('output/data.bin')
+
+
+def test_handler_observes_transfers_once(comfys3, monkeypatch):
+    get_s3_instance = comfys3.get_s3_instance
+
+    def slow_get_s3_instance():
+        time.sleep(0.05)
+        return get_s3_instance()
+
+    monkeypatch.setattr(comfys3, 'get_s3_instance', slow_get_s3_instance)
+    monkeypatch.setattr(rp_handler, 'import_comfys3_module', lambda name: comfys3)
+    monkeypatch.setattr(rp_handler, 's3', None)
+    threads = [threading.Thread(target=rp_handler.get_s3) for _ in range(4)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert comfys3._transfer_observers == [rp_handler.observe_s3_transfer]
+
+
+def count_requests(s3):
+    counts = collections.Counter()
+    s3.s3_client.meta.events.register('before-call.s3.*', lambda model, **kwargs: counts.update([model.name]))
+    return counts
+
+
+def save_batch(s3, tmp_path, save_path, contents):
+    # Like the comfys3 nodes, which number the files of a batch from the counter they got
+    folder, filename, counter, _, _ = save_path
+    keys = []
+
+    for index, content in enumerate(contents):
+        local_path = tmp_path / f'{uuid.uuid4()}.png'
+        local_path.write_text(content)
+        keys.append(s3.upload_file(str(local_path), os.path.join(folder, f'{filename}_{counter + index:05}_.png')))
+
+    return keys
+
+
+def test_get_save_path_lists_the_bucket_once(comfys3, tmp_path):
+    # Straight into the moto backend, as 10k put_object calls take half a minute
+    backend = s3_backends[DEFAULT_ACCOUNT_ID]['aws']
+
+    for index in range(10000):
+        backend.put_object('comfys3', f'output/other/file_{index:05}_.png', b'')
+
+    s3 = comfys3.get_s3_instance()
+    counts = count_requests(s3)
+
+    assert s3.get_save_path('ComfyUI')[2] == 1
+    assert counts['ListObjectsV2'] == 2
+
+    counts.clear()
+
+    assert [s3.get_save_path('ComfyUI')[2] for _ in range(5)] == [2, 3, 4, 5, 6]
+    assert counts['ListObjectsV2'] == 0
+
+
+def test_follows_the_numbering_of_batches(comfys3, tmp_path):
+    s3 = comfys3.get_s3_instance()
+
+    first = save_batch(s3, tmp_path, s3.get_save_path('ComfyUI'), ['a', 'b', 'c'])
+    second = save_batch(s3, tmp_path, s3.get_save_path('ComfyUI'), ['d'])
+
+    assert first + second == [f'output/ComfyUI_{counter:05}_.png' for counter in (1, 2, 3, 4)]
+
+
+def test_workers_sharing_the_output_folder_never_overwrite_each_other(comfys3, tmp_path):
+    client = boto3.client('s3', region_name='us-east-1')
+    client.put_object(Bucket='comfys3', Key='output/ComfyUI_00005_.png', Body=b'existing')
+    workers = [
+        comfys3.S3('us-east-1', 'testing', 'testing', 'comfys3', None)
+        for _ in range(2)
+    ]
+
+    # Both workers seed their counter before either has saved
+    save_paths = [worker.get_save_path('ComfyUI') for worker in workers]
+    assert [save_path[2] for save_path in save_paths] == [6, 6]
+
+    keys = [
+        save_batch(worker, tmp_path, save_path, [f'worker {index}'])[0]
+        for index, (worker, save_path) in enumerate(zip(workers, save_paths))
+    ]
+
+    assert keys == ['output/ComfyUI_00006_.png', 'output/ComfyUI_00007_.png']
+    assert [client.get_object(Bucket='comfys3', Key=key)['Body'].read() for key in keys] == [b'worker 0', b'worker 1']
+
+
+def test_create_env_writes_the_transfer_settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('COMFYS3_S3_MAX_CONCURRENCY', '3')
+    monkeypatch.delenv('COMFYS3_S3_MAX_BANDWIDTH', raising=False)
+    create_env = runpy.run_path(f'{os.path.dirname(rp_handler.__file__)}/comfyui/custom_nodes/comfys3/create_env.py')
+
+    create_env['main']()
+
+    for name, value in dotenv_values(tmp_path / '.env').items():
+        monkeypatch.setenv(name, value)
+
+    s3_client = load_comfys3(tmp_path, monkeypatch)
+
+    assert s3_client.TRANSFER_CONFIG.max_request_concurrency == 3
+    assert s3_client.TRANSFER_CONFIG.max_bandwidth is None
+    assert s3_client.TRANSFER_CONFIG.multipart_chunksize == 16 * 1024 * 1024
+    assert s3_client.S3_BATCH_WORKERS == 4
@@ -0,0 +1,74 @@
+import os
+import uuid
+import threading
+import rp_handler
+from conftest import wait_until
+
+GRAPH = {
+    '1': {'class_type': 'EmptyImage', 'inputs': {'width': 64, 'height': 64}},
+    '2': {'class_type': 'SaveImage', 'inputs': {'images': ['1', 0], 'filename_prefix': 'ComfyUI'}}
+}
+
+
+def queue_prompt(graph=GRAPH):
+    prompt_id = str(uuid.uuid4())
+    generation = rp_handler.comfyui_events.snapshot()
+    response = rp_handler.send_post_request('prompt', {
+        'prompt': graph,
+        'client_id': rp_handler.CLIENT_ID,
+        'prompt_id': prompt_id
+    })
+    assert response.status_code == 200
+    return prompt_id, generation
+
+
+def test_websocket_completion_fetches_history_once(comfyui):
+    prompt_id, generation = queue_prompt()
+    assert generation is not None
+
+    history = rp_handler.wait_for_prompt(prompt_id, generation)
+
+    assert history[prompt_id]['status']['status_str'] == 'success'
+    assert comfyui.history_requests == 1
+
+
+def test_polls_history_while_socket_is_down(comfyui):
+    comfyui.drop_websockets()
+    wait_until(lambda: rp_handler.comfyui_events.snapshot() is None)
+    prompt_id, generation = queue_prompt()
+    assert generation is None
+
+    history = rp_handler.wait_for_prompt(prompt_id, generation)
+
+    assert history[prompt_id]['status']['status_str'] == 'success'
+    assert comfyui.history_requests >= 1
+
+
+def test_falls_back_to_polling_when_socket_drops(comfyui):
+    comfyui.node_delay = 0.3
+    prompt_id, generation = queue_prompt()
+    threading.Timer(0.1, comfyui.drop_websockets).start()
+
+    history = rp_handler.wait_for_prompt(prompt_id, generation, deadline=None)
+
+    assert rp_handler.comfyui_events.snapshot() is None
+    assert history[prompt_id]['status']['status_str'] == 'success'
+
+
+def test_resumes_websocket_completion_after_reconnecting(comfyui):
+    comfyui.drop_websockets()
+    wait_until(lambda: rp_handler.comfyui_events.snapshot() is None)
+    comfyui.websocket_enabled = True
+    wait_until(lambda: rp_handler.comfyui_events.snapshot() is not None)
+    prompt_id, generation = queue_prompt()
+
+    rp_handler.wait_for_prompt(prompt_id, generation)
+
+    assert comfyui.history_requests == 1
+
+
+def test_handler_returns_outputs_and_deletes_files(comfyui):
+    result = rp_handler.handler({'id': 'job', 'input': {'callback': {}, 'payload': GRAPH}})
+
+    assert len(result['images']) == 1
+    assert os.listdir(comfyui.output_dir) == []
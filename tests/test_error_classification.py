@@ -0,0 +1,105 @@
+import pytest
+import requests
+import rp_handler
+
+# execution_error payloads as recorded from ComfyUI, without the tracebacks and inputs
+OOM = {
+    'node_id': '3',
+    'node_type': 'KSampler',
+    'exception_type': 'torch.OutOfMemoryError',
+    'exception_message': 'Allocation on device 0 would exceed allowed memory. (out of memory)\n'
+                         'Currently allocated     : 21.93 GiB\nRequested               : 1.27 GiB'
+}
+ILLEGAL_MEMORY_ACCESS = {
+    'node_id': '8',
+    'node_type': 'VAEDecode',
+    'exception_type': 'RuntimeError',
+    'exception_message': 'CUDA error: an illegal memory access was encountered\n'
+                         'CUDA kernel errors might be asynchronously reported at some other API call, '
+                         'so the stacktrace below might be incorrect.'
+}
+MISSING_INPUT_FILE = {
+    'node_id': '10',
+    'node_type': 'LoadImage',
+    'exception_type': 'FileNotFoundError',
+    'exception_message': "[Errno 2] No such file or directory: '/comfyui/input/missing.png'"
+}
+NODE_ERRORS = {
+    'error': {
+        'type': 'prompt_outputs_failed_validation',
+        'message': 'Prompt outputs failed validation',
+        'details': '',
+        'extra_info': {}
+    },
+    'node_errors': {
+        '3': {
+            'errors': [{
+                'type': 'value_not_in_list',
+                'message': 'Value not in list',
+                'details': "sampler_name: 'euler_x' not in ['euler', 'euler_ancestral']",
+                'extra_info': {'input_name': 'sampler_name'}
+            }],
+            'dependent_outputs': ['9'],
+            'class_type': 'KSampler'
+        }
+    }
+}
+
+
+def coalesced(error):
+    flights = rp_handler.PromptFlights()
+    flight, _ = flights.join('key')
+    flights.complete('key', flight, error)
+
+    try:
+        flights.wait(flight)
+    except Exception as e:
+        return e
+
+
+CASES = [
+    ('oom', rp_handler.ExecutionError('KSampler', OOM), 'poisoned', True),
+    ('illegal memory access', rp_handler.ExecutionError('VAEDecode', ILLEGAL_MEMORY_ACCESS), 'poisoned', True),
+    ('missing input file', rp_handler.ExecutionError('LoadImage', MISSING_INPUT_FILE), 'user', False),
+    ('400 with node_errors', rp_handler.PromptRejectedError(400, NODE_ERRORS), 'user', False),
+    ('500', rp_handler.PromptRejectedError(500, 'Internal Server Error'), 'transient', False),
+    (
+        'connection refused',
+        requests.exceptions.ConnectionError(
+            "HTTPConnectionPool(host='127.0.0.1', port=8188): Max retries exceeded with url: /prompt "
+            "(Caused by NewConnectionError('Failed to establish a new connection: [Errno 111] Connection refused'))"
+        ),
+        'transient',
+        False
+    ),
+    (
+        'lost websocket',
+        rp_handler.TransientError('Lost the websocket connection while capturing the outputs of prompt: 1234'),
+        'transient',
+        False
+    ),
+    ('coalesced oom', coalesced(rp_handler.ExecutionError('KSampler', OOM)), 'poisoned', True)
+]
+
+
+@pytest.mark.parametrize('error, category, refresh', [case[1:] for case in CASES], ids=[case[0] for case in CASES])
+def test_classifies_recorded_errors(error, category, refresh, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'check_comfyui_health', lambda: None)
+
+    assert rp_handler.classify_error(error) == category
+    assert rp_handler.should_refresh_worker(error) is refresh
+
+
+@pytest.mark.parametrize('problem, refresh', [(None, False), ('ComfyUI process has exited', True)])
+def test_refreshes_on_unrecognised_errors_only_when_unhealthy(problem, refresh, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'check_comfyui_health', lambda: problem)
+    error = KeyError('filename_prefix')
+
+    assert rp_handler.classify_error(error) is None
+    assert rp_handler.should_refresh_worker(error) is refresh
+
+
+def test_refreshes_on_transient_errors_when_unhealthy(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'check_comfyui_health', lambda: 'ComfyUI /queue is not healthy')
+
+    assert rp_handler.should_refresh_worker(rp_handler.PromptRejectedError(500, '')) is True
@@ -0,0 +1,44 @@
+import pytest
+import rp_handler
+from benchmark_graph_validator import BROKEN_GRAPHS, load_wan_workflow, make_object_info, make_broken_graph
+
+
+@pytest.fixture
+def workflow():
+    return load_wan_workflow()
+
+
+@pytest.fixture
+def validator(workflow):
+    validator = rp_handler.GraphValidator()
+    validator.load(make_object_info(workflow, filler=10))
+    return validator
+
+
+def test_accepts_everything_until_loaded(workflow):
+    validator = rp_handler.GraphValidator()
+
+    assert validator.validate(make_broken_graph(workflow, BROKEN_GRAPHS[0][1])) == []
+
+
+def test_accepts_the_wan_workflow(validator, workflow):
+    assert validator.validate(workflow) == []
+    assert validator.get_stats() == {'node_types': len(make_object_info(workflow)) + 10, 'rejected': 0}
+
+
+@pytest.mark.parametrize('mutate, expected', [case[1:] for case in BROKEN_GRAPHS], ids=[case[0] for case in BROKEN_GRAPHS])
+def test_rejects_broken_graphs(validator, workflow, mutate, expected):
+    errors = validator.validate(make_broken_graph(workflow, mutate))
+
+    assert expected in errors
+    assert validator.get_stats()['rejected'] == 1
+
+
+def test_ignores_malformed_definitions(workflow):
+    object_info = make_object_info(workflow)
+    object_info['Broken'] = {'input': ['not', 'a', 'dict']}
+    validator = rp_handler.GraphValidator()
+    validator.load(object_info)
+
+    assert 'Broken' not in validator.node_types
+    assert validator.validate(workflow) == []
@@ -0,0 +1,139 @@
+import os
+import base64
+import hashlib
+import threading
+import http.server
+import pytest
+import requests
+import rp_handler
+
+
+class ImageServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the images it is given under /images/<name> and counts the requests.
+    """
+    def __init__(self, images):
+        super().__init__(('127.0.0.1', 0), ImageRequestHandler)
+        self.images = images
+        self.requests = []
+
+    def get_url(self, name):
+        return f'http://127.0.0.1:{self.server_address[1]}/images/{name}'
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        data = self.server.images.get(os.path.basename(self.path))
+
+        if data is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def image_server():
+    server = ImageServer({'red.png': b'red image', 'blue.png': b'blue image'})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def input_cache(tmp_path, monkeypatch):
+    input_cache = rp_handler.InputCache(str(tmp_path / 'input'), 'prefetch', 1024 * 1024)
+    monkeypatch.setattr(rp_handler, 'input_cache', input_cache)
+    monkeypatch.setattr(rp_handler, 'download_session', requests.Session(), raising=False)
+    return input_cache
+
+
+def get_filename(data, extension='.png'):
+    return f'{hashlib.sha256(data).hexdigest()}{extension}'
+
+
+def test_stores_each_content_once(input_cache):
+    first = input_cache.store(b'image', '.png', source='https://example.com/image.png')
+    second = input_cache.store(b'image', '.png')
+
+    assert first == second == get_filename(b'image')
+    assert input_cache.lookup('https://example.com/image.png') == first
+    assert input_cache.lookup('https://example.com/other.png') is None
+    assert input_cache.get_stats() == {'files': 1, 'bytes': 5, 'hits': 2, 'misses': 1, 'bytes_saved': 5}
+    assert os.listdir(input_cache.cache_dir) == [first]
+    assert input_cache.pinned[first] == 3
+
+
+def test_evicts_the_least_recently_used_unpinned_files(input_cache):
+    input_cache.max_bytes = 30
+    stored = {name: input_cache.store(name.encode('utf-8') * 10, '.png', source=name) for name in 'abc'}
+    input_cache.release([stored['a'], stored['c']])
+
+    # b is still pinned by a queued job, and a was used again after c
+    input_cache.release([input_cache.lookup('a')])
+    stored['d'] = input_cache.store(b'd' * 10, '.png')
+
+    assert list(input_cache.files) == [stored['b'], stored['a'], stored['d']]
+    assert sorted(os.listdir(input_cache.cache_dir)) == sorted(input_cache.files)
+    assert input_cache.lookup('c') is None
+    assert input_cache.get_stats()['bytes'] == 30
+
+
+def test_picks_up_the_files_of_a_previous_run(input_cache):
+    os.makedirs(input_cache.cache_dir)
+
+    with open(f'{input_cache.cache_dir}/{get_filename(b"old")}', 'wb') as f:
+        f.write(b'old')
+
+    with open(f'{input_cache.cache_dir}/partial.png.tmp', 'wb') as f:
+        f.write(b'partial')
+
+    assert input_cache.store(b'old', '.png') == get_filename(b'old')
+    assert input_cache.get_stats() == {'files': 1, 'bytes': 3, 'hits': 1, 'misses': 0, 'bytes_saved': 0}
+    assert os.listdir(input_cache.cache_dir) == [get_filename(b'old')]
+
+
+def test_prefetches_input_images(input_cache, image_server):
+    png = b'png image'
+    payload = {
+        '1': {'class_type': 'LoadImage', 'inputs': {'image': image_server.get_url('red.png')}},
+        '2': {'class_type': 'LoadImageMask', 'inputs': {'image': f'data:image/png;base64,{base64.b64encode(png).decode("utf-8")}'}},
+        '3': {'class_type': 'LoadImage', 'inputs': {'image': 'example.png'}},
+        '4': {'class_type': 'EmptyImage', 'inputs': {'width': 64}}
+    }
+
+    filenames = rp_handler.prefetch_input_images(payload)
+
+    assert filenames == [get_filename(b'red image'), get_filename(png)]
+    assert [payload[node_id]['inputs'].get('image') for node_id in payload] == [
+        f'prefetch/{filenames[0]}', f'prefetch/{filenames[1]}', 'example.png', None
+    ]
+
+    rp_handler.input_cache.release(filenames)
+    payload['1']['inputs']['image'] = image_server.get_url('red.png')
+
+    assert rp_handler.prefetch_input_images(payload) == [filenames[0]]
+    assert image_server.requests == ['/images/red.png']
+
+
+def test_releases_the_fetched_images_when_one_fails(input_cache, image_server):
+    payload = {
+        '1': {'class_type': 'LoadImage', 'inputs': {'image': image_server.get_url('red.png')}},
+        '2': {'class_type': 'LoadImage', 'inputs': {'image': image_server.get_url('missing.png')}},
+        '3': {'class_type': 'LoadImage', 'inputs': {'image': image_server.get_url('blue.png')}}
+    }
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        rp_handler.prefetch_input_images(payload)
+
+    assert not +input_cache.pinned
+    assert input_cache.get_stats()['files'] == 2
+    assert payload['1']['inputs']['image'] == image_server.get_url('red.png')
@@ -0,0 +1,44 @@
+import time
+import asyncio
+import rp_handler
+from test_completion_listener import GRAPH
+
+JOBS = 8
+
+
+def make_graph(index):
+    # Graphs differ so that the jobs are not coalesced into one prompt
+    graph = {node_id: dict(node, inputs=dict(node['inputs'])) for node_id, node in GRAPH.items()}
+    graph['1']['inputs']['color'] = index
+    return graph
+
+
+async def run_jobs(concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_job(index):
+        async with semaphore:
+            return await rp_handler.async_handler({'id': f'job-{index}', 'input': {'callback': {}, 'payload': make_graph(index)}})
+
+    return await asyncio.gather(*[run_job(index) for index in range(JOBS)])
+
+
+def test_throughput_by_concurrency(comfyui, capsys):
+    # Long enough prompts and large enough outputs for the handler's own work to matter
+    comfyui.node_delay = 0.05
+    comfyui.image_size = 1024
+    throughput = {}
+
+    for concurrency in (1, 2, 4):
+        start = time.perf_counter()
+        results = asyncio.run(run_jobs(concurrency))
+        throughput[concurrency] = JOBS / (time.perf_counter() - start)
+
+        assert all(len(result['images']) == 1 for result in results)
+
+    with capsys.disabled():
+        print('\n' + ', '.join(f'concurrency {concurrency}: {jobs:.1f} jobs/s' for concurrency, jobs in throughput.items()))
+
+    assert comfyui.count_requests('POST', '/prompt') == 3 * JOBS
+    # Prompts still run one at a time, so jobs in flight can only overlap the handler's work with them
+    assert throughput[4] > throughput[1]
@@ -0,0 +1,73 @@
+import json
+import time
+import logging
+import threading
+import http.server
+import pytest
+import rp_handler
+from conftest import wait_until
+
+
+class LogAPI(http.server.ThreadingHTTPServer):
+    """
+    A stand-in log API that answers after delay seconds and keeps the batches
+    it received.
+    """
+    def __init__(self, delay):
+        super().__init__(('127.0.0.1', 0), LogAPIRequestHandler)
+        self.delay = delay
+        self.batches = []
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/logs'
+
+
+class LogAPIRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(self.server.delay)
+        self.server.batches.append(json.loads(body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def log_api(monkeypatch):
+    server = LogAPI(delay=1)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv('LOG_API_ENDPOINT', server.endpoint)
+    monkeypatch.setenv('LOG_API_FLUSH_INTERVAL', '60')
+    yield server
+    server.shutdown()
+
+
+def make_record(message):
+    return logging.LogRecord('test', logging.INFO, __file__, 0, message, None, None)
+
+
+def test_flush_does_not_wait_for_a_slow_log_api(log_api):
+    log_handler = rp_handler.SnapLogHandler('test')
+    log_handler.emit(make_record('first'))
+    log_handler.emit(make_record('second'))
+
+    start = time.monotonic()
+    log_handler.flush()
+
+    assert time.monotonic() - start < 0.1
+    wait_until(lambda: log_api.batches)
+    assert [record['log_message'] for record in log_api.batches[0]] == ['first', 'second']
+    log_handler.close()
+
+
+def test_close_ships_the_remaining_records(log_api):
+    log_handler = rp_handler.SnapLogHandler('test')
+    log_handler.emit(make_record('last'))
+
+    log_handler.close()
+
+    assert [record['log_message'] for batch in log_api.batches for record in batch] == ['last']
+    assert log_handler.get_stats()['records_shipped'] == 1
@@ -0,0 +1,74 @@
+import sys
+import asyncio
+import types
+import pytest
+import requests
+from aiohttp import web
+import rp_handler
+from conftest import load_comfys3
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(rp_handler.metrics, 'collectors', [])
+
+    for name in ('comfys3_transfers_total', 'comfys3_transfer_bytes_total', 'comfys3_transfer_seconds_total'):
+        monkeypatch.setitem(rp_handler.metrics.metrics[name], 'values', {})
+
+    rp_handler.metrics.add_collector('comfys3', rp_handler.collect_comfyui_s3_transfers)
+    return rp_handler.metrics
+
+
+def scrape():
+    server = rp_handler.http.server.ThreadingHTTPServer(('127.0.0.1', 0), rp_handler.MetricsRequestHandler)
+    rp_handler.threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        return requests.get(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5).text
+    finally:
+        server.shutdown()
+
+
+def test_exports_the_s3_transfers_made_inside_comfyui(comfyui, registry):
+    comfyui.s3_transfers = [
+        {'direction': 'upload', 'status': 'success', 'count': 3, 'bytes': 300, 'seconds': 1.5},
+        {'direction': 'upload', 'status': 'error', 'count': 1, 'bytes': 0, 'seconds': 0.0}
+    ]
+    rp_handler.observe_s3_transfer('download', 'success', 10, 0.1)
+
+    text = scrape()
+
+    assert 'comfys3_transfers_total{process="comfyui",direction="upload",status="success"} 3' in text
+    assert 'comfys3_transfers_total{process="comfyui",direction="upload",status="error"} 1' in text
+    assert 'comfys3_transfer_bytes_total{process="comfyui",direction="upload"} 300' in text
+    assert 'comfys3_transfers_total{process="handler",direction="download",status="success"}' in text
+
+
+def test_skips_comfyui_without_comfys3(comfyui, registry):
+    text = scrape()
+
+    assert 'process="comfyui"' not in text
+    assert 'Unable to collect' not in text
+
+
+"""
+Import s3_client as it is loaded inside ComfyUI, with a stand-in for the
+ComfyUI server module, and check the totals served by its stats route.
+"""
+def test_comfys3_serves_its_transfer_totals(tmp_path, monkeypatch):
+    routes = web.RouteTableDef()
+    prompt_server = types.SimpleNamespace(instance=types.SimpleNamespace(routes=routes))
+    monkeypatch.setitem(sys.modules, 'server', types.SimpleNamespace(PromptServer=prompt_server))
+
+    s3_client = load_comfys3(tmp_path, monkeypatch)
+    s3_client._notify_transfer('upload', 'success', 100, 0.5)
+    s3_client._notify_transfer('upload', 'success', 50, 0.25)
+    s3_client._notify_transfer('download', 'error')
+
+    [route] = [route for route in routes if route.path == '/comfys3/stats']
+    response = asyncio.run(route.handler(None))
+
+    assert rp_handler.json.loads(response.text) == [
+        {'direction': 'upload', 'status': 'success', 'count': 2, 'bytes': 150, 'seconds': 0.75},
+        {'direction': 'download', 'status': 'error', 'count': 1, 'bytes': 0, 'seconds': 0.0}
+    ]
@@ -0,0 +1,30 @@
+import copy
+import rp_handler
+from test_completion_listener import GRAPH
+
+
+def capture(**options):
+    payload = copy.deepcopy(GRAPH)
+    policy = dict(rp_handler.DEFAULT_OUTPUT_POLICY, capture='websocket', **options)
+    return payload, rp_handler.prepare_output_capture(payload, policy, generation=1)
+
+
+def test_captures_raw_pixels_when_encoding_again():
+    payload, capture_nodes = capture(passthrough=False)
+
+    assert capture_nodes == ['2']
+    assert payload['2'] == {'class_type': 'SaveImageWebsocket', 'inputs': {'images': ['1', 0], 'format': 'RAW'}}
+
+
+def test_captures_png_when_passing_through():
+    payload, _ = capture(passthrough=True)
+
+    assert payload['2']['inputs']['format'] == 'PNG'
+
+
+def test_saves_to_disk_while_the_socket_is_down():
+    payload = copy.deepcopy(GRAPH)
+    policy = dict(rp_handler.DEFAULT_OUTPUT_POLICY, capture='websocket')
+
+    assert rp_handler.prepare_output_capture(payload, policy, generation=None) == []
+    assert payload == GRAPH
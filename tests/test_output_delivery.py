@@ -0,0 +1,82 @@
+import base64
+import boto3
+import pytest
+import rp_handler
+
+SMALL = b'small image'
+LARGE = b'large image ' * 100
+TEXT = 'caption ' * 100
+
+
+@pytest.fixture
+def s3(comfys3, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'import_comfys3_module', lambda name: comfys3)
+    monkeypatch.setattr(rp_handler, 's3', None)
+    return rp_handler.get_s3()
+
+
+def make_policy(**overrides):
+    return dict(rp_handler.DEFAULT_OUTPUT_POLICY, delivery='s3', inline_max_bytes=100, **overrides)
+
+
+def make_outputs():
+    images = [{'filename': 'small.png', 'data': SMALL}, {'filename': 'large.png', 'data': LARGE}]
+    texts = [
+        {'filename': 'short.txt', 'type': 'text', 'content': 'short', 'content_raw': 'short'},
+        {'filename': 'long.txt', 'type': 'text', 'content': TEXT, 'content_raw': TEXT}
+    ]
+    return images, texts
+
+
+def read_object(key):
+    return boto3.client('s3', region_name='us-east-1').get_object(Bucket='comfys3', Key=key)['Body'].read()
+
+
+def test_uploads_outputs_over_the_inline_threshold(s3):
+    images, texts = make_outputs()
+
+    delivered_images, images_format, delivered_texts = rp_handler.deliver_outputs(images, texts, make_policy(presign=False), 'job-1')
+
+    assert images_format == 'webp'
+    assert delivered_images == [base64.b64encode(SMALL).decode('utf-8'), {'s3_key': 'output/job-1/large.webp'}]
+    assert delivered_texts == [texts[0], {'filename': 'long.txt', 'type': 'text', 's3_key': 'output/job-1/long.txt'}]
+    assert read_object('output/job-1/large.webp') == LARGE
+    assert read_object('output/job-1/long.txt') == TEXT.encode('utf-8')
+
+
+def test_presigns_the_uploaded_outputs(s3):
+    images, texts = make_outputs()
+
+    delivered_images, _, delivered_texts = rp_handler.deliver_outputs(images, texts, make_policy(presign=True), 'job-1')
+
+    for output in (delivered_images[1], delivered_texts[1]):
+        assert output['url'].startswith(f'https://comfys3.s3.amazonaws.com/{output["s3_key"]}?')
+        assert 'Signature' in output['url']
+
+
+def test_returns_failed_uploads_inline(s3, monkeypatch):
+    upload_fileobj = s3.s3_client.upload_fileobj
+
+    def failing_upload_fileobj(fileobj, bucket, key, **kwargs):
+        if key.endswith('.webp'):
+            raise ConnectionError('Connection reset by peer')
+
+        return upload_fileobj(fileobj, bucket, key, **kwargs)
+
+    monkeypatch.setattr(s3.s3_client, 'upload_fileobj', failing_upload_fileobj)
+    images, texts = make_outputs()
+
+    delivered_images, _, delivered_texts = rp_handler.deliver_outputs(images, texts, make_policy(), 'job-1')
+
+    assert delivered_images == [base64.b64encode(image['data']).decode('utf-8') for image in images]
+    assert delivered_texts[1]['s3_key'] == 'output/job-1/long.txt'
+
+
+def test_returns_everything_inline_without_s3(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'get_s3', lambda: None)
+    images, texts = make_outputs()
+
+    delivered_images, _, delivered_texts = rp_handler.deliver_outputs(images, texts, make_policy(), 'job-1')
+
+    assert delivered_images == [base64.b64encode(image['data']).decode('utf-8') for image in images]
+    assert delivered_texts == texts
@@ -0,0 +1,77 @@
+import os
+import copy
+import threading
+import pytest
+import rp_handler
+from conftest import wait_until
+from test_completion_listener import GRAPH
+
+JOBS = 8
+
+
+def test_identical_jobs_share_one_prompt(comfyui):
+    # Slow enough that every job joins the flight before the prompt is done
+    comfyui.node_delay = 0.5
+    barrier = threading.Barrier(JOBS)
+    results = [None] * JOBS
+
+    def run_job(index):
+        barrier.wait()
+        results[index] = rp_handler.handler({
+            'id': f'job-{index}',
+            'input': {'callback': {}, 'payload': copy.deepcopy(GRAPH)}
+        })
+
+    threads = [threading.Thread(target=run_job, args=(index,)) for index in range(JOBS)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join(30)
+
+    assert comfyui.count_requests('POST', '/prompt') == 1
+    assert all(result == results[0] for result in results)
+    assert len(results[0]['images']) == 1
+    assert os.listdir(comfyui.output_dir) == []
+    assert rp_handler.prompt_flights.flights == {}
+
+
+def test_failing_leader_completes_its_flight(comfyui, monkeypatch):
+    # A SaveImage without a filename_prefix fails the leader after it has joined the flight
+    graph = copy.deepcopy(GRAPH)
+    del graph['2']['inputs']['filename_prefix']
+    create_unique_filename_prefix = rp_handler.create_unique_filename_prefix
+    coalesced = rp_handler.prompt_flights.coalesced
+
+    def create_after_follower_joined(payload):
+        wait_until(lambda: rp_handler.prompt_flights.coalesced > coalesced)
+        create_unique_filename_prefix(payload)
+
+    monkeypatch.setattr(rp_handler, 'create_unique_filename_prefix', create_after_follower_joined)
+    results = {}
+
+    def run_job(job_id):
+        results[job_id] = rp_handler.handler({'id': job_id, 'input': {'callback': {}, 'payload': copy.deepcopy(graph)}})
+
+    threads = [threading.Thread(target=run_job, args=(job_id,)) for job_id in ('leader', 'follower')]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join(30)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert all('KeyError' in result['error'] for result in results.values())
+    assert rp_handler.prompt_flights.flights == {}
+    assert comfyui.count_requests('POST', '/prompt') == 0
+
+
+def test_wait_times_out():
+    flights = rp_handler.PromptFlights()
+    flights.join('key')
+    flight, leads_flight = flights.join('key')
+
+    with pytest.raises(TimeoutError):
+        flights.wait(flight, 0.01)
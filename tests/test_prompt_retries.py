@@ -0,0 +1,48 @@
+import pytest
+import rp_handler
+from test_completion_listener import GRAPH
+
+
+@pytest.fixture
+def short_timeout(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'TIMEOUT', 0.5)
+    monkeypatch.setattr(rp_handler, 'TRANSIENT_RETRY_DELAY', 0.01)
+
+
+def run_graph():
+    return rp_handler.run_prompt_with_retries(dict(GRAPH), rp_handler.DEFAULT_OUTPUT_POLICY.copy(), None)
+
+
+def test_cancels_the_prompt_before_queuing_it_again(comfyui, short_timeout):
+    # The first prompt is accepted but its response arrives after the timeout
+    comfyui.node_delay = 0.3
+    comfyui.response_delays['/prompt'] = [1]
+
+    prompt = run_graph()
+
+    first_prompt_id = comfyui.prompts[0]['prompt_id']
+    assert comfyui.count_requests('POST', '/prompt') == 2
+    assert first_prompt_id in comfyui.cancelled
+    assert list(comfyui.history) == [prompt['prompt_id']]
+    assert prompt['prompt_id'] != first_prompt_id
+
+
+def test_waits_again_for_the_same_prompt_when_history_times_out(comfyui, short_timeout):
+    comfyui.response_delays['/history/{prompt_id}'] = [1]
+
+    prompt = run_graph()
+
+    assert comfyui.count_requests('POST', '/prompt') == 1
+    assert comfyui.history_requests == 2
+    assert comfyui.cancelled == set()
+    assert prompt['history'][prompt['prompt_id']]['status']['status_str'] == 'success'
+
+
+def test_does_not_queue_again_when_comfyui_is_down(comfyui, short_timeout, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'check_comfyui_health', lambda: 'ComfyUI process has exited')
+    comfyui.response_delays['/prompt'] = [1]
+
+    with pytest.raises(rp_handler.TransientError):
+        run_graph()
+
+    assert comfyui.count_requests('POST', '/prompt') == 1
@@ -0,0 +1,63 @@
+import time
+import rp_handler
+
+GiB = 1024 ** 3
+
+
+def make_stats(vram_free):
+    return {
+        'system': {'ram_total': 64 * GiB, 'ram_free': 60 * GiB},
+        'devices': [{'type': 'cuda', 'vram_total': 24 * GiB, 'vram_free': vram_free}]
+    }
+
+
+def test_frees_without_holding_the_lock():
+    calls = []
+
+    def sample():
+        assert not governor.lock.locked()
+        calls.append('sample')
+        return make_stats(GiB)
+
+    def free():
+        assert not governor.lock.locked()
+        calls.append('free')
+
+    governor = rp_handler.ResourceGovernor(sample, free, GiB, 0.2)
+    token = governor.before_prompt('flux', {'flux.safetensors'})
+    governor.after_prompt(token)
+
+    assert calls == ['sample', 'free', 'sample']
+    assert token[2] is True
+    assert governor.get_stats()['frees'] == 1
+    assert governor.resident_models == {'flux.safetensors'}
+
+
+def test_keeps_resident_models_loaded():
+    frees = []
+    governor = rp_handler.ResourceGovernor(lambda: make_stats(GiB), lambda: frees.append(1), GiB, 0.2)
+    governor.resident_models.add('flux.safetensors')
+
+    token = governor.before_prompt('flux', {'flux.safetensors'})
+
+    assert frees == []
+    assert token[2] is False
+    assert governor.get_stats()['hot_reuses'] == 1
+
+
+def test_gives_up_quickly_on_a_busy_comfyui(comfyui, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'HEALTH_CHECK_TIMEOUT', 0.2)
+    comfyui.response_delays['/system_stats'] = [2]
+    governor = rp_handler.ResourceGovernor(rp_handler.get_system_stats, rp_handler.free_comfyui_memory, GiB, 0.2)
+    start = time.monotonic()
+
+    assert governor.before_prompt('flux', {'flux.safetensors'}) is None
+    assert time.monotonic() - start < 1
+    assert comfyui.count_requests('GET', '/system_stats') == 1
+
+
+def test_frees_comfyui_memory(comfyui):
+    rp_handler.free_comfyui_memory()
+
+    assert rp_handler.get_system_stats()['devices'][0]['type'] == 'cuda'
+    assert comfyui.count_requests('POST', '/free') == 1
@@ -0,0 +1,92 @@
+import os
+import copy
+import time
+import pytest
+import rp_handler
+from test_completion_listener import GRAPH
+
+
+@pytest.fixture
+def result_cache(tmp_path, monkeypatch):
+    result_cache = rp_handler.ResultCache(rp_handler.DiskResultStore(str(tmp_path / 'result-cache'), 1024 * 1024, 60))
+    monkeypatch.setattr(rp_handler, 'RESULT_CACHE', True)
+    monkeypatch.setattr(rp_handler, 'result_cache', result_cache)
+    return result_cache
+
+
+def test_expires_entries_after_the_ttl(tmp_path):
+    store = rp_handler.DiskResultStore(str(tmp_path), 1024, 60)
+    store.put('old', b'old result')
+    store.put('new', b'new result')
+
+    # Entries are dated by their file when the store is opened again
+    expired = time.time() - 120
+    os.utime(tmp_path / 'old.json', (expired, expired))
+    store = rp_handler.DiskResultStore(str(tmp_path), 1024, 60)
+
+    assert store.get('old') is None
+    assert store.get('new') == b'new result'
+    assert store.get_stats() == {'entries': 1, 'bytes': 10}
+    assert os.listdir(tmp_path) == ['new.json']
+
+
+def test_evicts_the_least_recently_used_entries(tmp_path):
+    store = rp_handler.DiskResultStore(str(tmp_path), 25, 60)
+    store.put('a', b'a' * 10)
+    store.put('b', b'b' * 10)
+    store.get('a')
+    store.put('c', b'c' * 10)
+
+    assert store.get('b') is None
+    assert [store.get(key) for key in 'ac'] == [b'a' * 10, b'c' * 10]
+    assert sorted(os.listdir(tmp_path)) == ['a.json', 'c.json']
+
+
+def test_reports_hits_and_seconds_saved(result_cache):
+    result_cache.store('key', {'images': ['image']}, 12.5)
+
+    assert result_cache.lookup('other') is None
+    assert result_cache.lookup('key') == {'images': ['image']}
+    assert result_cache.get_stats() == {
+        'entries': 1,
+        'bytes': len(b'{"result": {"images": ["image"]}, "seconds": 12.5}'),
+        'hits': 1,
+        'misses': 1,
+        'hit_rate': 0.5,
+        'gpu_seconds_saved': 12.5
+    }
+
+
+def test_key_ignores_output_names_and_titles():
+    policy = rp_handler.DEFAULT_OUTPUT_POLICY
+    graph = copy.deepcopy(GRAPH)
+    graph['3'] = {'class_type': 'SaveText|pysssss', 'inputs': {'text': 'caption', 'file': 'caption.txt'}}
+    renamed = copy.deepcopy(graph)
+    renamed['2']['inputs']['filename_prefix'] = 'Other'
+    renamed['2']['_meta'] = {'title': 'Save the image'}
+    renamed['3']['inputs']['file'] = 'other.txt'
+    key = rp_handler.get_result_key(graph, policy)
+
+    assert rp_handler.get_result_key(renamed, policy) == key
+
+    renamed['3']['inputs']['file'] = 'caption.json'
+    assert rp_handler.get_result_key(renamed, policy) != key
+
+    graph['1']['inputs']['width'] = 128
+    assert rp_handler.get_result_key(graph, policy) != key
+    assert rp_handler.get_result_key(GRAPH, dict(policy, format='png')) != rp_handler.get_result_key(GRAPH, policy)
+
+
+def test_cache_hit_does_not_queue_the_prompt(comfyui, result_cache):
+    first = rp_handler.handler({'id': 'first', 'input': {'callback': {}, 'payload': copy.deepcopy(GRAPH)}})
+    graph = copy.deepcopy(GRAPH)
+    graph['2']['inputs']['filename_prefix'] = 'Other'
+    second = rp_handler.handler({'id': 'second', 'input': {'callback': {}, 'payload': graph}})
+
+    assert second == first
+    assert comfyui.count_requests('POST', '/prompt') == 1
+    assert result_cache.get_stats()['hits'] == 1
+
+    rp_handler.handler({'id': 'third', 'input': {'callback': {}, 'payload': copy.deepcopy(GRAPH), 'cache': False}})
+
+    assert comfyui.count_requests('POST', '/prompt') == 2
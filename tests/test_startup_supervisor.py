@@ -0,0 +1,74 @@
+import sys
+import socket
+import subprocess
+import pytest
+import rp_handler
+
+LOG = '''Total VRAM 24564 MB, total RAM 64230 MB
+Import times for custom nodes:
+   0.0 seconds: /comfyui/custom_nodes/websocket_image_save.py
+   0.3 seconds (IMPORT FAILED): /comfyui/custom_nodes/broken_node
+   2.4 seconds: /comfyui/custom_nodes/comfys3
+
+Starting server
+'''
+
+
+@pytest.fixture(autouse=True)
+def fast_polling(monkeypatch):
+    monkeypatch.setattr(rp_handler, 'STARTUP_POLL_INTERVAL', 0.05)
+
+
+def unused_uri():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{s.getsockname()[1]}'
+
+
+def test_parses_the_phases_from_the_log(fake_comfyui, tmp_path):
+    log_path = tmp_path / 'comfyui.log'
+    fake_comfyui.object_info = {'SaveImage': {}}
+    supervisor = rp_handler.StartupSupervisor(fake_comfyui.base_uri, str(log_path), timeout=10)
+
+    # A line that is still being written is only parsed once it is complete
+    log_path.write_text(LOG[:LOG.index('2.4 seconds') + 3])
+    supervisor._tail_log()
+
+    assert list(supervisor.phases) == ['process_spawned', 'nodes_loaded']
+    assert len(supervisor.node_import_times) == 2
+
+    with open(log_path, 'a') as f:
+        f.write(LOG[LOG.index('2.4 seconds') + 3:])
+
+    supervisor.wait()
+
+    assert list(supervisor.phases) == ['process_spawned', 'nodes_loaded', 'http_up', 'object_info']
+    assert supervisor.object_info == {'SaveImage': {}}
+    assert supervisor.node_import_times == [
+        (0.0, '/comfyui/custom_nodes/websocket_image_save.py'),
+        (0.3, '/comfyui/custom_nodes/broken_node'),
+        (2.4, '/comfyui/custom_nodes/comfys3')
+    ]
+    assert supervisor.failed_nodes == ['/comfyui/custom_nodes/broken_node']
+    assert 'slowest custom nodes: comfys3=2.4s' in supervisor.get_summary()
+    assert supervisor.get_summary().endswith('failed custom nodes: broken_node')
+
+
+def test_raises_at_the_deadline(tmp_path):
+    supervisor = rp_handler.StartupSupervisor(unused_uri(), str(tmp_path / 'missing.log'), timeout=0.3)
+
+    with pytest.raises(TimeoutError, match='not ready after 0.3s'):
+        supervisor.wait()
+
+    assert supervisor.phases == {}
+
+
+def test_raises_when_comfyui_exits(tmp_path):
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    supervisor = rp_handler.StartupSupervisor(unused_uri(), str(tmp_path / 'comfyui.log'), pid=process.pid, timeout=10)
+
+    with pytest.raises(RuntimeError, match='exited during startup'):
+        supervisor.wait()
+
+    assert list(supervisor.phases) == ['process_spawned']
@@ -0,0 +1,82 @@
+import json
+import asyncio
+import pytest
+import runpod
+import rp_handler
+
+GRAPH = {
+    '1': {'class_type': 'SaveText|pysssss', 'inputs': {'text': 'a caption', 'file': 'caption.txt'}},
+    '2': {'class_type': 'KSampler', 'inputs': {'seed': 1}},
+    '3': {'class_type': 'SaveImage', 'inputs': {'images': ['2', 0], 'filename_prefix': 'ComfyUI'}}
+}
+OOM = {
+    'exception_type': 'torch.OutOfMemoryError',
+    'exception_message': 'Allocation on device \nThis error means you ran out of memory on your GPU.',
+    'traceback': [],
+    'current_inputs': {},
+    'current_outputs': []
+}
+
+
+@pytest.fixture
+def worker_config(monkeypatch):
+    config = {}
+    monkeypatch.setattr(rp_handler, 'worker_config', config)
+    return config
+
+
+def run_stream(graph=GRAPH):
+    return list(rp_handler.stream_handler({'id': 'job', 'input': {'callback': {}, 'payload': graph}}))
+
+
+def test_streams_outputs_before_the_result(comfyui, worker_config):
+    updates = run_stream()
+    outputs = [update for update in updates[:-1] if update['type'] == 'output']
+
+    assert [output['node'] for output in outputs] == ['1', '3']
+    assert outputs[0]['texts'][0]['content_raw'] == 'a caption'
+    assert 'images' in updates[-1]
+    assert 'refresh_worker' not in worker_config
+
+
+def test_poisoned_error_refreshes_the_worker(comfyui, worker_config):
+    comfyui.errors['KSampler'] = OOM
+
+    updates = run_stream()
+
+    assert set(updates[-1]) == {'error'}
+    assert 'ran out of memory' in updates[-1]['error']
+    assert worker_config['refresh_worker'] is True
+
+
+def test_rejected_prompt_keeps_its_output(comfyui, worker_config):
+    node_errors = {'3': {'errors': [{'type': 'required_input_missing'}], 'class_type': 'SaveImage'}}
+    comfyui.reject = (400, {'error': {'type': 'prompt_outputs_failed_validation'}, 'node_errors': node_errors})
+
+    updates = run_stream()
+
+    error = updates[-1]['error']
+    assert error.startswith('HTTP status code: 400\n')
+    assert json.loads(error.split('\n', 1)[1])['output']['node_errors'] == node_errors
+    assert 'refresh_worker' not in worker_config
+
+
+def test_runpod_stops_the_pod_after_a_poisoned_streamed_job(comfyui, worker_config, monkeypatch):
+    comfyui.errors['KSampler'] = OOM
+    results = []
+
+    async def send_result(session, job_result, job, is_stream=False):
+        results.append(job_result)
+
+    async def stream_result(session, stream_output, job):
+        pass
+
+    monkeypatch.setattr(runpod.serverless.modules.rp_job, 'send_result', send_result)
+    monkeypatch.setattr(runpod.serverless.modules.rp_job, 'stream_result', stream_result)
+    worker_config.update({'handler': rp_handler.stream_handler, 'return_aggregate_stream': True})
+    job = {'id': 'job', 'input': {'callback': {}, 'payload': GRAPH}}
+
+    asyncio.run(runpod.serverless.modules.rp_job.handle_job(None, worker_config, job))
+
+    assert results[0]['stopPod'] is True
+    assert 'ran out of memory' in results[0]['error']
@@ -0,0 +1,63 @@
+import os
+import time
+import pytest
+import rp_handler
+from conftest import wait_until
+
+GRAPH = {
+    '1': {'class_type': 'LoadImage', 'inputs': {'image': 'example.png'}},
+    '2': {'class_type': 'SaveImage', 'inputs': {'images': ['1', 0], 'filename_prefix': 'warmup'}}
+}
+
+
+@pytest.fixture
+def warmup(comfyui, tmp_path, monkeypatch):
+    input_cache = rp_handler.InputCache(str(tmp_path / 'input'), 'prefetch', 1024 * 1024)
+    monkeypatch.setattr(rp_handler, 'input_cache', input_cache)
+    monkeypatch.setattr(rp_handler, 'WORKFLOW_WARMUP', {'test': {'params': {}}})
+    monkeypatch.setattr(rp_handler, 'get_warmup_payload', lambda workflow_name: {
+        node_id: dict(node, inputs=dict(node['inputs'])) for node_id, node in GRAPH.items()
+    })
+    return input_cache
+
+
+def test_deletes_the_warmup_outputs(comfyui, warmup):
+    rp_handler.run_warmup(timeout=10)
+
+    prompt = comfyui.prompts[0]['prompt']
+
+    assert comfyui.cancelled == set()
+    assert prompt['1']['inputs']['image'].startswith('prefetch/')
+    assert os.listdir(comfyui.output_dir) == []
+    assert comfyui.history == {}
+    assert comfyui.count_requests('POST', '/history') == 1
+    assert not +warmup.pinned
+
+
+def test_cancels_the_prompt_at_the_deadline(comfyui, warmup):
+    comfyui.node_delay = 1
+    start = time.monotonic()
+
+    rp_handler.run_warmup(timeout=0.3)
+
+    assert time.monotonic() - start < 1
+    # The prompt is removed from the queue and interrupted, so it never finishes
+    wait_until(lambda: comfyui.execution_lock is not None and not comfyui.execution_lock.locked())
+    assert len(comfyui.cancelled) == 1
+    assert comfyui.history == {}
+    assert comfyui.count_requests('POST', '/queue') == 1
+    assert comfyui.count_requests('POST', '/interrupt') == 1
+    assert not +warmup.pinned
+
+
+def test_gives_up_on_an_unresponsive_comfyui(comfyui, warmup, monkeypatch):
+    monkeypatch.setattr(rp_handler, 'HEALTH_CHECK_TIMEOUT', 0.2)
+    comfyui.node_delay = 1
+    comfyui.response_delays['/queue'] = [2]
+    start = time.monotonic()
+
+    rp_handler.run_warmup(timeout=0.3)
+
+    assert time.monotonic() - start < 1
+    assert comfyui.count_requests('POST', '/interrupt') == 0
+    assert not +warmup.pinned